@@ -0,0 +1,156 @@
+"""Batched admin alerts.
+
+Request handlers call ``queue_admin_alert`` instead of messaging the admin
+directly. Alerts are appended to a Redis list (an in-process list without
+Redis) so they survive restarts, and a single elected worker sends them as
+one WhatsApp digest once ``ADMIN_DIGEST_MAX_ITEMS`` have piled up or the
+oldest has waited ``ADMIN_DIGEST_WINDOW_SECONDS``. Digests are never sent
+more often than every ``ADMIN_DIGEST_MIN_INTERVAL`` seconds, and alerts are
+only removed from the list after Twilio accepts the message.
+"""
+
+import asyncio
+import logging
+import os
+import time
+from typing import List, Optional
+
+from leader import run_periodic
+from metrics import counter, gauge
+from session_store import get_redis
+from utils import notify_admin
+
+logger = logging.getLogger(__name__)
+
+ADMIN_DIGEST_WINDOW_SECONDS = float(os.getenv("ADMIN_DIGEST_WINDOW_SECONDS", "60"))
+ADMIN_DIGEST_MAX_ITEMS = int(os.getenv("ADMIN_DIGEST_MAX_ITEMS", "20"))
+ADMIN_DIGEST_MIN_INTERVAL = float(os.getenv("ADMIN_DIGEST_MIN_INTERVAL", "30"))
+ADMIN_DIGEST_KEY = os.getenv("ADMIN_DIGEST_KEY", "admin:alerts")
+# Twilio rejects WhatsApp bodies over 1600 characters
+_MAX_BODY = 1500
+# Longer alerts are cut so any one of them fits in a digest
+_MAX_ALERT = 1000
+_POLL_SECONDS = 1.0
+
+_local_alerts: List[str] = []
+
+DIGESTS_SENT = counter("metabolix_admin_digests_total", "Admin digests sent, by outcome.")
+
+
+async def queue_admin_alert(text: str) -> None:
+    """Buffer an alert for the next admin digest."""
+    text = _clip(text)
+    redis = get_redis()
+    if redis:
+        await redis.rpush(ADMIN_DIGEST_KEY, text)
+    else:
+        _local_alerts.append(text)
+
+
+async def pending_alerts() -> int:
+    """Number of alerts waiting for the next digest."""
+    redis = get_redis()
+    if redis:
+        return await redis.llen(ADMIN_DIGEST_KEY)
+    return len(_local_alerts)
+
+
+async def _peek(count: int) -> List[str]:
+    redis = get_redis()
+    if redis:
+        return await redis.lrange(ADMIN_DIGEST_KEY, 0, count - 1)
+    return _local_alerts[:count]
+
+
+async def _discard(count: int) -> None:
+    redis = get_redis()
+    if redis:
+        await redis.ltrim(ADMIN_DIGEST_KEY, count, -1)
+    else:
+        del _local_alerts[:count]
+
+
+def _clip(alert: str) -> str:
+    return alert if len(alert) <= _MAX_ALERT else alert[: _MAX_ALERT - 3] + "..."
+
+
+def _header(total: int) -> str:
+    return f"{total} new alert{'s' if total != 1 else ''}:"
+
+
+def digest_fit(alerts: List[str], total: Optional[int] = None) -> int:
+    """How many of ``alerts`` fit in one digest body."""
+    total = total if total is not None else len(alerts)
+    size = len(_header(total))
+    for shown, alert in enumerate(alerts):
+        size += len(_clip(alert)) + 3
+        if size > _MAX_BODY - 40:
+            return shown
+    return len(alerts)
+
+
+def format_digest(alerts: List[str], total: Optional[int] = None) -> str:
+    """Render alerts as one message, summarising whatever does not fit."""
+    total = total if total is not None else len(alerts)
+    shown = digest_fit(alerts, total)
+    lines = [_header(total)] + [f"- {_clip(alert)}" for alert in alerts[:shown]]
+    if total > shown:
+        lines.append(f"...and {total - shown} more")
+    return "\n".join(lines)
+
+
+async def flush_admin_digest() -> int:
+    """Send pending alerts as one digest; returns how many were sent.
+
+    Alerts stay queued if the send fails, so they go out with the next digest.
+    Only the alerts that fit in the message are removed; the rest are left
+    for the next one.
+    """
+    total = await pending_alerts()
+    if not total:
+        return 0
+    alerts = await _peek(total)
+    # Clipping guarantees the first alert fits; never leave the head stuck
+    shown = max(digest_fit(alerts), 1)
+    try:
+        await notify_admin(format_digest(alerts))
+    except Exception as exc:
+        DIGESTS_SENT.inc(outcome="failed")
+        logger.warning("Admin digest of %s alerts failed: %s", len(alerts), exc)
+        return 0
+    # Producers only append, so the first ``shown`` entries are the ones sent
+    await _discard(shown)
+    DIGESTS_SENT.inc(outcome="sent")
+    return shown
+
+
+async def _digest_loop() -> None:
+    first_seen: Optional[float] = None
+    last_sent = float("-inf")
+    while True:
+        now = time.monotonic()
+        try:
+            pending = await pending_alerts()
+        except Exception as exc:
+            logger.warning("Admin alert queue read failed: %s", exc)
+            pending = 0
+        if not pending:
+            first_seen = None
+        else:
+            first_seen = first_seen or now
+            due = pending >= ADMIN_DIGEST_MAX_ITEMS or now - first_seen >= ADMIN_DIGEST_WINDOW_SECONDS
+            if due and now - last_sent >= ADMIN_DIGEST_MIN_INTERVAL:
+                last_sent = now
+                # Alerts that did not fit stay due and go out after the interval
+                if await flush_admin_digest() >= pending:
+                    first_seen = None
+        await asyncio.sleep(_POLL_SECONDS)
+
+
+async def run_admin_digest() -> None:
+    """Run the digest sender on one worker cluster-wide."""
+    # The loop never returns, so it keeps the lease until cancelled or lost
+    await run_periodic("admin_digest", _digest_loop, interval=0)
+
+
+gauge("metabolix_admin_alerts_pending", "Admin alerts waiting for the next digest.", pending_alerts)
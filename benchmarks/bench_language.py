@@ -0,0 +1,43 @@
+"""Micro-benchmark: script-range language detection vs. langdetect.
+
+Run with ``python benchmarks/bench_language.py [iterations]``.
+"""
+
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils import _langdetect_language, detect_language  # noqa: E402
+
+LATIN = ["mounjaro cost?", "Hi, I want to lose weight"]
+INDIC = [
+    "मुझे वजन कम करना है",
+    "मला वजन कमी करायचे आहे",
+    "எனக்கு எடை குறைக்க வேண்டும்",
+    "నాకు బరువు తగ్గాలి",
+    "আমি ওজন কমাতে চাই",
+    "ਮੈਂ ਭਾਰ ਘਟਾਉਣਾ ਚਾਹੁੰਦਾ ਹਾਂ",
+    "મારે વજન ઘટાડવું છે",
+    "ನಾನು ತೂಕ ಇಳಿಸಬೇಕು",
+    "എനിക്ക് ഭാരം കുറയ്ക്കണം",
+]
+SAMPLES = LATIN + INDIC + ["👍"]
+
+
+def main() -> None:
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    _langdetect_language(SAMPLES[0])  # load langdetect profiles outside the timing
+    for label, texts in (("latin", LATIN), ("indic", INDIC)):
+        for name, fn in (("script+fallback", detect_language), ("langdetect", _langdetect_language)):
+            elapsed = timeit.timeit(lambda: [fn(t) for t in texts], number=iterations)
+            per_call = elapsed / (iterations * len(texts)) * 1e6
+            print(f"{label:>5} {name:>16}: {per_call:8.1f} us/message")
+    print()
+    for text in SAMPLES:
+        print(f"{detect_language(text):>10} | {_langdetect_language(text):>10} | {text}")
+
+
+if __name__ == "__main__":
+    main()
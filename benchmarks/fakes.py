@@ -0,0 +1,532 @@
+"""Local stand-ins for every external dependency used by the load test.
+
+* ``FakeDatabase`` - an in-memory substitute for the Motor database handle,
+  implementing just the query, update and projection operators the app uses.
+* ``FakeServices`` - one aiohttp server that impersonates the OpenAI chat
+  completions API, the Twilio Messages API and the Razorpay payment-links API,
+  with configurable OpenAI latency.
+
+Every call is counted in a shared ``collections.Counter`` so the harness can
+report per-dependency traffic.
+"""
+
+import asyncio
+import copy
+import itertools
+import json
+import random
+import time
+from collections import Counter
+from types import SimpleNamespace
+from typing import Any, Dict, List, Optional, Tuple
+
+from aiohttp import web
+from bson import ObjectId
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+_MISSING = object()
+
+
+# --- In-memory Mongo ---
+
+def _resolve(value: Any, parts: List[str]) -> List[Any]:
+    """Return every value reachable at ``parts``, fanning out over arrays."""
+    if not parts:
+        return [value]
+    head, rest = parts[0], parts[1:]
+    if isinstance(value, list):
+        if head.isdigit():
+            idx = int(head)
+            return _resolve(value[idx], rest) if idx < len(value) else []
+        out: List[Any] = []
+        for item in value:
+            out.extend(_resolve(item, parts))
+        return out
+    if isinstance(value, dict) and head in value:
+        return _resolve(value[head], rest)
+    return []
+
+
+def _compare(op: str, value: Any, arg: Any) -> bool:
+    try:
+        if op == "$lt":
+            return value < arg
+        if op == "$lte":
+            return value <= arg
+        if op == "$gt":
+            return value > arg
+        if op == "$gte":
+            return value >= arg
+    except TypeError:
+        return False
+    raise ValueError(f"Unsupported operator {op}")
+
+
+def _match_cond(values: List[Any], cond: Any) -> bool:
+    if isinstance(cond, dict) and cond and all(k.startswith("$") for k in cond):
+        for op, arg in cond.items():
+            if op == "$exists":
+                if bool(values) != bool(arg):
+                    return False
+            elif op == "$ne":
+                if _match_cond(values, arg):
+                    return False
+            elif op == "$in":
+                if not any(_match_cond(values, a) for a in arg):
+                    return False
+            elif op == "$type":
+                types = {"string": str, "date": object}
+                if not any(isinstance(v, types[arg]) for v in values):
+                    return False
+            else:
+                flat = [v for v in values if v is not None]
+                if not any(_compare(op, v, arg) for v in flat):
+                    return False
+        return True
+    if cond is None:
+        return not values or any(v is None for v in values)
+    return any(v == cond or (isinstance(v, list) and cond in v) for v in values)
+
+
+def matches(doc: Dict[str, Any], filt: Optional[Dict[str, Any]]) -> bool:
+    for key, cond in (filt or {}).items():
+        if key == "$or":
+            if not any(matches(doc, f) for f in cond):
+                return False
+        elif key == "$and":
+            if not all(matches(doc, f) for f in cond):
+                return False
+        elif not _match_cond(_resolve(doc, key.split(".")), cond):
+            return False
+    return True
+
+
+def _eval(expr: Any, doc: Dict[str, Any], this: Any = _MISSING) -> Any:
+    if isinstance(expr, str) and expr.startswith("$$this"):
+        path = expr[len("$$this."):].split(".") if expr != "$$this" else []
+        values = _resolve(this, path)
+        return values[0] if values else None
+    if isinstance(expr, str) and expr.startswith("$"):
+        values = _resolve(doc, expr[1:].split("."))
+        return values[0] if len(values) == 1 else (values or None)
+    if isinstance(expr, dict) and len(expr) == 1:
+        op, args = next(iter(expr.items()))
+        if op == "$ifNull":
+            first = _eval(args[0], doc, this)
+            return first if first is not None else _eval(args[1], doc, this)
+        if op == "$eq":
+            return _eval(args[0], doc, this) == _eval(args[1], doc, this)
+        if op == "$filter":
+            items = _eval(args["input"], doc, this) or []
+            return [i for i in items if _eval(args["cond"], doc, i)]
+        if op == "$map":
+            items = _eval(args["input"], doc, this) or []
+            return [_eval(args["in"], doc, i) for i in items]
+    return expr
+
+
+def _project(doc: Dict[str, Any], projection: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    if not projection:
+        return copy.deepcopy(doc)
+    include = {k: v for k, v in projection.items() if k != "_id" and (isinstance(v, dict) or v)}
+    if include:
+        out = {}
+        if projection.get("_id", 1) and "_id" in doc:
+            out["_id"] = doc["_id"]
+        for key, spec in include.items():
+            if isinstance(spec, dict):
+                out[key] = copy.deepcopy(_eval(spec, doc))
+            elif key in doc:
+                out[key] = copy.deepcopy(doc[key])
+        return out
+    out = copy.deepcopy(doc)
+    for key, spec in projection.items():
+        if not spec:
+            out.pop(key, None)
+    return out
+
+
+def _positional_index(doc: Dict[str, Any], filt: Dict[str, Any], array: str) -> Optional[int]:
+    prefix = array + "."
+    sub = {k[len(prefix):]: v for k, v in filt.items() if k.startswith(prefix)}
+    for idx, item in enumerate(doc.get(array) or []):
+        if isinstance(item, dict) and matches(item, sub):
+            return idx
+    return None
+
+
+def _targets(doc, path, filt, array_filters) -> List[Tuple[Any, Any]]:
+    """Resolve an update path to (container, key) pairs, creating parents."""
+    parts = path.split(".")
+    containers = [doc]
+    for i, part in enumerate(parts[:-1]):
+        nxt = []
+        for c in containers:
+            if part == "$":
+                idx = _positional_index(doc, filt, parts[i - 1])
+                if idx is not None:
+                    nxt.append(c[idx])
+            elif part.startswith("$[") and part.endswith("]"):
+                ident = part[2:-1]
+                conds = {}
+                for af in array_filters or []:
+                    for k, v in af.items():
+                        name, _, rest = k.partition(".")
+                        if name == ident:
+                            conds[rest] = v
+                nxt.extend(item for item in c if matches(item, conds))
+            elif isinstance(c, list):
+                nxt.append(c[int(part)])
+            else:
+                nxt.append(c.setdefault(part, {}))
+        containers = nxt
+    return [(c, parts[-1]) for c in containers]
+
+
+def apply_update(doc, update, filt=None, array_filters=None, inserting=False) -> None:
+    if isinstance(update, list):
+        return  # aggregation-pipeline updates are only used by one-off migrations
+    for op, fields in update.items():
+        if op == "$setOnInsert" and not inserting:
+            continue
+        for path, value in fields.items():
+            for container, key in _targets(doc, path, filt or {}, array_filters):
+                if op in ("$set", "$setOnInsert"):
+                    container[key] = copy.deepcopy(value)
+                elif op == "$unset":
+                    container.pop(key, None)
+                elif op == "$inc":
+                    container[key] = container.get(key, 0) + value
+                elif op == "$push":
+                    items = value["$each"] if isinstance(value, dict) and "$each" in value else [value]
+                    container.setdefault(key, []).extend(copy.deepcopy(items))
+                else:
+                    raise ValueError(f"Unsupported update operator {op}")
+
+
+class FakeCursor:
+    def __init__(self, collection: "FakeCollection", filt, projection) -> None:
+        self._collection = collection
+        self._filter = filt
+        self._projection = projection
+        self._sort: List[Tuple[str, int]] = []
+        self._limit = 0
+
+    def sort(self, key, direction=1) -> "FakeCursor":
+        self._sort = key if isinstance(key, list) else [(key, direction)]
+        return self
+
+    def limit(self, n: int) -> "FakeCursor":
+        self._limit = n
+        return self
+
+    def batch_size(self, n: int) -> "FakeCursor":
+        return self
+
+    def _results(self) -> List[Dict[str, Any]]:
+        docs = [d for d in self._collection.docs if matches(d, self._filter)]
+        for key, direction in reversed(self._sort):
+            docs.sort(key=lambda d: (_resolve(d, key.split(".")) or [None])[0] or 0,
+                      reverse=direction < 0)
+        if self._limit:
+            docs = docs[: self._limit]
+        return [_project(d, self._projection) for d in docs]
+
+    def __aiter__(self):
+        self._collection._count("find")
+        self._iter = iter(self._results())
+        return self
+
+    async def __anext__(self):
+        try:
+            return next(self._iter)
+        except StopIteration:
+            raise StopAsyncIteration
+
+    async def to_list(self, length=None):
+        self._collection._count("find")
+        return self._results()[:length] if length else self._results()
+
+
+class _EmptyAsyncIter:
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        raise StopAsyncIteration
+
+
+class FakeCollection:
+    def __init__(self, name: str, counter: Counter) -> None:
+        self.name = name
+        self.docs: List[Dict[str, Any]] = []
+        self.indexes: Dict[str, Any] = {"_id_": {"key": [("_id", 1)]}}
+        self._counter = counter
+
+    def _count(self, op: str) -> None:
+        self._counter[f"mongo.{self.name}.{op}"] += 1
+
+    def _insert(self, doc: Dict[str, Any]) -> Any:
+        for name, index in self.indexes.items():
+            partial = index.get("partialFilterExpression")
+            if not index.get("unique") or (partial and not matches(doc, partial)):
+                continue
+            fields = [k if isinstance(k, str) else k[0] for k in index["key"]]
+            key = [_resolve(doc, f.split(".")) for f in fields]
+            if any(key == [_resolve(d, f.split(".")) for f in fields] for d in self.docs):
+                raise DuplicateKeyError(f"E11000 duplicate key on {self.name}.{name}")
+        doc.setdefault("_id", ObjectId())
+        self.docs.append(copy.deepcopy(doc))
+        return doc["_id"]
+
+    def _upsert_doc(self, filt, update, array_filters) -> Dict[str, Any]:
+        doc = {k: copy.deepcopy(v) for k, v in filt.items()
+               if not k.startswith("$") and "." not in k
+               and not (isinstance(v, dict) and any(o.startswith("$") for o in v))}
+        apply_update(doc, update, filt, array_filters, inserting=True)
+        doc["_id"] = ObjectId()
+        self._insert(doc)
+        return doc
+
+    def _update(self, filt, update, upsert=False, array_filters=None, many=False):
+        matched = [d for d in self.docs if matches(d, filt)]
+        if not many:
+            matched = matched[:1]
+        for doc in matched:
+            apply_update(doc, update, filt, array_filters)
+        upserted = None
+        if not matched and upsert:
+            upserted = self._upsert_doc(filt, update, array_filters)["_id"]
+        return SimpleNamespace(matched_count=len(matched), modified_count=len(matched),
+                               upserted_id=upserted)
+
+    async def insert_one(self, doc):
+        self._count("insert_one")
+        return SimpleNamespace(inserted_id=self._insert(doc))
+
+    async def insert_many(self, docs, ordered=True):
+        self._count("insert_many")
+        return SimpleNamespace(inserted_ids=[self._insert(d) for d in docs])
+
+    async def delete_one(self, filt):
+        self._count("delete_one")
+        for i, doc in enumerate(self.docs):
+            if matches(doc, filt):
+                del self.docs[i]
+                return SimpleNamespace(deleted_count=1)
+        return SimpleNamespace(deleted_count=0)
+
+    async def find_one(self, filt=None, projection=None, sort=None):
+        self._count("find_one")
+        docs = self.docs
+        if sort:
+            docs = FakeCursor(self, filt, None).sort(sort)._results()
+        for doc in docs:
+            if matches(doc, filt):
+                return _project(doc, projection)
+        return None
+
+    def find(self, filt=None, projection=None, **kwargs) -> FakeCursor:
+        return FakeCursor(self, filt, projection)
+
+    async def update_one(self, filt, update, upsert=False, array_filters=None):
+        self._count("update_one")
+        return self._update(filt, update, upsert, array_filters)
+
+    async def update_many(self, filt, update, upsert=False, array_filters=None):
+        self._count("update_many")
+        return self._update(filt, update, upsert, array_filters, many=True)
+
+    async def replace_one(self, filt, replacement, upsert=False):
+        self._count("replace_one")
+        for i, doc in enumerate(self.docs):
+            if matches(doc, filt):
+                self.docs[i] = {"_id": doc["_id"], **copy.deepcopy(replacement)}
+                return SimpleNamespace(matched_count=1, modified_count=1, upserted_id=None)
+        if upsert:
+            return SimpleNamespace(matched_count=0, modified_count=0,
+                                   upserted_id=self._insert(dict(replacement)))
+        return SimpleNamespace(matched_count=0, modified_count=0, upserted_id=None)
+
+    async def find_one_and_update(self, filt, update, projection=None, upsert=False,
+                                  return_document=ReturnDocument.BEFORE, array_filters=None):
+        self._count("find_one_and_update")
+        for doc in self.docs:
+            if matches(doc, filt):
+                before = _project(doc, projection)
+                apply_update(doc, update, filt, array_filters)
+                return _project(doc, projection) if return_document else before
+        if upsert:
+            doc = self._upsert_doc(filt, update, array_filters)
+            return _project(doc, projection) if return_document else None
+        return None
+
+    async def bulk_write(self, requests, ordered=True):
+        self._count("bulk_write")
+        modified = 0
+        for req in requests:
+            res = self._update(req._filter, req._doc, req._upsert, req._array_filters)
+            modified += res.modified_count
+        return SimpleNamespace(modified_count=modified)
+
+    async def count_documents(self, filt):
+        self._count("count_documents")
+        return sum(1 for d in self.docs if matches(d, filt))
+
+    async def create_indexes(self, models):
+        self._count("create_indexes")
+        for model in models:
+            self.indexes[model.document["name"]] = dict(model.document)
+        return [m.document["name"] for m in models]
+
+    async def create_index(self, keys, **kwargs):
+        name = kwargs.get("name") or "_".join(f"{k}_{d}" for k, d in keys)
+        self.indexes[name] = {"key": keys, **kwargs}
+        return name
+
+    async def index_information(self):
+        return dict(self.indexes)
+
+    def aggregate(self, pipeline):
+        return _EmptyAsyncIter()
+
+
+class FakeDatabase:
+    """Attribute/item access to lazily created ``FakeCollection`` objects."""
+
+    def __init__(self, counter: Optional[Counter] = None) -> None:
+        self.counter = counter if counter is not None else Counter()
+        self._collections: Dict[str, FakeCollection] = {}
+
+    def __getitem__(self, name: str) -> FakeCollection:
+        if name not in self._collections:
+            self._collections[name] = FakeCollection(name, self.counter)
+        return self._collections[name]
+
+    def __getattr__(self, name: str) -> FakeCollection:
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return self[name]
+
+    async def command(self, name: str, *args, **kwargs):
+        self.counter[f"mongo.command.{name}"] += 1
+        return {"ok": 1.0}
+
+
+# --- Fake HTTP services ---
+
+class FakeServices:
+    """OpenAI, Twilio and Razorpay impersonated by one local aiohttp server."""
+
+    def __init__(
+        self,
+        counter: Optional[Counter] = None,
+        openai_latency: float = 0.0,
+        link_ratio: float = 0.0,
+        reply: str = "Thanks for reaching out to Metabolix! How can I help?",
+    ) -> None:
+        self.counter = counter if counter is not None else Counter()
+        self.openai_latency = openai_latency
+        self.link_ratio = link_ratio
+        self.reply = reply
+        self.base_url = ""
+        self._runner: Optional[web.AppRunner] = None
+        self._ids = itertools.count(1)
+
+    async def _chat_completion(self, request: web.Request) -> web.StreamResponse:
+        self.counter["openai.chat.completions"] += 1
+        payload = await request.json()
+        if self.openai_latency:
+            await asyncio.sleep(self.openai_latency)
+        content = self.reply
+        if random.random() < self.link_ratio:
+            content += " Book your consult here: <PAYMENT_LINK>"
+        prompt_tokens = sum(len(str(m.get("content", ""))) // 4 for m in payload["messages"])
+        if payload.get("stream"):
+            return await self._stream_completion(request, payload, content, prompt_tokens)
+        return web.json_response({
+            "id": f"chatcmpl-{next(self._ids)}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": payload.get("model", "gpt-3.5-turbo"),
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": content},
+                "finish_reason": "stop",
+            }],
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": len(content) // 4,
+                "total_tokens": prompt_tokens + len(content) // 4,
+            },
+        })
+
+    async def _stream_completion(
+        self, request: web.Request, payload: Dict[str, Any], content: str, prompt_tokens: int
+    ) -> web.StreamResponse:
+        resp = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await resp.prepare(request)
+        base = {
+            "id": f"chatcmpl-{next(self._ids)}",
+            "object": "chat.completion.chunk",
+            "created": int(time.time()),
+            "model": payload.get("model", "gpt-3.5-turbo"),
+        }
+        words = content.split(" ")
+        for i, word in enumerate(words):
+            delta = word if i == len(words) - 1 else word + " "
+            chunk = {**base, "choices": [{"index": 0, "delta": {"content": delta}, "finish_reason": None}]}
+            await resp.write(f"data: {json.dumps(chunk)}\n\n".encode())
+        usage = {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": len(content) // 4,
+            "total_tokens": prompt_tokens + len(content) // 4,
+        }
+        await resp.write(f"data: {json.dumps({**base, 'choices': [], 'usage': usage})}\n\n".encode())
+        await resp.write(b"data: [DONE]\n\n")
+        await resp.write_eof()
+        return resp
+
+    async def _twilio_message(self, request: web.Request) -> web.Response:
+        self.counter["twilio.messages"] += 1
+        await request.post()
+        return web.json_response({"sid": f"SM{next(self._ids)}", "status": "queued"}, status=201)
+
+    async def _create_link(self, request: web.Request) -> web.Response:
+        self.counter["razorpay.payment_links.create"] += 1
+        await request.json()
+        link_id = f"plink_{next(self._ids)}"
+        return web.json_response({"id": link_id, "short_url": f"https://rzp.io/i/{link_id}"})
+
+    async def _fetch_link(self, request: web.Request) -> web.Response:
+        self.counter["razorpay.payment_links.fetch"] += 1
+        return web.json_response({"id": request.match_info["link_id"], "status": "created"})
+
+    async def start(self) -> str:
+        app = web.Application()
+        app.router.add_post("/v1/chat/completions", self._chat_completion)
+        app.router.add_post("/2010-04-01/Accounts/{sid}/Messages.json", self._twilio_message)
+        app.router.add_post("/v1/payment_links", self._create_link)
+        app.router.add_get("/v1/payment_links/{link_id}", self._fetch_link)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.base_url = f"http://127.0.0.1:{port}"
+        return self.base_url
+
+    async def stop(self) -> None:
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+
+def dependency_counts(counter: Counter) -> Dict[str, int]:
+    """Collapse detailed counters into one total per dependency."""
+    totals: Dict[str, int] = {}
+    for key, value in counter.items():
+        dep = key.split(".", 1)[0]
+        totals[dep] = totals.get(dep, 0) + value
+    return totals
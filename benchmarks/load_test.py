@@ -0,0 +1,268 @@
+"""End-to-end load test for the Metabolix API against local fakes.
+
+Boots ``main.app`` under uvicorn with every external dependency replaced by
+a local stand-in (see ``benchmarks/fakes.py``; Redis uses ``fakeredis`` when
+installed and the in-process session tier otherwise), drives ``/whatsapp``,
+``/consult``, ``/order`` and ``/payment-webhook`` at the requested
+concurrency and reports latency percentiles, throughput and per-dependency
+call counts.
+
+    python benchmarks/load_test.py --requests 1000 --concurrency 50 --openai-latency 0.3
+
+Pass ``--max-p95`` to exit non-zero when any endpoint's p95 latency exceeds
+the budget, so the run can gate CI.
+"""
+
+import argparse
+import asyncio
+import contextlib
+import hashlib
+import hmac
+import importlib
+import json
+import logging
+import os
+import sys
+import time
+from collections import Counter
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Tuple
+
+import aiohttp
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("OPENAI_API_KEY", "sk-load-test")
+
+from benchmarks.fakes import FakeDatabase, FakeServices, dependency_counts  # noqa: E402
+
+ENDPOINTS = ("whatsapp", "consult", "order", "payment-webhook")
+WEBHOOK_SECRET = "load-test-secret"
+
+try:
+    import fakeredis.aioredis as fake_aioredis
+except ImportError:  # pragma: no cover - optional dev dependency
+    fake_aioredis = None
+
+
+def percentile(values: Sequence[float], pct: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(pct * len(ordered)))]
+
+
+@contextlib.contextmanager
+def _patched(overrides: List[Tuple[Any, str, Any]]) -> Iterator[None]:
+    saved = [(obj, name, getattr(obj, name)) for obj, name, _ in overrides]
+    for obj, name, value in overrides:
+        setattr(obj, name, value)
+    try:
+        yield
+    finally:
+        for obj, name, value in reversed(saved):
+            setattr(obj, name, value)
+
+
+def _app_overrides(base_url: str, fake_db: FakeDatabase, redis: Any) -> List[Tuple[Any, str, Any]]:
+    """Point every client the app holds at the local fakes."""
+    import chat_engine
+    import db
+    import razorpay_utils
+    import session_store
+    import utils
+    from openai import AsyncOpenAI
+
+    return [
+        (chat_engine, "client", AsyncOpenAI(api_key="sk-load-test", base_url=f"{base_url}/v1")),
+        (db, "db", fake_db),
+        (session_store, "_redis", redis),
+        (utils, "TWILIO_ACCOUNT_SID", "AC-load-test"),
+        (utils, "TWILIO_AUTH_TOKEN", "token"),
+        (utils, "TWILIO_WHATSAPP_NUMBER", "14155238886"),
+        (utils, "TWILIO_API_BASE", base_url),
+        (razorpay_utils, "RAZORPAY_API_BASE", f"{base_url}/v1"),
+        (razorpay_utils, "RAZORPAY_KEY_ID", "rzp_test"),
+        (razorpay_utils, "RAZORPAY_KEY_SECRET", "secret"),
+    ]
+
+
+def _user(i: int) -> Dict[str, Any]:
+    return {"name": f"User {i}", "age": 35, "gender": "F", "location": "Delhi",
+            "phone": f"+9190000{i:05d}"}
+
+
+def _build_request(endpoint: str, i: int, phones: int) -> Tuple[str, Dict[str, Any]]:
+    user = _user(i % phones)
+    if endpoint == "whatsapp":
+        # A plain price question would be answered from the catalog and a short
+        # opener from the response cache; ask something that needs the model
+        body = "I want to lose 10 kg, which plan suits me?"
+        form = {"From": f"whatsapp:{user['phone']}", "Body": body, "NumMedia": "0"}
+        return "/whatsapp", {"data": form}
+    if endpoint == "consult":
+        body = {"user": user, "symptoms": {"description": "weight gain"}}
+        return "/consult", {"json": body}
+    if endpoint == "order":
+        return "/order", {"json": {"user": user, "product": "GLP-1 Weight Loss Plan"}}
+    payload = {
+        "event": "payment.captured",
+        "payload": {"payment": {"entity": {
+            "id": f"pay_{i}", "amount": 9900, "status": "captured", "contact": user["phone"],
+        }}},
+    }
+    raw = json.dumps(payload).encode()
+    signature = hmac.new(WEBHOOK_SECRET.encode(), raw, hashlib.sha256).hexdigest()
+    headers = {"X-Razorpay-Signature": signature, "Content-Type": "application/json"}
+    return "/payment-webhook", {"data": raw, "headers": headers}
+
+
+async def _drive(base_url: str, endpoints: Sequence[str], requests: int, concurrency: int,
+                 phones: int) -> Tuple[Dict[str, List[float]], Counter, float]:
+    latencies: Dict[str, List[float]] = {e: [] for e in endpoints}
+    errors: Counter = Counter()
+    queue: "asyncio.Queue[int]" = asyncio.Queue()
+    for i in range(requests):
+        queue.put_nowait(i)
+
+    async with aiohttp.ClientSession() as session:
+        async def worker() -> None:
+            while not queue.empty():
+                i = queue.get_nowait()
+                endpoint = endpoints[i % len(endpoints)]
+                path, kwargs = _build_request(endpoint, i, phones)
+                start = time.perf_counter()
+                try:
+                    async with session.post(f"{base_url}{path}", **kwargs) as resp:
+                        await resp.read()
+                        if resp.status >= 400:
+                            errors[endpoint] += 1
+                except aiohttp.ClientError:
+                    errors[endpoint] += 1
+                latencies[endpoint].append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        elapsed = time.perf_counter() - start
+    return latencies, errors, elapsed
+
+
+async def run_load_test(
+    requests: int = 200,
+    concurrency: int = 20,
+    openai_latency: float = 0.05,
+    link_ratio: float = 0.1,
+    endpoints: Sequence[str] = ENDPOINTS,
+    phones: Optional[int] = None,
+) -> Dict[str, Any]:
+    """Run one load test and return the report as a dict."""
+    import uvicorn
+
+    import http_client
+
+    counter: Counter = Counter()
+    services = FakeServices(counter, openai_latency=openai_latency, link_ratio=link_ratio)
+    base_url = await services.start()
+    redis = fake_aioredis.FakeRedis(decode_responses=True) if fake_aioredis else None
+    previous_secret = os.environ.get("RAZORPAY_WEBHOOK_SECRET")
+    os.environ["RAZORPAY_WEBHOOK_SECRET"] = WEBHOOK_SECRET
+    try:
+        with _patched(_app_overrides(base_url, FakeDatabase(counter), redis)):
+            from main import app
+
+            config = uvicorn.Config(app, host="127.0.0.1", port=0, log_level="warning")
+            server = uvicorn.Server(config)
+            serve_task = asyncio.create_task(server.serve())
+            while not server.started:
+                await asyncio.sleep(0.01)
+            port = server.servers[0].sockets[0].getsockname()[1]
+            try:
+                latencies, errors, elapsed = await _drive(
+                    f"http://127.0.0.1:{port}", list(endpoints), requests, concurrency,
+                    phones or max(1, requests // 4),
+                )
+            finally:
+                server.should_exit = True
+                await serve_task
+                await http_client.close_http()
+    finally:
+        await services.stop()
+        if previous_secret is None:
+            os.environ.pop("RAZORPAY_WEBHOOK_SECRET", None)
+        else:
+            os.environ["RAZORPAY_WEBHOOK_SECRET"] = previous_secret
+
+    report: Dict[str, Any] = {
+        "requests": requests,
+        "concurrency": concurrency,
+        "elapsed": elapsed,
+        "rps": requests / elapsed if elapsed else 0.0,
+        "endpoints": {},
+        "dependencies": dependency_counts(counter),
+        "calls": dict(sorted(counter.items())),
+    }
+    for endpoint, values in latencies.items():
+        report["endpoints"][endpoint] = {
+            "count": len(values),
+            "errors": errors[endpoint],
+            "p50": percentile(values, 0.50),
+            "p95": percentile(values, 0.95),
+            "p99": percentile(values, 0.99),
+        }
+    return report
+
+
+def format_report(report: Dict[str, Any]) -> str:
+    lines = [
+        f"{report['requests']} requests, concurrency {report['concurrency']}: "
+        f"{report['rps']:.1f} req/s over {report['elapsed']:.2f}s",
+        "",
+        f"{'endpoint':<16}{'count':>7}{'errors':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}",
+    ]
+    for name, stats in report["endpoints"].items():
+        lines.append(
+            f"{name:<16}{stats['count']:>7}{stats['errors']:>8}"
+            f"{stats['p50'] * 1000:>10.1f}{stats['p95'] * 1000:>10.1f}{stats['p99'] * 1000:>10.1f}"
+        )
+    lines += ["", "dependency calls:"]
+    lines += [f"  {name:<44}{count:>8}" for name, count in report["calls"].items()]
+    return "\n".join(lines)
+
+
+def main(argv: Optional[Sequence[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--openai-latency", type=float, default=0.05,
+                        help="seconds the fake OpenAI server waits per completion")
+    parser.add_argument("--link-ratio", type=float, default=0.1,
+                        help="fraction of completions that ask for a payment link")
+    parser.add_argument("--endpoints", default=",".join(ENDPOINTS))
+    parser.add_argument("--json", dest="json_path", help="also write the report to this file")
+    parser.add_argument("--max-p95", type=float, help="fail if any endpoint p95 exceeds this (s)")
+    parser.add_argument("--log-level", default="WARNING")
+    args = parser.parse_args(argv)
+
+    importlib.import_module("main")  # configures logging on import
+
+    logging.getLogger().setLevel(args.log_level.upper())
+    logging.getLogger("aiohttp.access").setLevel(args.log_level.upper())
+
+    report = asyncio.run(run_load_test(
+        requests=args.requests,
+        concurrency=args.concurrency,
+        openai_latency=args.openai_latency,
+        link_ratio=args.link_ratio,
+        endpoints=[e for e in args.endpoints.split(",") if e],
+    ))
+    print(format_report(report))
+    if args.json_path:
+        with open(args.json_path, "w") as fh:
+            json.dump(report, fh, indent=2)
+
+    failed = any(s["errors"] for s in report["endpoints"].values())
+    if args.max_p95 is not None:
+        failed |= any(s["p95"] > args.max_p95 for s in report["endpoints"].values())
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
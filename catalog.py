@@ -0,0 +1,227 @@
+"""Product catalog, pricing rules and a fast path for plain price questions.
+
+Prices live here instead of in the system prompt. ``quote`` applies the
+discount rules: the advertised sale price when there is one, otherwise
+``OPENING_DISCOUNT`` off MRP, and never below the product's floor price.
+``answer_catalog_question`` answers short price/frequency questions about a
+single product without an LLM call, and ``catalog_prompt`` renders only the
+entries relevant to a conversation for the system prompt.
+"""
+
+import os
+import re
+from dataclasses import dataclass, field
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from metrics import counter
+
+OPENING_DISCOUNT = float(os.getenv("OPENING_DISCOUNT", "0.05"))
+# Longer messages carry more than a price question and go to the LLM
+FAST_PATH_MAX_WORDS = int(os.getenv("CATALOG_FAST_PATH_MAX_WORDS", "12"))
+
+CATALOG_ANSWERS = counter(
+    "metabolix_catalog_answers_total", "WhatsApp questions answered from the catalog without an LLM call."
+)
+
+DISCLAIMER = "_This is not medical advice. Always consult a licensed doctor for personal health concerns._"
+CONSULT_URL = "https://www.mymetabolix.com/products/doctor-consult"
+
+
+@dataclass(frozen=True)
+class Product:
+    key: str
+    name: str
+    family: str
+    mrp: int
+    sale: Optional[int] = None
+    floor: Optional[int] = None
+    delivery: int = 0
+    dose: Optional[str] = None
+    frequency: Optional[str] = None
+    prescription: bool = False
+    notes: Tuple[str, ...] = field(default_factory=tuple)
+
+    @property
+    def opening(self) -> int:
+        """Price quoted before any negotiation."""
+        if self.sale is not None:
+            return self.sale
+        return round(self.mrp * (1 - OPENING_DISCOUNT))
+
+    @property
+    def minimum(self) -> int:
+        """Lowest price that may ever be offered."""
+        return self.floor if self.floor is not None else self.opening
+
+
+@dataclass(frozen=True)
+class Quote:
+    product: Product
+    quantity: int
+    unit_price: int
+    delivery: int
+
+    @property
+    def total(self) -> int:
+        return self.unit_price * self.quantity + self.delivery
+
+
+PRODUCTS: Tuple[Product, ...] = (
+    Product(
+        "glp1-plan", "GLP-1 Weight Loss Plan (3 Months)", "plan", mrp=51000, sale=47000,
+        notes=(
+            "12 once-weekly injections",
+            "Free cold-chain home delivery",
+            "Personalized diet + exercise plans",
+            "WhatsApp care support",
+        ),
+    ),
+    Product("cgm", "CGM add-on", "cgm", mrp=5249),
+    Product(
+        "doctor-consult", "Doctor Consult for GLP-1 Therapy", "consult", mrp=999, sale=499,
+        notes=("Required before any medication purchase", f"Book here: {CONSULT_URL}"),
+    ),
+    Product("diet-plan", "GLP-1 Diet Plan (Veg/Non-Veg)", "diet", mrp=399, sale=199),
+    Product("rybelsus-3", "Rybelsus Semaglutide 3mg", "rybelsus", mrp=3170, sale=2536,
+            delivery=399, dose="3mg", frequency="taken as a tablet once daily", prescription=True),
+    Product("rybelsus-7", "Rybelsus Semaglutide 7mg", "rybelsus", mrp=3520, sale=2816,
+            delivery=399, dose="7mg", frequency="taken as a tablet once daily", prescription=True),
+    Product("rybelsus-14", "Rybelsus Semaglutide 14mg", "rybelsus", mrp=3870, sale=3096,
+            delivery=399, dose="14mg", frequency="taken as a tablet once daily", prescription=True),
+    Product("mounjaro-2.5", "Mounjaro Tirzepatide 2.5mg", "mounjaro", mrp=3500, sale=2800,
+            delivery=2500, dose="2.5mg", frequency="given as an injection once weekly",
+            prescription=True),
+    Product("mounjaro-5", "Mounjaro Tirzepatide 5mg", "mounjaro", mrp=4375, sale=3500,
+            delivery=2500, dose="5mg", frequency="given as an injection once weekly",
+            prescription=True),
+)
+
+PRODUCTS_BY_KEY: Dict[str, Product] = {p.key: p for p in PRODUCTS}
+
+# Words that identify a product family in a user message
+FAMILY_ALIASES: Dict[str, Tuple[str, ...]] = {
+    "mounjaro": ("mounjaro", "tirzepatide"),
+    "rybelsus": ("rybelsus", "semaglutide"),
+    "consult": ("consult", "consultation", "doctor"),
+    "diet": ("diet plan", "diet"),
+    "cgm": ("cgm", "glucose monitor"),
+    "plan": ("weight loss plan", "glp-1 plan", "glp1 plan", "3 month plan", "weight loss program"),
+}
+
+# Only unambiguous phrasings: "heart rate", "daily diet" or "how much weight"
+# are not price or frequency questions and must reach the model
+_PRICE_WORDS = re.compile(
+    r"\b(price|prices|pricing|cost|costs|charges?|fees?|mrp)\b|\bhow much (is|are|for)\b"
+)
+_FREQUENCY_WORDS = re.compile(
+    r"\b(how often|frequency|how many times|dosage schedule|daily or weekly|weekly or daily)\b"
+)
+_DOSE = re.compile(r"(\d+(?:\.\d+)?)\s*mg\b")
+
+
+def rupees(amount: int) -> str:
+    return f"₹{amount:,}"
+
+
+def quote(product: Product, quantity: int = 1, offered: Optional[int] = None) -> Quote:
+    """Price ``quantity`` units of ``product``.
+
+    Starts from the sale price, or ``OPENING_DISCOUNT`` off MRP when there is
+    none. A counter-offer (``offered``) is accepted down to the floor price.
+    """
+    price = product.opening
+    if offered is not None:
+        price = min(price, offered)
+    return Quote(product, quantity, max(price, product.minimum), product.delivery)
+
+
+def find_families(text: str) -> List[str]:
+    """Product families mentioned in ``text``, in catalog order."""
+    text = text.lower()
+    return [
+        family for family, aliases in FAMILY_ALIASES.items()
+        if any(re.search(rf"\b{re.escape(alias)}\b", text) for alias in aliases)
+    ]
+
+
+def products_for(families: Iterable[str], text: str = "") -> List[Product]:
+    """Catalog entries in ``families``, narrowed to a dose if ``text`` names one."""
+    families = set(families)
+    matches = [p for p in PRODUCTS if p.family in families]
+    doses = {f"{m}mg" for m in _DOSE.findall(text.lower())}
+    dosed = [p for p in matches if p.dose in doses]
+    return dosed or matches
+
+
+def _price_line(product: Product) -> str:
+    q = quote(product)
+    line = f"*{product.name}*: "
+    if q.unit_price < product.mrp:
+        line += f"~{rupees(product.mrp)}~ "
+    return line + f"*{rupees(q.unit_price)}*"
+
+
+def answer_catalog_question(text: str) -> Optional[str]:
+    """Answer a short price or frequency question about one product family.
+
+    Returns ``None`` when the message needs the LLM: no clear intent, several
+    product families, or a longer message.
+    """
+    if not text or len(text.split()) > FAST_PATH_MAX_WORDS:
+        return None
+    lowered = text.lower()
+    wants_price = bool(_PRICE_WORDS.search(lowered))
+    wants_frequency = bool(_FREQUENCY_WORDS.search(lowered))
+    families = find_families(lowered)
+    if len(families) != 1 or not (wants_price or wants_frequency):
+        return None
+    products = products_for(families, lowered)
+    lines: List[str] = []
+    if wants_price:
+        lines += [f"• {_price_line(p)}" for p in products]
+        delivery = {p.delivery for p in products}
+        if len(delivery) == 1 and products[0].delivery:
+            lines.append(f"• Delivery: *{rupees(products[0].delivery)}*")
+        for note in products[0].notes if len(products) == 1 else ():
+            lines.append(f"• {note}")
+    if wants_frequency:
+        frequency = products[0].frequency
+        if not frequency:
+            return None
+        name = products[0].name.split(" ")[0]
+        lines.append(f"• {name} is {frequency}.")
+    if any(p.prescription for p in products):
+        consult = quote(PRODUCTS_BY_KEY["doctor-consult"]).unit_price
+        lines.append(
+            f"• A doctor consult ({rupees(consult)}) is required before buying: {CONSULT_URL}"
+        )
+    lines += ["", "• Would you like to know more or get started?", "", DISCLAIMER]
+    CATALOG_ANSWERS.inc(family=families[0])
+    return "\n".join(lines)
+
+
+def catalog_prompt(text: str) -> str:
+    """Catalog entries for the system prompt.
+
+    Full entries for the product families mentioned in ``text``; otherwise a
+    one-line price list so the model can still point users to an offering.
+    """
+    families = find_families(text)
+    if not families:
+        return "\n".join(f"- {_price_line(p)}" for p in PRODUCTS)
+    products = products_for(families)
+    if any(p.prescription for p in products) and "consult" not in families:
+        products.append(PRODUCTS_BY_KEY["doctor-consult"])
+    lines = []
+    for product in products:
+        q = quote(product)
+        parts = [f"MRP {rupees(product.mrp)}", f"offer {rupees(q.unit_price)}"]
+        if product.minimum < q.unit_price:
+            parts.append(f"minimum {rupees(product.minimum)}")
+        if product.delivery:
+            parts.append(f"delivery {rupees(product.delivery)}")
+        if product.frequency:
+            parts.append(product.frequency)
+        parts += list(product.notes)
+        lines.append(f"- {product.name}: " + "; ".join(parts))
+    return "\n".join(lines)
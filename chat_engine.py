@@ -1,122 +1,480 @@
 """OpenAI GPT-4 integration for the Metabolix chatbot."""
 
+import asyncio
+import hashlib
 import logging
 import os
-from typing import Dict, List
+import random
+import re
+import time
+import unicodedata
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
 
+import openai
 from openai import AsyncOpenAI
 from dotenv import load_dotenv
 
+from catalog import PRODUCTS, catalog_prompt
+from metrics import counter, gauge, histogram, stats_gauge, timed
+from session_store import get_redis
+from utils import LRUCache, count_message_tokens
+
 load_dotenv()
-client = AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+# Created lazily by get_client() so importing this module needs no credentials
+client: Optional[AsyncOpenAI] = None
 logger = logging.getLogger(__name__)
 
+OPENAI_MODEL = os.getenv("OPENAI_MODEL", "gpt-3.5-turbo")
+OPENAI_MAX_IN_FLIGHT = int(os.getenv("OPENAI_MAX_IN_FLIGHT", "16"))
+OPENAI_TOKENS_PER_MINUTE = int(os.getenv("OPENAI_TOKENS_PER_MINUTE", "0"))  # 0 = unlimited
+OPENAI_MAX_RETRIES = int(os.getenv("OPENAI_MAX_RETRIES", "3"))
+OPENAI_TIMEOUT = float(os.getenv("OPENAI_TIMEOUT", "30"))
+# Total time for a completion including queueing, retries and backoff; the
+# WhatsApp turn waits slightly longer than this (see routes.REPLY_TIMEOUT)
+OPENAI_DEADLINE = float(os.getenv("OPENAI_DEADLINE", "55"))
+OPENAI_BACKOFF_BASE = float(os.getenv("OPENAI_BACKOFF_BASE", "0.5"))
+OPENAI_BACKOFF_MAX = float(os.getenv("OPENAI_BACKOFF_MAX", "20"))
+# Completion tokens reserved against the per-minute budget before a call
+_COMPLETION_ESTIMATE = 300
+
+OPENAI_TOKENS = counter("metabolix_openai_tokens_total", "OpenAI tokens used, by type.")
+OPENAI_QUEUE_WAIT = histogram(
+    "metabolix_openai_queue_wait_seconds",
+    "Time spent waiting for an OpenAI concurrency slot and token budget.",
+)
+OPENAI_RETRIES = counter("metabolix_openai_retries_total", "OpenAI retries, by reason.")
+OPENAI_FIRST_TOKEN = histogram(
+    "metabolix_openai_first_token_seconds",
+    "Time from opening a streamed completion to its first content token.",
+)
+
 PAYMENT_PLACEHOLDER = "<PAYMENT_LINK>"
 
-SYSTEM_PROMPT_TEMPLATE = f"""
-You are Metabolix, a multilingual WhatsApp chatbot for https://www.mymetabolix.com — a metabolic clinic offering medically guided weight-loss plans, doctor consultations, and GLP-1-based therapies.
-
-Your tasks:
-
-1. Greet the user warmly when they arrive via website or Meta ad.
-   - Ask for consent to chat and share health info.
-   - Share the website: https://www.mymetabolix.com
-
-2. If consent is given, collect basic details one at a time:
-   - *Name*
-   - *Age*
-   - *Gender*
-   - *City*
-   - *Height* and *Weight*
-
-3. Respond to questions about products or services:
-   - Keep replies short and clear, formatted for WhatsApp using:
-     - **bold** for highlights  
-     - ~~strikethrough~~ for original prices  
-     - *italic* for disclaimers  
-     - Bullets for lists and follow-up questions
-
-4. Provide info about these core offerings:
-   - **GLP-1 Weight Loss Plan (3 Months)**  
-     - ~~₹51,000~~ **₹47,000**  
-     - 12 once-weekly injections  
-     - Free cold-chain home delivery  
-     - Personalized diet + exercise plans  
-     - WhatsApp care support  
-     - *Optional CGM add-on: ₹5,249*
-
-   - **Doctor Consult for GLP-1 Therapy**  
-     - ~~₹999~~ **₹499**  
-     - Required before any medication purchase  
-     - Book here: https://www.mymetabolix.com/products/doctor-consult
-
-   - **GLP-1 Diet Plans (Veg/Non-Veg)**  
-     - ~~₹399~~ **₹199**
-
-5. If a user asks for medication (like Rybelsus or Mounjaro):
-   - Never share payment links directly  
-   - Always prompt them to first consult a doctor  
-   - If consult done, share plan or consult Razorpay link only  
-   - Mention **product price ranges**, but not confirm final price unless approved  
-
-6. Prices:
-   - **Rybelsus Semaglutide**:  
-     - 3mg: ~~₹3,170~~ **₹2,536**  
-     - 7mg: ~~₹3,520~~ **₹2,816**  
-     - 14mg: ~~₹3,870~~ **₹3,096**  
-     - Delivery: **₹399**
-
-   - **Mounjaro Tirzepatide**:
-     - 2.5mg: ~~₹3,500~~ **₹2,800**
-     - 5mg: ~~₹4,375~~ **₹3,500**
-     - Delivery: **₹2,500**
-
-   - *Frequency*: **Mounjaro injections are once weekly** while **Rybelsus tablets are taken daily**.
-
-7. Discount logic:
-   - Start with sale price if mentioned  
-   - If not, offer **5% off** initially from MRP  
-   - Max discount: up to minimum price only (never go below)  
-
-8. If user confirms order or appointment:
-   - Send them a payment link containing: {PAYMENT_PLACEHOLDER}  
-   - Notify admin with this format:
-     ```
-     📦 *New Order Alert*:
-     - Name: [User]
-     - Age/Gender: [ ]
-     - Plan: [ ]
-     - Paid: Yes/No
-     - Razorpay ID: [ ]
-     ```
-
-9. End every message with:
-   *This is not medical advice. Always consult a licensed doctor for personal health concerns.*
-
-10. Format all questions/follow-ups using bullets. Keep tone:
-   - Warm
-   - Human
-   - Helpful
-   - Short & clear
-   - Never robotic
-
-11. After each reply, invite the user to share more or ask any questions they have.
+# Prices are not written here: catalog_prompt() injects the entries relevant
+# to the conversation into {catalog} on every call.
+SYSTEM_PROMPT_TEMPLATE = """
+You are Metabolix, a multilingual WhatsApp chatbot for https://www.mymetabolix.com, a metabolic clinic offering medically guided weight-loss plans, doctor consultations and GLP-1 therapies. Reply in {language}.
+
+1. Greet new users warmly, ask for consent to chat and share health info, and share the website.
+2. Once consent is given, collect one at a time: *Name*, *Age*, *Gender*, *City*, *Height* and *Weight*.
+3. Keep replies short and clear for WhatsApp: *bold* for highlights, ~strikethrough~ for original prices, _italic_ for disclaimers, bullets for lists and follow-up questions.
+4. For medication (e.g. Rybelsus, Mounjaro) always ask the user to consult a doctor first and never share a medication payment link; mention prices but do not confirm a final price unless approved.
+5. Quote only the catalog prices below. Offer the listed offer price; never go below a listed minimum.
+6. When the user confirms an order or appointment, include {payment} in your reply for the payment link.
+7. End every message with: _This is not medical advice. Always consult a licensed doctor for personal health concerns._
+8. Be warm, human, helpful, short and clear, never robotic, and invite the user to share more or ask questions.
+
+Catalog:
+{catalog}
 """
 
 
-async def generate_response(messages: List[Dict[str, str]], language: str = "English") -> str:
-    """Call OpenAI's API and return the assistant's reply."""
-    system_prompt = SYSTEM_PROMPT_TEMPLATE.format(language=language)
-    chat_messages = [{"role": "system", "content": system_prompt}] + messages
-    try:
-        resp = await client.chat.completions.create(
-            model="gpt-3.5-turbo",
-            messages=chat_messages,
-            temperature=0.6,
-            timeout=1000,
+def get_client() -> AsyncOpenAI:
+    """Return the shared OpenAI client, creating it on first use."""
+    global client
+    if client is None:
+        # Retries are handled by generate_response so they respect the limiter
+        client = AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"), max_retries=0)
+    return client
+
+
+async def close_client() -> None:
+    """Close the OpenAI client's connection pool."""
+    global client
+    if client is not None:
+        await client.close()
+        client = None
+
+
+class _Limiter:
+    """Caps in-flight completions and spends a per-minute token budget."""
+
+    def __init__(self, max_in_flight: int, tokens_per_minute: int) -> None:
+        self.semaphore = asyncio.Semaphore(max_in_flight)
+        self.tokens_per_minute = tokens_per_minute
+        self.available = float(tokens_per_minute)
+        self.updated = time.monotonic()
+        self.loop = asyncio.get_running_loop()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.available = min(
+            float(self.tokens_per_minute),
+            self.available + (now - self.updated) * self.tokens_per_minute / 60,
         )
-        return resp.choices[0].message.content.strip()
+        self.updated = now
+
+    async def reserve(self, tokens: int) -> None:
+        if not self.tokens_per_minute:
+            return
+        tokens = min(tokens, self.tokens_per_minute)
+        while True:
+            self._refill()
+            if self.available >= tokens:
+                self.available -= tokens
+                return
+            await asyncio.sleep((tokens - self.available) * 60 / self.tokens_per_minute)
+
+    def settle(self, reserved: int, used: int) -> None:
+        """Correct the budget once actual usage is known."""
+        if self.tokens_per_minute:
+            self.available -= used - reserved
+
+
+_limiter: Optional[_Limiter] = None
+
+
+def _get_limiter() -> _Limiter:
+    global _limiter
+    if _limiter is None or _limiter.loop is not asyncio.get_running_loop():
+        _limiter = _Limiter(OPENAI_MAX_IN_FLIGHT, OPENAI_TOKENS_PER_MINUTE)
+    return _limiter
+
+
+def _estimate_tokens(messages: List[Dict[str, str]]) -> int:
+    return count_message_tokens(messages) + _COMPLETION_ESTIMATE
+
+
+def _retry_reason(exc: Exception) -> Optional[str]:
+    """Return a label if ``exc`` is worth retrying, else ``None``."""
+    if isinstance(exc, openai.APITimeoutError):
+        return "timeout"
+    if isinstance(exc, openai.APIConnectionError):
+        return "connection"
+    if isinstance(exc, openai.APIStatusError):
+        if exc.status_code == 429:
+            return "rate_limit"
+        if exc.status_code >= 500:
+            return "server_error"
+    return None
+
+
+def _retry_after(exc: Exception) -> Optional[float]:
+    response = getattr(exc, "response", None)
+    if response is None:
+        return None
+    headers = response.headers
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000
+        if headers.get("retry-after"):
+            return float(headers["retry-after"])
+    except ValueError:
+        return None
+    return None
+
+
+def _backoff(attempt: int, exc: Exception) -> float:
+    delay = random.uniform(0, min(OPENAI_BACKOFF_MAX, OPENAI_BACKOFF_BASE * 2 ** attempt))
+    retry_after = _retry_after(exc)
+    if retry_after is not None:
+        delay = max(delay, min(retry_after, OPENAI_BACKOFF_MAX))
+    return delay
+
+
+class _Call:
+    """An open completion; ``used`` is settled against the budget on release."""
+
+    def __init__(self, response: Any, estimate: int) -> None:
+        self.response = response
+        self.used = estimate
+
+
+@asynccontextmanager
+async def _completion(
+    chat_messages: List[Dict[str, str]], **params: Any
+) -> AsyncIterator[_Call]:
+    """Create a completion under the shared limiter, retrying 429/5xx/timeouts.
+
+    The limiter slot is held until the ``async with`` block exits, so a
+    streamed reply counts against ``OPENAI_MAX_IN_FLIGHT`` until it finishes;
+    ``call.used`` (the estimate unless the block updates it) is settled
+    against the token budget then. Attempts and backoff together stay within
+    ``OPENAI_DEADLINE``: each attempt's timeout is cut to the time left, and no
+    retry is started that could not finish in time.
+    """
+    params = {"model": OPENAI_MODEL, "temperature": 0.6, **params}
+    limiter = _get_limiter()
+    estimate = _estimate_tokens(chat_messages)
+    deadline = time.monotonic() + OPENAI_DEADLINE
+    attempt = 0
+    while True:
+        start = time.perf_counter()
+        async with limiter.semaphore:
+            await limiter.reserve(estimate)
+            OPENAI_QUEUE_WAIT.observe(time.perf_counter() - start)
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                limiter.settle(estimate, 0)
+                raise asyncio.TimeoutError("OpenAI deadline exceeded while queued")
+            try:
+                with timed("openai.chat_completion"):
+                    resp = await get_client().chat.completions.create(
+                        messages=chat_messages, timeout=min(OPENAI_TIMEOUT, remaining), **params
+                    )
+            except Exception as exc:
+                reason = _retry_reason(exc)
+                if reason is None or attempt >= OPENAI_MAX_RETRIES:
+                    raise
+                delay = _backoff(attempt, exc)
+                if time.monotonic() + delay >= deadline:
+                    raise
+            else:
+                call = _Call(resp, estimate)
+                try:
+                    yield call
+                finally:
+                    limiter.settle(estimate, call.used)
+                return
+        # Back off outside the semaphore so waiting retries don't hold a slot
+        OPENAI_RETRIES.inc(reason=reason)
+        logger.warning("OpenAI %s, retrying in %.2fs (attempt %s)", reason, delay, attempt + 1)
+        await asyncio.sleep(delay)
+        attempt += 1
+
+
+async def _create_completion(chat_messages: List[Dict[str, str]], **params: Any) -> Any:
+    """Create a non-streamed completion; see ``_completion``."""
+    async with _completion(chat_messages, **params) as call:
+        if call.response.usage:
+            call.used = call.response.usage.total_tokens
+        return call.response
+
+
+FALLBACK_REPLY = "Sorry, I couldn't process that right now. Please try after some time."
+
+
+def _prompt(messages: List[Dict[str, str]], language: str) -> List[Dict[str, str]]:
+    recent = " ".join(m.get("content") or "" for m in messages[-4:] if m.get("role") == "user")
+    system_prompt = SYSTEM_PROMPT_TEMPLATE.format(
+        language=language, payment=PAYMENT_PLACEHOLDER, catalog=catalog_prompt(recent)
+    )
+    return [{"role": "system", "content": system_prompt}] + messages
+
+
+async def _generate(messages: List[Dict[str, str]], language: str) -> Tuple[str, bool]:
+    """Return ``(reply, ok)``; ``ok`` is False when the fallback reply was used."""
+    try:
+        resp = await _create_completion(_prompt(messages, language))
+        if resp.usage:
+            OPENAI_TOKENS.inc(resp.usage.prompt_tokens, type="prompt")
+            OPENAI_TOKENS.inc(resp.usage.completion_tokens, type="completion")
+        return resp.choices[0].message.content.strip(), True
     except Exception as exc:
         logger.exception("OpenAI request failed: %s", exc)
-        return "Sorry, I couldn't process that right now. Please try after some time."
+        return FALLBACK_REPLY, False
+
+
+# --- Response cache ---
+#
+# First messages from ads are mostly the same handful of openers ("hi",
+# "price?"), so their replies are cached by normalized text, language and
+# conversation stage. Only stages in RESPONSE_CACHE_STAGES are cached; by
+# default just "first" (a lone user message with no pinned profile or
+# summary), since later replies depend on the conversation and returning-user
+# replies can contain the user's details.
+
+RESPONSE_CACHE_TTL = int(os.getenv("RESPONSE_CACHE_TTL", "3600"))
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", "1000"))
+RESPONSE_CACHE_MAX_WORDS = int(os.getenv("RESPONSE_CACHE_MAX_WORDS", "8"))
+RESPONSE_CACHE_STAGES = {
+    s.strip() for s in os.getenv("RESPONSE_CACHE_STAGES", "first").split(",") if s.strip()
+}
+
+# Changing the prompt, catalog or model invalidates every cached reply
+PROMPT_VERSION = hashlib.sha1(
+    f"{SYSTEM_PROMPT_TEMPLATE}|{PRODUCTS!r}|{OPENAI_MODEL}".encode("utf-8")
+).hexdigest()[:12]
+
+_reply_cache: LRUCache[str] = LRUCache(RESPONSE_CACHE_SIZE, ttl=RESPONSE_CACHE_TTL)
+_inflight: Dict[str, "asyncio.Future[str]"] = {}
+
+RESPONSE_CACHE = counter("metabolix_response_cache_total", "Response cache lookups, by result.")
+gauge(
+    "metabolix_response_cache_memory",
+    "In-process response cache size and hit/miss/eviction counts.",
+    lambda: stats_gauge(_reply_cache.stats()),
+)
+
+_NON_WORD = re.compile(r"[^\w\s]+")
+
+
+def normalize_message(text: str) -> str:
+    """Case-fold, drop punctuation/emoji and collapse whitespace."""
+    text = unicodedata.normalize("NFKC", text).casefold()
+    return " ".join(_NON_WORD.sub(" ", text).split())
+
+
+def conversation_stage(messages: List[Dict[str, str]]) -> str:
+    if len(messages) == 1 and messages[0].get("role") == "user":
+        return "first"
+    if any(m.get("role") == "assistant" for m in messages):
+        return "followup"
+    return "returning"
+
+
+def response_cache_key(messages: List[Dict[str, str]], language: str) -> Optional[str]:
+    """Cache key for this turn, or ``None`` if its reply should not be cached."""
+    if not messages or messages[-1].get("role") != "user":
+        return None
+    stage = conversation_stage(messages)
+    text = normalize_message(messages[-1].get("content") or "")
+    if stage not in RESPONSE_CACHE_STAGES or not text:
+        return None
+    if len(text.split()) > RESPONSE_CACHE_MAX_WORDS:
+        return None
+    digest = hashlib.sha1(text.encode("utf-8")).hexdigest()[:16]
+    return f"reply:{PROMPT_VERSION}:{language}:{stage}:{digest}"
+
+
+async def _cache_get(key: str) -> Optional[str]:
+    reply = _reply_cache.get(key)
+    if reply is not None:
+        RESPONSE_CACHE.inc(result="hit_memory")
+        return reply
+    redis = get_redis()
+    if redis:
+        try:
+            reply = await redis.get(key)
+        except Exception as exc:
+            logger.warning("Response cache read failed: %s", exc)
+        if reply is not None:
+            _reply_cache.set(key, reply)
+            RESPONSE_CACHE.inc(result="hit_redis")
+            return reply
+    RESPONSE_CACHE.inc(result="miss")
+    return None
+
+
+async def _cache_set(key: str, reply: str) -> None:
+    _reply_cache.set(key, reply)
+    redis = get_redis()
+    if redis:
+        try:
+            await redis.set(key, reply, ex=RESPONSE_CACHE_TTL)
+        except Exception as exc:
+            logger.warning("Response cache write failed: %s", exc)
+
+
+async def generate_response(messages: List[Dict[str, str]], language: str = "English") -> str:
+    """Call OpenAI's API and return the assistant's reply.
+
+    Cacheable turns are served from the response cache, and identical
+    concurrent misses share a single OpenAI call.
+    """
+    key = response_cache_key(messages, language)
+    if key is None:
+        return (await _generate(messages, language))[0]
+    cached = await _cache_get(key)
+    if cached is not None:
+        return cached
+    pending = _inflight.get(key)
+    if pending is not None:
+        RESPONSE_CACHE.inc(result="coalesced")
+        try:
+            return await asyncio.shield(pending)
+        except asyncio.CancelledError:
+            if not pending.cancelled():
+                raise
+            return (await _generate(messages, language))[0]
+
+    future: "asyncio.Future[str]" = asyncio.get_running_loop().create_future()
+    _inflight[key] = future
+    try:
+        reply, ok = await _generate(messages, language)
+        if ok:
+            await _cache_set(key, reply)
+        future.set_result(reply)
+        return reply
+    finally:
+        if not future.done():
+            future.cancel()
+        _inflight.pop(key, None)
+
+
+# A user confirming after the bot offered a consult, order or appointment is
+# when the reply usually carries PAYMENT_PLACEHOLDER (prompt rule 6)
+_PAYMENT_INTENT = re.compile(r"\b(pay|payment|link|book|booking|buy|proceed)\b")
+_CONFIRMATION = re.compile(
+    r"^(yes|yeah|yep|ok|okay|sure|confirm|confirmed|done|go ahead|haan|ha)\b"
+)
+_OFFER = re.compile(r"\b(consult|consultation|appointment|order|book|booking|plan)\b")
+
+
+def payment_link_likely(messages: List[Dict[str, str]]) -> bool:
+    """Guess whether the next reply will include ``PAYMENT_PLACEHOLDER``."""
+    if not messages or messages[-1].get("role") != "user":
+        return False
+    text = normalize_message(messages[-1].get("content") or "")
+    if _PAYMENT_INTENT.search(text):
+        return True
+    if not _CONFIRMATION.match(text):
+        return False
+    previous = next(
+        (m.get("content") or "" for m in reversed(messages[:-1]) if m.get("role") == "assistant"),
+        "",
+    )
+    return bool(_OFFER.search(previous.lower()))
+
+
+async def stream_response(
+    messages: List[Dict[str, str]], language: str = "English"
+) -> AsyncIterator[str]:
+    """Yield the assistant's reply as it is generated.
+
+    The request goes through the same limiter and retries as
+    ``generate_response`` and keeps its in-flight slot until the stream ends;
+    the budget is settled with the usage reported in the last chunk. Closing
+    or cancelling the generator closes the upstream HTTP response, which
+    stops generation.
+    """
+    chat_messages = _prompt(messages, language)
+    params = {"stream": True, "stream_options": {"include_usage": True}}
+    async with _completion(chat_messages, **params) as call:
+        stream = call.response
+        first = True
+        start = time.perf_counter()
+        try:
+            async for chunk in stream:
+                if chunk.usage:
+                    call.used = chunk.usage.total_tokens
+                    OPENAI_TOKENS.inc(chunk.usage.prompt_tokens, type="prompt")
+                    OPENAI_TOKENS.inc(chunk.usage.completion_tokens, type="completion")
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta.content
+                if delta:
+                    if first:
+                        OPENAI_FIRST_TOKEN.observe(time.perf_counter() - start)
+                        first = False
+                    yield delta
+        finally:
+            await stream.close()
+
+
+SUMMARY_PROMPT = (
+    "You maintain a running summary of a WhatsApp conversation between a patient and "
+    "the Metabolix assistant. Update the summary with the new messages. Keep facts the "
+    "assistant will need later: the user's goals, health details, products or plans "
+    "discussed, prices quoted, payments and any pending questions. Write at most 120 "
+    "words in English, in plain sentences."
+)
+
 
+async def summarize_conversation(previous: Optional[str], messages: List[Dict[str, str]]) -> str:
+    """Fold ``messages`` into the running summary ``previous`` and return the new summary."""
+    transcript = "\n".join(f"{m['role']}: {m.get('content') or ''}" for m in messages)
+    chat_messages = [
+        {"role": "system", "content": SUMMARY_PROMPT},
+        {
+            "role": "user",
+            "content": f"Current summary:\n{previous or '(none)'}\n\nNew messages:\n{transcript}",
+        },
+    ]
+    with timed("openai.summarize"):
+        resp = await _create_completion(chat_messages, temperature=0.2, max_tokens=250)
+    if resp.usage:
+        OPENAI_TOKENS.inc(resp.usage.prompt_tokens, type="prompt")
+        OPENAI_TOKENS.inc(resp.usage.completion_tokens, type="completion")
+    return resp.choices[0].message.content.strip()
@@ -0,0 +1,127 @@
+"""Token-budgeted prompt context with a rolling conversation summary.
+
+``build_context`` keeps the newest session messages that fit in
+``CONTEXT_HISTORY_TOKENS`` and replaces everything older with the running
+summary, so the prompt stays roughly the same size however long the chat
+runs. Messages that fall out of the window are folded into the summary by a
+background task (``schedule_summary``) and upserted as the phone's single
+rolling summary. The summary records how many session messages it covers,
+counted from the start of the conversation (see ``conversation_offset``); on
+later turns only the messages after that point are candidates for the window,
+however the session was trimmed or lost.
+"""
+
+import asyncio
+import logging
+import os
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+from chat_engine import summarize_conversation
+from db import save_conversation_summary
+from metrics import histogram
+from utils import count_message_tokens, count_tokens
+
+logger = logging.getLogger(__name__)
+
+CONTEXT_HISTORY_TOKENS = int(os.getenv("CONTEXT_HISTORY_TOKENS", "1200"))
+
+Message = Dict[str, str]
+
+CONTEXT_TOKENS = histogram(
+    "metabolix_context_tokens",
+    "Tokens of session history sent per turn, excluding the system prompt.",
+    buckets=(50, 100, 200, 400, 800, 1200, 1600, 2400, 3200, 6400),
+)
+
+_summarizing: Set[str] = set()
+_tasks: Set["asyncio.Task[None]"] = set()
+
+
+def conversation_offset(session: List[Message], turns: int) -> int:
+    """Position of the first non-pinned message of a stored session.
+
+    ``turns`` is the user's durable ``chat_count``; every turn appends one
+    question and one reply to the session, so the count survives restarts,
+    worker switches and expired sessions.
+    """
+    body = sum(1 for message in session if message.get("role") != "system")
+    return max(2 * turns - body, 0)
+
+
+def build_context(
+    session: List[Message],
+    summary: Optional[Dict[str, Any]] = None,
+    budget: Optional[int] = None,
+    offset: int = 0,
+) -> Tuple[List[Message], List[Message], Optional[int]]:
+    """Return ``(messages, overflow, covered)`` for one turn.
+
+    ``messages`` is the pinned system messages, the summary (if any) and the
+    newest turns within ``budget`` tokens; the current user message is always
+    kept. ``overflow`` is the older, not yet summarized messages that did not
+    fit and should be folded into the summary, and ``covered`` the message
+    count to store with that summary. ``offset`` is the conversation position
+    of the first non-pinned message in ``session``.
+    """
+    if budget is None:
+        budget = CONTEXT_HISTORY_TOKENS
+    head = 0
+    while head < len(session) and session[head].get("role") == "system":
+        head += 1
+    pinned, history = session[:head], session[head:]
+    covered = (summary or {}).get("covered") or 0
+    # The newest message is the current turn and can never be covered
+    first = max(0, min(covered - offset, len(history) - 1))
+    body = history[first:]
+
+    start, used = len(body), 0
+    while start > 0:
+        cost = count_tokens(body[start - 1].get("content") or "") + 4
+        if start < len(body) and used + cost > budget:
+            break
+        used += cost
+        start -= 1
+    # Don't open the window on an assistant reply without its question
+    if 0 < start < len(body) - 1 and body[start].get("role") == "assistant":
+        start += 1
+    kept, overflow = body[start:], body[:start]
+
+    messages = list(pinned)
+    if summary and summary.get("summary"):
+        messages.append(
+            {"role": "system", "content": f"Summary of the conversation so far: {summary['summary']}"}
+        )
+    messages += kept
+    CONTEXT_TOKENS.observe(count_message_tokens(messages))
+    return messages, overflow, offset + first + start if overflow else None
+
+
+async def _fold(
+    phone: str, previous: Optional[str], overflow: List[Message], covered: int
+) -> None:
+    try:
+        text = await summarize_conversation(previous, overflow)
+        if await save_conversation_summary(phone, text, covered):
+            logger.info("Folded %s messages into summary for %s", len(overflow), phone)
+        else:
+            logger.info("Discarded stale summary fold for %s", phone)
+    except Exception as exc:
+        logger.warning("Summarizing conversation for %s failed: %s", phone, exc)
+    finally:
+        _summarizing.discard(phone)
+
+
+def schedule_summary(
+    phone: str,
+    summary: Optional[Dict[str, Any]],
+    overflow: List[Message],
+    covered: Optional[int],
+) -> None:
+    """Fold ``overflow`` into ``phone``'s summary in the background."""
+    if not overflow or not covered or phone in _summarizing:
+        return
+    _summarizing.add(phone)
+    previous = (summary or {}).get("summary")
+    task = asyncio.create_task(_fold(phone, previous, overflow, covered))
+    _tasks.add(task)
+    task.add_done_callback(_tasks.discard)
@@ -1,13 +1,19 @@
 """Async MongoDB integration using Motor with TLS and certifi."""
 
+import asyncio
 import os
 import logging
-from typing import Any, Dict, Optional
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
 
 from dotenv import load_dotenv
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ASCENDING, DESCENDING, IndexModel, ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError, OperationFailure
 import certifi
 
+from metrics import instrument
+
 # Load environment variables
 load_dotenv()
 
@@ -17,12 +23,76 @@ logger = logging.getLogger(__name__)
 # MongoDB connection string
 MONGODB_URI = os.getenv("MONGODB_URI")
 
-# Async client and DB handle
+# Number of chat turns stored per chat_history bucket document
+CHAT_BUCKET_SIZE = int(os.getenv("CHAT_BUCKET_SIZE", "100"))
+
+# Declarative index spec, applied by ensure_indexes() at startup
+INDEXES: Dict[str, List[IndexModel]] = {
+    "users": [
+        IndexModel(
+            [("phone", ASCENDING)],
+            name="phone_unique",
+            unique=True,
+            partialFilterExpression={"phone": {"$type": "string"}},
+        ),
+        IndexModel(
+            [("phone", ASCENDING), ("payments.link_id", ASCENDING)],
+            name="phone_payment_link",
+        ),
+        IndexModel(
+            [("last_nudge_at", ASCENDING), ("last_activity_at", ASCENDING)],
+            name="nudge_due",
+        ),
+    ],
+    "chat_history": [
+        IndexModel(
+            [("phone", ASCENDING), ("bucket", ASCENDING)],
+            name="phone_bucket",
+            unique=True,
+        ),
+    ],
+    # time_id serves time-range scans in the (time, _id) order exports resume from
+    "chats": [
+        IndexModel([("phone", ASCENDING), ("time", DESCENDING)], name="phone_time"),
+        IndexModel([("time", ASCENDING), ("_id", ASCENDING)], name="time_id"),
+    ],
+    "orders": [
+        IndexModel([("user.phone", ASCENDING), ("time", DESCENDING)], name="phone_time"),
+        IndexModel([("time", ASCENDING), ("_id", ASCENDING)], name="time_id"),
+    ],
+    "appointments": [
+        IndexModel([("user.phone", ASCENDING), ("time", DESCENDING)], name="phone_time"),
+        IndexModel([("time", ASCENDING), ("_id", ASCENDING)], name="time_id"),
+    ],
+    "summaries": [
+        IndexModel([("user_phone", ASCENDING), ("_id", DESCENDING)], name="phone_latest"),
+        # One rolling conversation summary per phone, upserted on every fold
+        IndexModel(
+            [("user_phone", ASCENDING)],
+            name="phone_rolling_unique",
+            unique=True,
+            partialFilterExpression={"rolling": True},
+        ),
+    ],
+    "payment_events": [
+        IndexModel([("event_key", ASCENDING)], name="event_key_unique", unique=True),
+        IndexModel([("phone", ASCENDING), ("time", DESCENDING)], name="phone_time"),
+    ],
+}
+
+# Async client and DB handle, created by init_db() from the app lifespan
 client: Optional[AsyncIOMotorClient] = None
 db = None
 
-# Setup MongoDB connection with TLS
-if MONGODB_URI:
+
+def init_db() -> None:
+    """Create the Motor client if configured and not already set up."""
+    global client, db
+    if db is not None:
+        return
+    if not MONGODB_URI:
+        logger.warning("MONGODB_URI not set. Database not configured.")
+        return
     try:
         client = AsyncIOMotorClient(
             MONGODB_URI,
@@ -32,14 +102,34 @@ if MONGODB_URI:
             tlsAllowInvalidCertificates=os.getenv("MONGODB_ALLOW_INVALID_CERTS", "false").lower() == "true"
         )
         db = client.get_default_database()
-        logger.info("Connected to MongoDB successfully.")
+        logger.info("MongoDB client created.")
     except Exception as e:
         logger.error(f"MongoDB connection error: {e}")
-else:
-    logger.warning("MONGODB_URI not set. Database not configured.")
+
+
+def get_db():
+    """Return the database handle, or ``None`` when not configured."""
+    return db
+
+
+async def ping_db() -> None:
+    """Round-trip to the server; raises if it is unreachable."""
+    if db is None:
+        raise RuntimeError("Database not configured")
+    await db.command("ping")
+
+
+def close_db() -> None:
+    """Close the Motor client created by ``init_db``."""
+    global client, db
+    if client is not None:
+        client.close()
+        client = None
+        db = None
 
 # === Async DB Operations ===
 
+@instrument("mongo.save_user")
 async def save_user(user: Dict[str, Any]) -> str:
     """Create or update a user profile."""
     if db is None:
@@ -50,18 +140,20 @@ async def save_user(user: Dict[str, Any]) -> str:
         logger.info("Saved user with id %s", res.inserted_id)
         return str(res.inserted_id)
 
-    await db.users.update_one(
+    doc = await db.users.find_one_and_update(
         {"phone": phone},
         {
             "$set": user,
-            "$setOnInsert": {"chats": [], "payments": []},
+            "$setOnInsert": {"payments": []},
         },
+        projection={"_id": 1},
         upsert=True,
+        return_document=ReturnDocument.AFTER,
     )
-    doc = await db.users.find_one({"phone": phone}, {"_id": 1})
     logger.info("Saved user with phone %s", phone)
     return str(doc["_id"])
 
+@instrument("mongo.save_chat")
 async def save_chat(chat: Dict[str, Any]) -> str:
     if db is None:
         raise RuntimeError("Database not configured")
@@ -70,19 +162,263 @@ async def save_chat(chat: Dict[str, Any]) -> str:
     return str(res.inserted_id)
 
 
+class UnitOfWork:
+    """Collects one request's writes and flushes them in as few round trips as possible.
+
+    Everything targeting the user document is merged into a single update;
+    chat turns, ``chats`` inserts and positional payment updates are written
+    concurrently with it.
+    """
+
+    def __init__(self, phone: Optional[str] = None) -> None:
+        self.phone = phone
+        self._set: Dict[str, Any] = {}
+        self._payments: List[Dict[str, Any]] = []
+        self._payment_updates: List[UpdateOne] = []
+        self._turns: List[Dict[str, Any]] = []
+        self._chats: List[Dict[str, Any]] = []
+
+    def set_language(self, language: str) -> None:
+        self._set["language"] = language
+
+    def record_payment(self, payment: Dict[str, Any]) -> None:
+        self._payments.append(payment)
+
+    def mark_payment_paid(self, link_id: str, payment_id: str) -> None:
+        self._payment_updates.append(
+            UpdateOne(
+                {"phone": self.phone, "payments.link_id": link_id},
+                {"$set": {"payments.$.status": "paid", "payments.$.payment_id": payment_id}},
+            )
+        )
+
+    def expire_pending_payments(self, before: str) -> None:
+        self._payment_updates.append(
+            UpdateOne(
+                {"phone": self.phone},
+                {"$set": {"payments.$[p].status": "expired"}},
+                array_filters=[{"p.status": "pending", "p.time": {"$lt": before}}],
+            )
+        )
+
+    def append_chat(self, user_text: str, bot_text: str, time: str) -> None:
+        self._turns.append({"input": user_text, "output": bot_text, "time": time})
+
+    def save_chat(self, chat: Dict[str, Any]) -> None:
+        self._chats.append(chat)
+
+    @instrument("mongo.flush")
+    async def flush(self) -> None:
+        """Write all pending mutations and reset the unit of work."""
+        if db is None:
+            raise RuntimeError("Database not configured")
+        tasks = []
+        if self._chats:
+            tasks.append(db.chats.insert_many(self._chats, ordered=False))
+        if self._payment_updates:
+            tasks.append(db.users.bulk_write(self._payment_updates, ordered=True))
+        if self.phone and (self._set or self._payments or self._turns):
+            tasks.append(self._flush_user())
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            self._set, self._payments, self._turns = {}, [], []
+            self._payment_updates, self._chats = [], []
+
+    async def _flush_user(self) -> None:
+        update: Dict[str, Any] = {}
+        fields = dict(self._set)
+        if self._turns:
+            # Keep the nudge scheduler's denormalized activity fields current
+            fields.update(last_activity_at=datetime.utcnow(), last_nudge_at=None)
+            update["$inc"] = {"chat_count": len(self._turns)}
+        if fields:
+            update["$set"] = fields
+        if self._payments:
+            update["$push"] = {"payments": {"$each": self._payments}}
+        if not self._turns:
+            await db.users.update_one({"phone": self.phone}, update, upsert=True)
+            return
+
+        user = await db.users.find_one_and_update(
+            {"phone": self.phone},
+            update,
+            projection={"chat_count": 1},
+            upsert=True,
+            return_document=ReturnDocument.AFTER,
+        )
+        first = user["chat_count"] - len(self._turns)
+        buckets: Dict[int, List[Dict[str, Any]]] = {}
+        for offset, turn in enumerate(self._turns):
+            seq = first + offset
+            buckets.setdefault(seq // CHAT_BUCKET_SIZE, []).append({"seq": seq, **turn})
+        await db.chat_history.bulk_write(
+            [
+                UpdateOne(
+                    {"phone": self.phone, "bucket": bucket},
+                    {
+                        "$push": {"messages": {"$each": messages}},
+                        "$inc": {"count": len(messages)},
+                        "$set": {"end_time": messages[-1]["time"]},
+                        "$setOnInsert": {"start_time": messages[0]["time"]},
+                    },
+                    upsert=True,
+                )
+                for bucket, messages in buckets.items()
+            ]
+        )
+
+
 async def append_chat(phone: str, user_text: str, bot_text: str, time: str) -> None:
-    """Append a chat message to the user's conversation history."""
+    """Append a chat turn to the user's bucketed conversation history.
+
+    The user document only carries a ``chat_count`` counter; the turn itself
+    goes into ``chat_history`` under bucket ``seq // CHAT_BUCKET_SIZE``.
+    Also refreshes the denormalized ``last_activity_at`` and clears
+    ``last_nudge_at`` so the nudge scheduler can find idle users by index.
+    """
+    uow = UnitOfWork(phone)
+    uow.append_chat(user_text, bot_text, time)
+    await uow.flush()
+
+
+async def get_chat_history(
+    phone: str, limit: int = 50, before: Optional[int] = None
+) -> Tuple[List[Dict[str, Any]], Optional[int]]:
+    """Return up to ``limit`` chat turns older than ``before``, oldest first.
+
+    ``before`` is the ``seq`` cursor returned by the previous call; the
+    returned cursor is ``None`` once the start of the history is reached.
+    """
     if db is None:
         raise RuntimeError("Database not configured")
-    await db.users.update_one(
-        {"phone": phone},
-        {
-            "$push": {
-                "chats": {"input": user_text, "output": bot_text, "time": time}
-            }
-        },
-        upsert=True,
+    query: Dict[str, Any] = {"phone": phone}
+    if before is not None:
+        query["bucket"] = {"$lte": (before - 1) // CHAT_BUCKET_SIZE}
+    cursor = (
+        db.chat_history.find(query, {"_id": 0, "messages": 1})
+        .sort("bucket", -1)
+        .limit(limit // CHAT_BUCKET_SIZE + 2)
+    )
+    turns: List[Dict[str, Any]] = []
+    async for bucket in cursor:
+        messages = [
+            m for m in bucket.get("messages", []) if before is None or m["seq"] < before
+        ]
+        turns = messages + turns
+        if len(turns) >= limit:
+            break
+    turns = turns[-limit:] if limit else []
+    next_before = turns[0]["seq"] if turns and len(turns) == limit else None
+    return turns, next_before
+
+
+def _parse_time(value: Any) -> Optional[datetime]:
+    if isinstance(value, datetime):
+        return value
+    try:
+        return datetime.fromisoformat(value)
+    except (TypeError, ValueError):
+        return None
+
+
+async def migrate_legacy_chats(batch_size: int = 100) -> int:
+    """Move embedded ``users.chats`` arrays into ``chat_history`` buckets.
+
+    Legacy turns get negative ``seq`` numbers so they sort before any turns
+    appended since the upgrade. Safe to re-run; returns the number of users
+    migrated.
+    """
+    if db is None:
+        return 0
+    migrated = 0
+    cursor = db.users.find(
+        {"chats.0": {"$exists": True}},
+        {"phone": 1, "chats": 1, "last_activity_at": 1, "last_nudge": 1},
+        batch_size=batch_size,
     )
+    async for user in cursor:
+        phone = user.get("phone")
+        chats = user.get("chats") or []
+        if not phone:
+            continue
+        buckets: Dict[int, List[Dict[str, Any]]] = {}
+        for offset, chat in enumerate(chats):
+            seq = offset - len(chats)
+            buckets.setdefault(seq // CHAT_BUCKET_SIZE, []).append({"seq": seq, **chat})
+        for bucket, messages in buckets.items():
+            await db.chat_history.replace_one(
+                {"phone": phone, "bucket": bucket},
+                {
+                    "phone": phone,
+                    "bucket": bucket,
+                    "count": len(messages),
+                    "messages": messages,
+                    "start_time": messages[0].get("time"),
+                    "end_time": messages[-1].get("time"),
+                },
+                upsert=True,
+            )
+        update: Dict[str, Any] = {"$unset": {"chats": ""}}
+        if "last_activity_at" not in user:
+            # The nudge backfill skips users with last_activity_at, so carry
+            # the legacy nudge over here as well
+            last = _parse_time(chats[-1].get("time"))
+            nudged = _parse_time(user.get("last_nudge"))
+            update["$set"] = {
+                "last_activity_at": last,
+                "last_nudge_at": nudged if nudged and (last is None or nudged >= last) else None,
+            }
+        await db.users.update_one({"_id": user["_id"]}, update)
+        migrated += 1
+    if migrated:
+        logger.info("Migrated embedded chats for %s users", migrated)
+    return migrated
+
+
+async def ensure_indexes() -> None:
+    """Create every index declared in ``INDEXES``.
+
+    Safe to run on every startup; a conflicting definition is logged and
+    skipped so one bad index cannot block the rest.
+    """
+    if db is None:
+        return
+    for name, models in INDEXES.items():
+        try:
+            await db[name].create_indexes(models)
+        except OperationFailure as exc:
+            logger.warning("Index creation failed on %s: %s", name, exc)
+
+
+async def index_report() -> Dict[str, Dict[str, List[str]]]:
+    """Compare declared indexes with the live ones.
+
+    Returns, per collection, declared indexes that are ``missing``, live
+    indexes that are not declared (``undeclared``) and live indexes with no
+    recorded accesses since the server started (``unused``).
+    """
+    if db is None:
+        return {}
+    report: Dict[str, Dict[str, List[str]]] = {}
+    for name, models in INDEXES.items():
+        coll = db[name]
+        declared = {m.document["name"] for m in models}
+        live = set(await coll.index_information()) - {"_id_"}
+        unused = []
+        try:
+            async for stat in coll.aggregate([{"$indexStats": {}}]):
+                if stat["name"] != "_id_" and stat["accesses"]["ops"] == 0:
+                    unused.append(stat["name"])
+        except OperationFailure as exc:
+            logger.debug("$indexStats unavailable for %s: %s", name, exc)
+        report[name] = {
+            "missing": sorted(declared - live),
+            "undeclared": sorted(live - declared),
+            "unused": sorted(unused),
+        }
+    return report
+
 
 async def save_summary(summary: Dict[str, Any]) -> str:
     if db is None:
@@ -91,56 +427,161 @@ async def save_summary(summary: Dict[str, Any]) -> str:
     logger.info("Saved summary with id %s", res.inserted_id)
     return str(res.inserted_id)
 
-async def get_user_by_phone(phone: str) -> Optional[Dict[str, Any]]:
+@instrument("mongo.get_conversation_summary")
+async def get_conversation_summary(phone: str) -> Optional[Dict[str, Any]]:
+    """Rolling conversation summary for ``phone``, if any.
+
+    Consult summaries posted to ``/summary`` are stored alongside but are not
+    rolling summaries and are ignored.
+    """
     if db is None:
         raise RuntimeError("Database not configured")
-    user = await db.users.find_one({"phone": phone})
-    logger.debug("Fetched user by phone %s: %s", phone, bool(user))
-    return user
+    return await db.summaries.find_one(
+        {"user_phone": phone, "rolling": True},
+        {"_id": 0, "summary": 1, "covered": 1},
+    )
+
 
+async def save_conversation_summary(phone: str, summary: str, covered: int) -> bool:
+    """Upsert ``phone``'s rolling summary covering its first ``covered`` messages.
 
-async def update_user_language(phone: str, language: str) -> None:
-    """Store the last used language for a user."""
+    Returns False, leaving the stored summary alone, when it already covers
+    at least as much (e.g. a slower fold finishing after a newer one).
+    """
     if db is None:
         raise RuntimeError("Database not configured")
-    await db.users.update_one({"phone": phone}, {"$set": {"language": language}})
-    logger.debug("Updated language for %s to %s", phone, language)
+    try:
+        await db.summaries.update_one(
+            {"user_phone": phone, "rolling": True, "covered": {"$lt": covered}},
+            {
+                "$set": {
+                    "summary": summary,
+                    "covered": covered,
+                    "time": datetime.utcnow().isoformat(),
+                }
+            },
+            upsert=True,
+        )
+    except DuplicateKeyError:
+        return False
+    return True
 
 
-async def record_payment(phone: str, payment: Dict[str, Any]) -> None:
-    """Store a payment event for a user."""
+@instrument("mongo.insert_payment_event")
+async def insert_payment_event(event: Dict[str, Any]) -> bool:
+    """Store a webhook event; False if its ``event_key`` was already recorded."""
     if db is None:
         raise RuntimeError("Database not configured")
-    await db.users.update_one(
+    try:
+        await db.payment_events.insert_one(event)
+    except DuplicateKeyError:
+        return False
+    return True
+
+
+async def delete_payment_event(event_key: str) -> None:
+    """Forget an event so a redelivery is processed again."""
+    if db is None:
+        raise RuntimeError("Database not configured")
+    await db.payment_events.delete_one({"event_key": event_key})
+
+
+@instrument("mongo.get_turn_context")
+async def get_turn_context(phone: str) -> Dict[str, Any]:
+    """Fetch profile fields, ``chat_count`` and payments for a turn in one read.
+
+    ``payments`` holds only the pending entries; ``payment_link_ids`` lists
+    the link id of every recorded payment, whatever its status.
+    """
+    if db is None:
+        raise RuntimeError("Database not configured")
+    user = await db.users.find_one(
         {"phone": phone},
-        {"$push": {"payments": payment}},
-        upsert=True,
+        {
+            "_id": 0,
+            "name": 1,
+            "age": 1,
+            "gender": 1,
+            "pin": 1,
+            "language": 1,
+            "chat_count": 1,
+            "payments": {
+                "$filter": {
+                    "input": {"$ifNull": ["$payments", []]},
+                    "cond": {"$eq": ["$$this.status", "pending"]},
+                }
+            },
+            "payment_link_ids": {
+                "$map": {"input": {"$ifNull": ["$payments", []]}, "in": "$$this.link_id"}
+            },
+        },
     )
-    
+    return user or {}
 
-async def mark_payment_paid(phone: str, link_id: str, payment_id: str) -> None:
-    """Update a pending payment's status to paid."""
+
+@instrument("mongo.get_pending_payments")
+async def get_pending_payments(phone: str) -> List[Dict[str, Any]]:
+    """Return only the user's pending payment entries, oldest first."""
     if db is None:
         raise RuntimeError("Database not configured")
-    await db.users.update_one(
-        {"phone": phone, "payments.link_id": link_id},
-        {"$set": {"payments.$.status": "paid", "payments.$.payment_id": payment_id}},
+    user = await db.users.find_one(
+        {"phone": phone, "payments.status": "pending"},
+        {
+            "_id": 0,
+            "payments": {
+                "$filter": {
+                    "input": "$payments",
+                    "cond": {"$eq": ["$$this.status", "pending"]},
+                }
+            },
+        },
     )
+    return (user or {}).get("payments") or []
 
 
+@instrument("mongo.save_order")
 async def save_order(order: Dict[str, Any]) -> str:
     """Store a product order."""
     if db is None:
         raise RuntimeError("Database not configured")
+    order.setdefault("time", datetime.utcnow().isoformat())
     res = await db.orders.insert_one(order)
     logger.info("Saved order with id %s", res.inserted_id)
     return str(res.inserted_id)
 
 
+@instrument("mongo.save_appointment")
 async def save_appointment(appointment: Dict[str, Any]) -> str:
     """Store an appointment request."""
     if db is None:
         raise RuntimeError("Database not configured")
+    appointment.setdefault("time", datetime.utcnow().isoformat())
     res = await db.appointments.insert_one(appointment)
     logger.info("Saved appointment with id %s", res.inserted_id)
     return str(res.inserted_id)
+
+
+async def _insert_rows(collection: str, docs: List[Dict[str, Any]]) -> Dict[int, str]:
+    """Insert ``docs`` unordered; return ``{index: error}`` for rows that failed."""
+    if db is None:
+        raise RuntimeError("Database not configured")
+    now = datetime.utcnow().isoformat()
+    for doc in docs:
+        doc.setdefault("time", now)
+    try:
+        await db[collection].insert_many(docs, ordered=False)
+    except BulkWriteError as exc:
+        return {e["index"]: e.get("errmsg", "write failed") for e in exc.details.get("writeErrors", [])}
+    return {}
+
+
+@instrument("mongo.save_orders")
+async def save_orders(orders: List[Dict[str, Any]]) -> Dict[int, str]:
+    """Store a chunk of orders in one round trip."""
+    return await _insert_rows("orders", orders)
+
+
+@instrument("mongo.save_appointments")
+async def save_appointments(appointments: List[Dict[str, Any]]) -> Dict[int, str]:
+    """Store a chunk of appointment requests in one round trip."""
+    return await _insert_rows("appointments", appointments)
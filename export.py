@@ -0,0 +1,221 @@
+"""Streaming exports of chats, orders, appointments and payments.
+
+Rows are read from Motor cursors ``EXPORT_BATCH_SIZE`` documents at a time
+and written out as NDJSON or CSV as they arrive, so memory use does not grow
+with the export. Collections are walked in ``(time, _id)`` order, which the
+``time_id`` indexes serve directly; payments are unwound from user documents
+in ``_id`` order. Every row carries a ``cursor`` token; pass the last one
+seen as ``after`` to resume an interrupted export.
+
+    python export.py orders --format csv --since 2024-01-01 > orders.csv
+"""
+
+import argparse
+import asyncio
+import base64
+import csv
+import io
+import json
+import os
+import sys
+from typing import Any, AsyncIterator, Dict, List, Optional
+
+from bson import ObjectId
+
+import db
+
+EXPORT_BATCH_SIZE = int(os.getenv("EXPORT_BATCH_SIZE", "1000"))
+
+# Columns written in CSV mode; nested fields use dotted paths
+FIELDS: Dict[str, List[str]] = {
+    "chats": ["cursor", "time", "phone", "input", "output"],
+    "orders": [
+        "cursor", "time", "user.name", "user.phone", "user.age", "user.gender",
+        "user.location", "product", "quantity",
+    ],
+    "appointments": [
+        "cursor", "time", "user.name", "user.phone", "user.age", "user.gender",
+        "user.location", "datetime",
+    ],
+    "payments": [
+        "cursor", "time", "phone", "name", "payment_id", "link_id", "amount", "status", "link",
+    ],
+}
+_PHONE_FIELD = {"chats": "phone", "orders": "user.phone", "appointments": "user.phone"}
+
+
+def encode_cursor(*parts: Any) -> str:
+    raw = json.dumps([str(p) if isinstance(p, ObjectId) else p for p in parts])
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def decode_cursor(token: str) -> List[Any]:
+    """Inverse of ``encode_cursor``; raises ``ValueError`` on a malformed token."""
+    try:
+        padded = token + "=" * (-len(token) % 4)
+        parts = json.loads(base64.urlsafe_b64decode(padded.encode()))
+    except Exception as exc:
+        raise ValueError("Invalid export cursor") from exc
+    if not isinstance(parts, list) or len(parts) != 2:
+        raise ValueError("Invalid export cursor")
+    return parts
+
+
+def _time_range(since: Optional[str], until: Optional[str]) -> Dict[str, str]:
+    cond = {}
+    if since:
+        cond["$gte"] = since
+    if until:
+        cond["$lt"] = until
+    return cond
+
+
+async def _collection_rows(
+    kind: str,
+    phone: Optional[str],
+    since: Optional[str],
+    until: Optional[str],
+    after: Optional[str],
+) -> AsyncIterator[Dict[str, Any]]:
+    clauses: List[Dict[str, Any]] = []
+    if phone:
+        clauses.append({_PHONE_FIELD[kind]: phone})
+    time_cond = _time_range(since, until)
+    if time_cond:
+        clauses.append({"time": time_cond})
+    if after:
+        last_time, last_id = decode_cursor(after)
+        last_id = ObjectId(last_id)
+        if last_time is None:
+            clauses.append({"$or": [{"time": {"$ne": None}}, {"time": None, "_id": {"$gt": last_id}}]})
+        else:
+            clauses.append(
+                {"$or": [{"time": {"$gt": last_time}}, {"time": last_time, "_id": {"$gt": last_id}}]}
+            )
+    query = {"$and": clauses} if clauses else {}
+    cursor = (
+        db.get_db()[kind]
+        .find(query)
+        .sort([("time", 1), ("_id", 1)])
+        .batch_size(EXPORT_BATCH_SIZE)
+    )
+    async for doc in cursor:
+        doc["cursor"] = encode_cursor(doc.get("time"), doc["_id"])
+        doc["_id"] = str(doc["_id"])
+        yield doc
+
+
+async def _payment_rows(
+    phone: Optional[str],
+    since: Optional[str],
+    until: Optional[str],
+    after: Optional[str],
+) -> AsyncIterator[Dict[str, Any]]:
+    match: Dict[str, Any] = {"payments.0": {"$exists": True}}
+    if phone:
+        match["phone"] = phone
+    resume: Dict[str, Any] = {}
+    if after:
+        last_id, last_idx = decode_cursor(after)
+        match["_id"] = {"$gte": ObjectId(last_id)}
+        resume = {"$or": [{"_id": {"$gt": ObjectId(last_id)}}, {"idx": {"$gt": last_idx}}]}
+    pipeline: List[Dict[str, Any]] = [
+        {"$match": match},
+        {"$sort": {"_id": 1}},
+        {"$project": {"phone": 1, "name": 1, "payments": 1}},
+        {"$unwind": {"path": "$payments", "includeArrayIndex": "idx"}},
+    ]
+    time_cond = _time_range(since, until)
+    if time_cond:
+        pipeline.append({"$match": {"payments.time": time_cond}})
+    if resume:
+        pipeline.append({"$match": resume})
+    cursor = db.get_db().users.aggregate(pipeline, batchSize=EXPORT_BATCH_SIZE)
+    async for doc in cursor:
+        yield {
+            "cursor": encode_cursor(doc["_id"], doc["idx"]),
+            "phone": doc.get("phone"),
+            "name": doc.get("name"),
+            **doc["payments"],
+        }
+
+
+def export_rows(
+    kind: str,
+    phone: Optional[str] = None,
+    since: Optional[str] = None,
+    until: Optional[str] = None,
+    after: Optional[str] = None,
+) -> AsyncIterator[Dict[str, Any]]:
+    """Stream export rows for ``kind`` (one of ``FIELDS``)."""
+    if kind not in FIELDS:
+        raise ValueError(f"Unknown export {kind!r}")
+    if db.get_db() is None:
+        raise RuntimeError("Database not configured")
+    if after:
+        decode_cursor(after)  # fail before streaming starts
+    if kind == "payments":
+        return _payment_rows(phone, since, until, after)
+    return _collection_rows(kind, phone, since, until, after)
+
+
+def _field(row: Dict[str, Any], path: str) -> Any:
+    value: Any = row
+    for part in path.split("."):
+        value = value.get(part) if isinstance(value, dict) else None
+    return "" if value is None else value
+
+
+async def render_ndjson(rows: AsyncIterator[Dict[str, Any]]) -> AsyncIterator[str]:
+    async for row in rows:
+        yield json.dumps(row, default=str) + "\n"
+
+
+async def render_csv(rows: AsyncIterator[Dict[str, Any]], fields: List[str]) -> AsyncIterator[str]:
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(fields)
+    async for row in rows:
+        writer.writerow([_field(row, f) for f in fields])
+        # Hand rows out in roughly page-sized pieces
+        if buffer.tell() >= 64 * 1024:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+
+def render(kind: str, rows: AsyncIterator[Dict[str, Any]], fmt: str) -> AsyncIterator[str]:
+    """Encode ``rows`` as ``ndjson`` or ``csv``."""
+    if fmt == "csv":
+        return render_csv(rows, FIELDS[kind])
+    if fmt == "ndjson":
+        return render_ndjson(rows)
+    raise ValueError(f"Unknown export format {fmt!r}")
+
+
+async def _run(args: argparse.Namespace) -> None:
+    db.init_db()
+    try:
+        rows = export_rows(args.kind, args.phone, args.since, args.until, args.after)
+        async for chunk in render(args.kind, rows, args.format):
+            sys.stdout.write(chunk)
+    finally:
+        db.close_db()
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Stream an export to stdout.")
+    parser.add_argument("kind", choices=sorted(FIELDS))
+    parser.add_argument("--format", choices=["ndjson", "csv"], default="ndjson")
+    parser.add_argument("--phone")
+    parser.add_argument("--since", help="inclusive ISO timestamp")
+    parser.add_argument("--until", help="exclusive ISO timestamp")
+    parser.add_argument("--after", help="resume after this row's cursor")
+    args = parser.parse_args(argv)
+    asyncio.run(_run(args))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,100 @@
+"""Shared async HTTP transport for outbound API calls (Twilio, Razorpay).
+
+One keep-alive ``aiohttp`` session is reused for all requests in an event
+loop, with a global connection cap, per-host concurrency limits and
+configurable timeouts. Per-host limits default to ``HTTP_MAX_PER_HOST`` and
+can be overridden with ``HTTP_HOST_LIMITS="api.twilio.com=20,api.razorpay.com=10"``.
+"""
+
+import asyncio
+import base64
+import logging
+import os
+from typing import Any, Dict, Optional, Tuple
+from urllib.parse import urlsplit
+
+import aiohttp
+
+logger = logging.getLogger(__name__)
+
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", "100"))
+HTTP_MAX_PER_HOST = int(os.getenv("HTTP_MAX_PER_HOST", "20"))
+HTTP_TIMEOUT_SECONDS = float(os.getenv("HTTP_TIMEOUT_SECONDS", "15"))
+HTTP_CONNECT_TIMEOUT_SECONDS = float(os.getenv("HTTP_CONNECT_TIMEOUT_SECONDS", "5"))
+HTTP_KEEPALIVE_SECONDS = float(os.getenv("HTTP_KEEPALIVE_SECONDS", "30"))
+
+
+def _parse_host_limits(raw: str) -> Dict[str, int]:
+    limits: Dict[str, int] = {}
+    for item in raw.split(","):
+        host, _, value = item.partition("=")
+        if host.strip() and value.strip().isdigit():
+            limits[host.strip()] = int(value)
+    return limits
+
+
+HTTP_HOST_LIMITS = _parse_host_limits(os.getenv("HTTP_HOST_LIMITS", ""))
+
+_session: Optional[aiohttp.ClientSession] = None
+_session_loop: Optional[asyncio.AbstractEventLoop] = None
+_host_semaphores: Dict[str, asyncio.Semaphore] = {}
+
+
+def get_session() -> aiohttp.ClientSession:
+    """Return the pooled session for the running event loop."""
+    global _session, _session_loop
+    loop = asyncio.get_running_loop()
+    if _session is None or _session.closed or _session_loop is not loop:
+        connector = aiohttp.TCPConnector(
+            limit=HTTP_POOL_SIZE,
+            keepalive_timeout=HTTP_KEEPALIVE_SECONDS,
+        )
+        timeout = aiohttp.ClientTimeout(
+            total=HTTP_TIMEOUT_SECONDS, connect=HTTP_CONNECT_TIMEOUT_SECONDS
+        )
+        _session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+        _session_loop = loop
+        _host_semaphores.clear()
+    return _session
+
+
+def _host_semaphore(host: str) -> asyncio.Semaphore:
+    sem = _host_semaphores.get(host)
+    if sem is None:
+        sem = asyncio.Semaphore(HTTP_HOST_LIMITS.get(host, HTTP_MAX_PER_HOST))
+        _host_semaphores[host] = sem
+    return sem
+
+
+async def request_json(
+    method: str,
+    url: str,
+    *,
+    auth: Optional[Tuple[str, str]] = None,
+    json: Optional[Dict[str, Any]] = None,
+    data: Optional[Dict[str, Any]] = None,
+) -> Dict[str, Any]:
+    """Send a request through the shared pool and return the JSON body.
+
+    Raises ``aiohttp.ClientResponseError`` for non-2xx responses.
+    """
+    session = get_session()
+    headers = {}
+    if auth:
+        token = base64.b64encode(f"{auth[0]}:{auth[1]}".encode()).decode()
+        headers["Authorization"] = f"Basic {token}"
+    async with _host_semaphore(urlsplit(url).netloc):
+        async with session.request(method, url, headers=headers, json=json, data=data) as resp:
+            if resp.status >= 400:
+                body = await resp.text()
+                logger.warning("%s %s failed with %s: %s", method, url, resp.status, body[:200])
+                resp.raise_for_status()
+            return await resp.json(content_type=None)
+
+
+async def close_http() -> None:
+    """Close the pooled session."""
+    global _session
+    if _session is not None and not _session.closed:
+        await _session.close()
+    _session = None
@@ -0,0 +1,169 @@
+"""Cluster-wide single-leader scheduling for background jobs.
+
+Every worker process runs ``run_periodic`` for each job, but only the holder
+of the job's Redis lease executes it. The lease is a ``SET NX PX`` key that
+the leader renews every third of ``LEADER_LEASE_TTL``; if the leader dies or
+stalls, the key expires and another worker takes over on its next poll. The
+time of the last completed run is stored alongside the lease so a failover
+does not run the job early. Without Redis every process is its own leader.
+"""
+
+import asyncio
+import logging
+import os
+import time
+import uuid
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+from metrics import gauge, labels
+from session_store import get_redis
+
+logger = logging.getLogger(__name__)
+
+LEADER_LEASE_TTL = float(os.getenv("LEADER_LEASE_TTL", "30"))
+
+_local_last_run: Dict[str, float] = {}
+_leases: Dict[str, "Lease"] = {}
+
+
+class Lease:
+    """A renewable Redis lease identifying the leader for ``name``."""
+
+    def __init__(self, name: str, ttl: Optional[float] = None) -> None:
+        self.name = name
+        self.key = f"lease:{name}"
+        self.ttl = ttl if ttl is not None else LEADER_LEASE_TTL
+        self.token = uuid.uuid4().hex
+        self.held = False
+
+    async def acquire(self) -> bool:
+        """Take the lease if free, or renew it if already held."""
+        if self.held:
+            return await self.renew()
+        redis = get_redis()
+        if not redis:
+            self.held = True
+            return True
+        self.held = bool(await redis.set(self.key, self.token, nx=True, px=int(self.ttl * 1000)))
+        if self.held:
+            logger.info("Became leader for %s", self.name)
+        return self.held
+
+    async def renew(self) -> bool:
+        """Extend the lease; returns False if it was lost to another worker."""
+        redis = get_redis()
+        if not redis:
+            return self.held
+        async with redis.pipeline(transaction=True) as pipe:
+            await pipe.watch(self.key)
+            if await pipe.get(self.key) == self.token:
+                pipe.multi()
+                pipe.pexpire(self.key, int(self.ttl * 1000))
+                await pipe.execute()
+            else:
+                await pipe.unwatch()
+                if self.held:
+                    logger.warning("Lost leader lease for %s", self.name)
+                self.held = False
+        return self.held
+
+    async def release(self) -> None:
+        """Give up the lease so another worker can take over immediately."""
+        redis = get_redis()
+        was_held, self.held = self.held, False
+        if not redis or not was_held:
+            return
+        async with redis.pipeline(transaction=True) as pipe:
+            await pipe.watch(self.key)
+            if await pipe.get(self.key) == self.token:
+                pipe.multi()
+                pipe.delete(self.key)
+                await pipe.execute()
+            else:
+                await pipe.unwatch()
+
+
+async def _last_run(name: str) -> float:
+    redis = get_redis()
+    if not redis:
+        return _local_last_run.get(name, 0.0)
+    value = await redis.get(f"lease:{name}:last_run")
+    return float(value) if value else 0.0
+
+
+async def _mark_run(name: str, interval: float) -> None:
+    now = time.time()
+    redis = get_redis()
+    if not redis:
+        _local_last_run[name] = now
+        return
+    await redis.set(f"lease:{name}:last_run", now, ex=max(1, int(interval * 2)))
+
+
+async def _run_while_leader(lease: Lease, job: Callable[[], Awaitable[Any]]) -> bool:
+    """Run ``job``, renewing the lease; cancel it if the lease is lost."""
+    task = asyncio.ensure_future(job())
+    try:
+        while True:
+            done, _ = await asyncio.wait({task}, timeout=lease.ttl / 3)
+            if done:
+                task.result()
+                return True
+            if not await lease.renew():
+                task.cancel()
+                await asyncio.gather(task, return_exceptions=True)
+                return False
+    finally:
+        if not task.done():
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+
+
+async def run_periodic(
+    name: str,
+    job: Callable[[], Awaitable[Any]],
+    interval: float,
+    ttl: Optional[float] = None,
+) -> None:
+    """Run ``job`` every ``interval`` seconds on exactly one worker cluster-wide.
+
+    Followers poll for the lease every ``ttl / 3`` seconds. Runs forever; on
+    cancellation the lease is released so another worker can take over.
+    """
+    lease = _leases[name] = Lease(name, ttl)
+    poll = lease.ttl / 3
+    try:
+        while True:
+            delay = poll
+            try:
+                if await lease.acquire():
+                    due = await _last_run(name) + interval - time.time()
+                    if due <= 0:
+                        try:
+                            completed = await _run_while_leader(lease, job)
+                        except Exception as exc:
+                            # A failed pass still waits a full interval
+                            logger.exception("Background job %s failed: %s", name, exc)
+                            completed = True
+                        if completed:
+                            await _mark_run(name, interval)
+                        due = interval
+                    delay = min(poll, due)
+            except Exception as exc:
+                logger.warning("Leader election for %s failed: %s", name, exc)
+            await asyncio.sleep(delay)
+    finally:
+        await lease.release()
+        _leases.pop(name, None)
+
+
+def leadership() -> Dict[str, bool]:
+    """Which periodic jobs this worker currently leads."""
+    return {name: lease.held for name, lease in _leases.items()}
+
+
+gauge(
+    "metabolix_leader",
+    "1 if this worker holds the lease for the background job.",
+    lambda: {labels(job=name): int(held) for name, held in leadership().items()},
+)
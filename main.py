@@ -3,23 +3,97 @@
 import logging
 import os
 import asyncio
-from typing import Optional
+import time
+from contextlib import asynccontextmanager
+from typing import List
 
-from fastapi import FastAPI
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, PlainTextResponse
 from fastapi.middleware.cors import CORSMiddleware
 from dotenv import load_dotenv
 
-from routes import router
-
-from db import db
+from routes import router, process_whatsapp_job
+
+from chat_engine import close_client, get_client
+from db import (
+    close_db,
+    ensure_indexes,
+    get_db,
+    index_report,
+    init_db,
+    migrate_legacy_chats,
+    ping_db,
+)
 from nudge import start_nudge_loop
+from admin_digest import run_admin_digest
+from http_client import close_http, get_session as get_http_session
+import metrics
+from reply_queue import WHATSAPP_ASYNC_REPLIES, start_reply_workers, stop_reply_workers
+from session_store import close_redis, get_redis, init_redis, ping_redis
 
 log_level = os.getenv("LOG_LEVEL", "INFO").upper()
 logging.basicConfig(level=getattr(logging, log_level, logging.INFO))
 logger = logging.getLogger(__name__)
 
 load_dotenv()
-app = FastAPI(title=os.getenv("BOT_NAME", "MetabolixBot"))
+
+READINESS_TIMEOUT = float(os.getenv("READINESS_TIMEOUT", "2"))
+
+_background: List["asyncio.Task[None]"] = []
+
+
+async def _bootstrap_indexes() -> None:
+    try:
+        await ensure_indexes()
+        for collection, report in (await index_report()).items():
+            if report["missing"] or report["undeclared"]:
+                logger.warning("Index drift on %s: %s", collection, report)
+    except Exception as exc:
+        logger.warning("Index bootstrap failed: %s", exc)
+
+
+async def _warm(name: str, ping) -> None:
+    try:
+        await asyncio.wait_for(ping(), timeout=READINESS_TIMEOUT)
+    except Exception as exc:
+        logger.warning("%s warm-up failed: %s", name, exc)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Create and warm client pools, run background tasks, close on shutdown."""
+    init_db()
+    init_redis()
+    get_client()
+    get_http_session()
+    warmups = []
+    if get_db() is not None:
+        warmups.append(_warm("MongoDB", ping_db))
+    if get_redis() is not None:
+        warmups.append(_warm("Redis", ping_redis))
+    await asyncio.gather(*warmups)
+
+    await _bootstrap_indexes()
+    _background.append(asyncio.create_task(migrate_legacy_chats()))
+    _background.append(asyncio.create_task(start_nudge_loop()))
+    _background.append(asyncio.create_task(run_admin_digest()))
+    if WHATSAPP_ASYNC_REPLIES:
+        start_reply_workers(process_whatsapp_job)
+    try:
+        yield
+    finally:
+        await stop_reply_workers()
+        for task in _background:
+            task.cancel()
+        await asyncio.gather(*_background, return_exceptions=True)
+        _background.clear()
+        await close_http()
+        await close_client()
+        await close_redis()
+        close_db()
+
+
+app = FastAPI(title=os.getenv("BOT_NAME", "MetabolixBot"), lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -30,19 +104,66 @@ app.add_middleware(
 )
 
 
+HTTP_REQUEST_SECONDS = metrics.histogram(
+    "metabolix_http_request_seconds", "HTTP request latency in seconds."
+)
+
+
+@app.middleware("http")
+async def record_request_latency(request: Request, call_next):
+    start = time.perf_counter()
+    response = await call_next(request)
+    route = request.scope.get("route")
+    HTTP_REQUEST_SECONDS.observe(
+        time.perf_counter() - start,
+        method=request.method,
+        path=getattr(route, "path", "unmatched"),
+        status=response.status_code,
+    )
+    return response
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics_endpoint() -> PlainTextResponse:
+    """Expose metrics in Prometheus text format."""
+    return PlainTextResponse(await metrics.render(), media_type="text/plain; version=0.0.4")
+
+
 @app.get("/")
 async def health_check() -> dict[str, str]:
     """Simple health check."""
     logger.debug("Health check called")
     return {"status": "ok"}
 
-app.include_router(router)
 
+async def _check(ping) -> str:
+    try:
+        await asyncio.wait_for(ping(), timeout=READINESS_TIMEOUT)
+        return "ok"
+    except asyncio.TimeoutError:
+        return "timeout"
+    except Exception as exc:
+        return f"error: {exc}"
+
+
+@app.get("/ready")
+async def readiness_check() -> JSONResponse:
+    """Ping each configured backing service; 503 if any is unreachable."""
+    names, pings = [], []
+    if get_db() is not None:
+        names.append("mongodb")
+        pings.append(_check(ping_db))
+    if get_redis() is not None:
+        names.append("redis")
+        pings.append(_check(ping_redis))
+    checks = dict(zip(names, await asyncio.gather(*pings)))
+    ready = all(result == "ok" for result in checks.values())
+    return JSONResponse(
+        {"status": "ready" if ready else "unavailable", "checks": checks},
+        status_code=200 if ready else 503,
+    )
 
-@app.on_event("startup")
-async def start_tasks() -> None:
-    """Launch background tasks on startup."""
-    asyncio.create_task(start_nudge_loop())
+app.include_router(router)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,181 @@
+"""Lightweight in-process metrics rendered in Prometheus text format.
+
+Counters and histograms are kept per worker process. ``timed`` and
+``instrument`` record stage latencies into ``metabolix_stage_seconds`` so a
+slow reply can be attributed to OpenAI, Razorpay, Redis or Mongo.
+"""
+
+import functools
+import inspect
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+LabelKey = Tuple[Tuple[str, str], ...]
+
+
+def _label_key(labels: Dict[str, Any]) -> LabelKey:
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _format_labels(key: LabelKey, extra: Optional[Tuple[str, str]] = None) -> str:
+    pairs = list(key) + ([extra] if extra else [])
+    if not pairs:
+        return ""
+    body = ",".join(f'{k}="{v}"' for k, v in pairs)
+    return "{" + body + "}"
+
+
+def _format_value(value: float) -> str:
+    return repr(float(value)) if value != float("inf") else "+Inf"
+
+
+class Counter:
+    def __init__(self, name: str, doc: str) -> None:
+        self.name = name
+        self.doc = doc
+        self._values: Dict[LabelKey, float] = {}
+
+    def inc(self, amount: float = 1.0, **labels: Any) -> None:
+        key = _label_key(labels)
+        self._values[key] = self._values.get(key, 0.0) + amount
+
+    def value(self, **labels: Any) -> float:
+        return self._values.get(_label_key(labels), 0.0)
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.doc}", f"# TYPE {self.name} counter"]
+        for key, value in sorted(self._values.items()):
+            lines.append(f"{self.name}{_format_labels(key)} {_format_value(value)}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, doc: str, buckets: Sequence[float] = DEFAULT_BUCKETS) -> None:
+        self.name = name
+        self.doc = doc
+        self.buckets = tuple(buckets)
+        # label key -> (per-bucket counts, sum, count)
+        self._values: Dict[LabelKey, Tuple[List[int], float, int]] = {}
+
+    def observe(self, value: float, **labels: Any) -> None:
+        key = _label_key(labels)
+        counts, total, count = self._values.get(key) or ([0] * len(self.buckets), 0.0, 0)
+        idx = bisect_left(self.buckets, value)
+        if idx < len(counts):
+            counts[idx] += 1
+        self._values[key] = (counts, total + value, count + 1)
+
+    def count(self, **labels: Any) -> int:
+        item = self._values.get(_label_key(labels))
+        return item[2] if item else 0
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.doc}", f"# TYPE {self.name} histogram"]
+        for key, (counts, total, count) in sorted(self._values.items()):
+            cumulative = 0
+            for bound, n in zip(self.buckets, counts):
+                cumulative += n
+                le = ("le", _format_value(bound))
+                lines.append(f"{self.name}_bucket{_format_labels(key, le)} {cumulative}")
+            lines.append(f"{self.name}_bucket{_format_labels(key, ('le', '+Inf'))} {count}")
+            lines.append(f"{self.name}_sum{_format_labels(key)} {_format_value(total)}")
+            lines.append(f"{self.name}_count{_format_labels(key)} {count}")
+        return lines
+
+
+_metrics: List[Any] = []
+_gauges: List[Tuple[str, str, Callable[[], Dict[LabelKey, float]]]] = []
+
+
+def counter(name: str, doc: str) -> Counter:
+    """Create and register a counter."""
+    metric = Counter(name, doc)
+    _metrics.append(metric)
+    return metric
+
+
+def histogram(name: str, doc: str, buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+    """Create and register a histogram."""
+    metric = Histogram(name, doc, buckets)
+    _metrics.append(metric)
+    return metric
+
+
+def gauge(name: str, doc: str, read: Callable[[], Any]) -> None:
+    """Register a gauge whose value is read at scrape time.
+
+    ``read`` may be a coroutine function and returns either a number or a
+    ``{labels(...): value}`` mapping.
+    """
+    _gauges.append((name, doc, read))
+
+
+def labels(**kwargs: Any) -> LabelKey:
+    return _label_key(kwargs)
+
+
+def stats_gauge(stats: Dict[str, Any], label: str = "stat") -> Dict[LabelKey, float]:
+    """Turn a flat stats dict into gauge samples labelled by key."""
+    return {
+        _label_key({label: k}): v
+        for k, v in stats.items()
+        if isinstance(v, (int, float)) and not isinstance(v, bool)
+    }
+
+
+async def render() -> str:
+    """Render every registered metric in Prometheus text exposition format."""
+    lines: List[str] = []
+    for metric in _metrics:
+        lines.extend(metric.render())
+    for name, doc, read in _gauges:
+        lines += [f"# HELP {name} {doc}", f"# TYPE {name} gauge"]
+        try:
+            value = read()
+            if inspect.isawaitable(value):
+                value = await value
+        except Exception:
+            continue
+        items = value.items() if isinstance(value, dict) else [((), value)]
+        for key, v in sorted(items):
+            lines.append(f"{name}{_format_labels(key)} {_format_value(v)}")
+    return "\n".join(lines) + "\n"
+
+
+STAGE_SECONDS = histogram(
+    "metabolix_stage_seconds", "Latency of instrumented stages in seconds."
+)
+STAGE_ERRORS = counter(
+    "metabolix_stage_errors_total", "Exceptions raised by instrumented stages."
+)
+
+
+@contextmanager
+def timed(stage: str) -> Iterator[None]:
+    """Record the duration of the enclosed block under ``stage``."""
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        STAGE_ERRORS.inc(stage=stage)
+        raise
+    finally:
+        STAGE_SECONDS.observe(time.perf_counter() - start, stage=stage)
+
+
+def instrument(stage: str) -> Callable:
+    """Decorator form of ``timed`` for coroutine functions."""
+
+    def decorator(func: Callable) -> Callable:
+        @functools.wraps(func)
+        async def wrapper(*args: Any, **kwargs: Any) -> Any:
+            with timed(stage):
+                return await func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
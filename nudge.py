@@ -1,9 +1,14 @@
 import asyncio
 import logging
 import os
+import uuid
 from datetime import datetime, timedelta
+from typing import Any, Dict, List
 
-from db import db
+from pymongo import UpdateOne
+
+from db import get_db
+from leader import run_periodic
 from utils import send_whatsapp_message
 
 logger = logging.getLogger(__name__)
@@ -13,50 +18,162 @@ NUDGE_TEXT = os.getenv(
     "NUDGE_TEXT",
     "Hi! We noticed you haven't continued our chat. Complete your order today and get 5% off!",
 )
+NUDGE_INTERVAL_SECONDS = int(os.getenv("NUDGE_INTERVAL_SECONDS", "3600"))
+NUDGE_BATCH_SIZE = int(os.getenv("NUDGE_BATCH_SIZE", "500"))
+NUDGE_CONCURRENCY = int(os.getenv("NUDGE_CONCURRENCY", "10"))
+
+# Only the fields needed to build the message are pulled from Mongo.
+_NUDGE_PROJECTION = {"_id": 1, "phone": 1, "name": 1, "last_activity_at": 1}
+
 
+async def backfill_activity_fields() -> int:
+    """Populate ``last_activity_at``/``last_nudge_at`` for users created before
+    those fields were maintained by ``append_chat``.
 
-async def check_and_nudge() -> None:
-    """Send a nudge message to inactive users."""
+    Returns the number of user documents updated.
+    """
+    db = get_db()
+    if db is None:
+        return 0
+    last_time = {"$dateFromString": {"dateString": {"$last": "$chats.time"}, "onError": None}}
+    legacy_nudge = {"$dateFromString": {"dateString": "$last_nudge", "onError": None, "onNull": None}}
+    res = await db.users.update_many(
+        {"last_activity_at": {"$exists": False}, "chats.0": {"$exists": True}},
+        [
+            {"$set": {"last_activity_at": last_time}},
+            {
+                "$set": {
+                    "last_nudge_at": {
+                        "$cond": [
+                            {"$gte": [legacy_nudge, "$last_activity_at"]},
+                            legacy_nudge,
+                            None,
+                        ]
+                    }
+                }
+            },
+        ],
+    )
+    if res.modified_count:
+        logger.info("Backfilled nudge fields for %s users", res.modified_count)
+    return res.modified_count
+
+
+async def _claim(batch: List[Dict[str, Any]], now: datetime) -> List[Dict[str, Any]]:
+    """Stamp ``batch`` as nudged before sending; returns the users claimed.
+
+    Each stamp only applies while the user is still due and has not replied
+    since they were read, so a pass rerun after a leader failover skips users
+    already claimed. The stamps carry a per-pass token so one ``find`` tells
+    which of them applied.
+    """
+    db = get_db()
+    token = uuid.uuid4().hex
+    ops = [
+        UpdateOne(
+            {
+                "_id": user["_id"],
+                "last_nudge_at": None,
+                "last_activity_at": user.get("last_activity_at"),
+            },
+            {"$set": {"last_nudge_at": now, "last_nudge": now.isoformat(), "nudge_claim": token}},
+        )
+        for user in batch
+        if user.get("phone")
+    ]
+    if not ops:
+        return []
+    await db.users.bulk_write(ops, ordered=False)
+    claimed = {
+        doc["_id"]
+        async for doc in db.users.find(
+            {"_id": {"$in": [user["_id"] for user in batch]}, "nudge_claim": token}, {"_id": 1}
+        )
+    }
+    return [user for user in batch if user["_id"] in claimed]
+
+
+async def _send_nudge(user: Dict[str, Any], semaphore: asyncio.Semaphore) -> bool:
+    phone = user["phone"]
+    name = user.get("name") or "there"
+    async with semaphore:
+        try:
+            await send_whatsapp_message(phone, f"Hi {name}! {NUDGE_TEXT}")
+        except Exception as exc:
+            logger.warning("Failed to nudge %s: %s", phone, exc)
+            return False
+    logger.info("Sent nudge to %s", phone)
+    return True
+
+
+async def _nudge_batch(batch: List[Dict[str, Any]], semaphore: asyncio.Semaphore) -> int:
+    # Mongo stores milliseconds; truncate so the unclaim below can match the stamp
+    now = datetime.utcnow()
+    now = now.replace(microsecond=now.microsecond // 1000 * 1000)
+    claimed = await _claim(batch, now)
+    results = await asyncio.gather(*(_send_nudge(u, semaphore) for u in claimed))
+    failed = [user["_id"] for user, sent in zip(claimed, results) if not sent]
+    if failed:
+        # Only undo our own stamp; a reply in the meantime has already cleared it
+        await get_db().users.update_many(
+            {"_id": {"$in": failed}, "last_nudge_at": now},
+            {"$set": {"last_nudge_at": None}},
+        )
+    return len(claimed) - len(failed)
+
+
+async def check_and_nudge() -> int:
+    """Send a nudge message to inactive users.
+
+    ``append_chat`` keeps ``last_activity_at`` current and clears
+    ``last_nudge_at``, so due users are exactly those with no nudge since
+    their last activity and an activity older than the cutoff. Returns the
+    number of users nudged.
+    """
+    db = get_db()
     if db is None:
         logger.debug("Database not configured; skipping nudge check")
-        return
+        return 0
 
     cutoff = datetime.utcnow() - timedelta(hours=NUDGE_HOURS)
-    async for user in db.users.find({"chats": {"$ne": []}}):
-        last_chat = user.get("chats", [])[-1]
-        if not last_chat:
-            continue
-        try:
-            last_time = datetime.fromisoformat(last_chat.get("time"))
-        except Exception:
-            continue
-        last_nudge_time = user.get("last_nudge")
-        if last_nudge_time:
-            try:
-                last_nudge = datetime.fromisoformat(last_nudge_time)
-            except Exception:
-                last_nudge = None
-        else:
-            last_nudge = None
-        if last_time < cutoff and (not last_nudge or last_nudge < last_time):
-            phone = user.get("phone")
-            if phone:
-                name = user.get("name", "there")
-                text = f"Hi {name}! {NUDGE_TEXT}"
-                await send_whatsapp_message(phone, text)
-                await db.users.update_one(
-                    {"_id": user["_id"]},
-                    {"$set": {"last_nudge": datetime.utcnow().isoformat()}},
-                )
-                logger.info("Sent nudge to %s", phone)
+    cursor = db.users.find(
+        {"last_nudge_at": None, "last_activity_at": {"$lt": cutoff}},
+        _NUDGE_PROJECTION,
+        batch_size=NUDGE_BATCH_SIZE,
+    )
+    semaphore = asyncio.Semaphore(NUDGE_CONCURRENCY)
+    sent = 0
+    batch: List[Dict[str, Any]] = []
+    async for user in cursor:
+        batch.append(user)
+        if len(batch) >= NUDGE_BATCH_SIZE:
+            sent += await _nudge_batch(batch, semaphore)
+            batch = []
+    if batch:
+        sent += await _nudge_batch(batch, semaphore)
+    if sent:
+        logger.info("Nudge pass complete: %s users nudged", sent)
+    return sent
 
 
-async def start_nudge_loop() -> None:
-    """Background loop to periodically nudge inactive users."""
-    while True:
+_backfilled = False
+
+
+async def _nudge_pass() -> None:
+    global _backfilled
+    if not _backfilled:
         try:
-            await check_and_nudge()
+            await backfill_activity_fields()
         except Exception as exc:
-            logger.exception("Nudge check failed: %s", exc)
-        await asyncio.sleep(3600)
+            logger.exception("Nudge setup failed: %s", exc)
+        _backfilled = True
+    await check_and_nudge()
+
+
+async def start_nudge_loop() -> None:
+    """Background loop to periodically nudge inactive users.
 
+    Runs in every worker, but ``run_periodic`` elects a single leader through
+    Redis so each pass happens once cluster-wide.
+    """
+    await run_periodic("nudge", _nudge_pass, NUDGE_INTERVAL_SECONDS)
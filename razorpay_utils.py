@@ -1,19 +1,63 @@
 """Razorpay integration for payment links."""
 
+import asyncio
+import json
 import logging
 import os
-from typing import Any, Dict, Optional
+import time
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional
 from dotenv import load_dotenv
 
 import razorpay
-import asyncio
+
+from db import delete_payment_event, insert_payment_event
+from http_client import request_json
+from metrics import counter, gauge, instrument, stats_gauge
+from session_store import get_redis
+from utils import LRUCache
 
 load_dotenv()
-CLIENT = razorpay.Client(
-    auth=(os.getenv("RAZORPAY_KEY_ID"), os.getenv("RAZORPAY_KEY_SECRET"))
-)
+RAZORPAY_KEY_ID = os.getenv("RAZORPAY_KEY_ID")
+RAZORPAY_KEY_SECRET = os.getenv("RAZORPAY_KEY_SECRET")
+RAZORPAY_API_BASE = os.getenv("RAZORPAY_API_BASE", "https://api.razorpay.com/v1")
+
+# The SDK client is only used for local webhook signature verification;
+# API calls go through the shared async HTTP pool.
+_sdk_client: Optional[razorpay.Client] = None
 logger = logging.getLogger(__name__)
 
+# Links expire so stale pending entries stop being polled
+PAYMENT_LINK_EXPIRY_HOURS = int(os.getenv("PAYMENT_LINK_EXPIRY_HOURS", "48"))
+PAYMENT_STATUS_TTL = int(os.getenv("PAYMENT_STATUS_TTL", "60"))
+# Razorpay retries failed deliveries for about a day
+PAYMENT_EVENT_TTL = int(os.getenv("PAYMENT_EVENT_TTL", str(3 * 24 * 3600)))
+# Created links are remembered briefly so a repeated ask reuses the same link
+PAYMENT_LINK_CACHE_TTL = int(os.getenv("PAYMENT_LINK_CACHE_TTL", "900"))
+# Pending links closer than this to expiry are not handed out again
+PAYMENT_LINK_MIN_REMAINING_HOURS = float(os.getenv("PAYMENT_LINK_MIN_REMAINING_HOURS", "1"))
+
+# link_id -> paid info, or {} when the link was still unpaid at last check
+_status_cache: LRUCache[Dict[str, Any]] = LRUCache(10000, ttl=PAYMENT_STATUS_TTL)
+gauge(
+    "metabolix_payment_status_cache",
+    "Payment link status cache size and hit/miss counts.",
+    lambda: stats_gauge(_status_cache.stats()),
+)
+
+WEBHOOK_EVENTS = counter(
+    "metabolix_payment_webhook_events_total", "Payment webhook deliveries, by outcome."
+)
+
+# phone -> {"amount:description": link}; only used without Redis, which is
+# shared by every worker and so sees links forgotten elsewhere once paid
+_link_cache: LRUCache[Dict[str, Dict[str, str]]] = LRUCache(10000, ttl=PAYMENT_LINK_CACHE_TTL)
+_link_inflight: Dict[str, "asyncio.Task[Dict[str, str]]"] = {}
+PAYMENT_LINKS = counter(
+    "metabolix_payment_links_total", "Payment links handed out, by source."
+)
+
+@instrument("razorpay.create_payment_link")
 async def create_payment_link(amount: int, description: str, phone: str) -> Dict[str, str]:
     """Create a payment link and return its id and short URL."""
     data = {
@@ -21,38 +65,229 @@ async def create_payment_link(amount: int, description: str, phone: str) -> Dict
         "currency": "INR",
         "description": description,
         "customer": {"contact": phone},
+        "expire_by": int(time.time()) + PAYMENT_LINK_EXPIRY_HOURS * 3600,
     }
     logger.info("Creating payment link for amount %s to %s", amount, phone)
-    link = await asyncio.to_thread(CLIENT.payment_link.create, data)
+    link = await request_json(
+        "POST",
+        f"{RAZORPAY_API_BASE}/payment_links",
+        auth=(RAZORPAY_KEY_ID, RAZORPAY_KEY_SECRET),
+        json=data,
+    )
     result = {"id": link.get("id"), "url": link.get("short_url")}
     logger.info("Payment link created: %s", result["url"])
     return result
 
 
+def _link_field(amount: int, description: str) -> str:
+    return f"{amount}:{description}"
+
+
+def _is_paid(link_id: Optional[str]) -> bool:
+    return bool(link_id and _status_cache.get(link_id))
+
+
+def _reusable_pending(
+    pending: List[Dict[str, Any]], amount: int, description: str
+) -> Optional[Dict[str, str]]:
+    """Newest pending link for the same amount and description with time left."""
+    cutoff = (
+        datetime.utcnow()
+        - timedelta(hours=PAYMENT_LINK_EXPIRY_HOURS - PAYMENT_LINK_MIN_REMAINING_HOURS)
+    ).isoformat()
+    for p in reversed(pending):
+        if (
+            p.get("status") == "pending"
+            and p.get("link_id")
+            and p.get("amount") == amount
+            and p.get("description") == description
+            and p.get("time", "") >= cutoff
+            and not _is_paid(p["link_id"])
+        ):
+            return {"id": p["link_id"], "url": p["link"]}
+    return None
+
+
+async def _cached_link(phone: str, field: str) -> Optional[Dict[str, str]]:
+    redis = get_redis()
+    if redis:
+        try:
+            raw = await redis.hget(f"payment_links:{phone}", field)
+        except Exception as exc:
+            logger.warning("Payment link cache read failed: %s", exc)
+            raw = None
+        link = json.loads(raw) if raw else None
+    else:
+        link = (_link_cache.get(phone) or {}).get(field)
+    if link is None or _is_paid(link.get("id")):
+        return None
+    return link
+
+
+async def _remember_link(phone: str, field: str, link: Dict[str, str]) -> None:
+    redis = get_redis()
+    if redis:
+        key = f"payment_links:{phone}"
+        try:
+            async with redis.pipeline(transaction=True) as pipe:
+                pipe.hset(key, field, json.dumps(link))
+                pipe.expire(key, PAYMENT_LINK_CACHE_TTL)
+                await pipe.execute()
+        except Exception as exc:
+            logger.warning("Payment link cache write failed: %s", exc)
+    else:
+        _link_cache.set(phone, {**(_link_cache.get(phone) or {}), field: link})
+
+
+async def forget_payment_links(phone: str) -> None:
+    """Drop cached links for ``phone``, e.g. once one of them is paid."""
+    _link_cache.pop(phone)
+    redis = get_redis()
+    if redis:
+        try:
+            await redis.delete(f"payment_links:{phone}")
+        except Exception as exc:
+            logger.warning("Payment link cache delete failed: %s", exc)
+
+
+async def _new_link(amount: int, description: str, phone: str, field: str) -> Dict[str, str]:
+    link = await create_payment_link(amount, description, phone)
+    await _remember_link(phone, field, link)
+    PAYMENT_LINKS.inc(source="created")
+    return link
+
+
+async def get_payment_link(
+    amount: int,
+    description: str,
+    phone: Optional[str],
+    pending: Optional[List[Dict[str, Any]]] = None,
+) -> Dict[str, str]:
+    """Return a payment link, reusing one when possible.
+
+    In order: an unpaid pending link from ``pending`` with the same amount and
+    description and at least ``PAYMENT_LINK_MIN_REMAINING_HOURS`` left, a link
+    created for the same request within ``PAYMENT_LINK_CACHE_TTL``, or a new
+    link. Concurrent calls for the same request share one Razorpay call.
+    Without a phone there is nothing to tie a link to its user, so a fresh
+    link is always created and never cached.
+    """
+    if not phone:
+        PAYMENT_LINKS.inc(source="created")
+        return await create_payment_link(amount, description, phone)
+    link = _reusable_pending(pending or [], amount, description)
+    if link:
+        PAYMENT_LINKS.inc(source="pending")
+        return link
+    field = _link_field(amount, description)
+    link = await _cached_link(phone, field)
+    if link:
+        PAYMENT_LINKS.inc(source="cache")
+        return link
+    key = f"{phone}:{field}"
+    task = _link_inflight.get(key)
+    if task is None:
+        task = asyncio.ensure_future(_new_link(amount, description, phone, field))
+        _link_inflight[key] = task
+        task.add_done_callback(lambda _: _link_inflight.pop(key, None))
+    else:
+        PAYMENT_LINKS.inc(source="coalesced")
+    return await asyncio.shield(task)
+
+
+@instrument("razorpay.fetch_payment_link")
 async def fetch_payment_link(link_id: str) -> Dict[str, Any]:
     """Fetch payment link details from Razorpay."""
-    return await asyncio.to_thread(CLIENT.payment_link.fetch, link_id)
+    return await request_json(
+        "GET",
+        f"{RAZORPAY_API_BASE}/payment_links/{link_id}",
+        auth=(RAZORPAY_KEY_ID, RAZORPAY_KEY_SECRET),
+    )
+
+
+def cache_payment_status(link_id: str, info: Optional[Dict[str, Any]]) -> None:
+    """Record a link's status, e.g. from the payment webhook."""
+    _status_cache.set(link_id, info or {})
 
 
 async def is_payment_complete(link_id: str) -> Optional[Dict[str, Any]]:
-    """Check if a payment link is paid and return info if so."""
+    """Check if a payment link is paid and return info if so.
+
+    Results are cached for ``PAYMENT_STATUS_TTL`` seconds per link so repeated
+    messages do not re-poll Razorpay.
+    """
+    cached = _status_cache.get(link_id)
+    if cached is not None:
+        return cached or None
     data = await fetch_payment_link(link_id)
+    info = None
     if data.get("status") == "paid":
-        return {
+        info = {
             "payment_id": data.get("payment_id"),
             "amount": data.get("amount", 0) / 100,
         }
-    return None
+    cache_payment_status(link_id, info)
+    return info
+
+
+def _client() -> razorpay.Client:
+    global _sdk_client
+    if _sdk_client is None:
+        _sdk_client = razorpay.Client(auth=(RAZORPAY_KEY_ID, RAZORPAY_KEY_SECRET))
+    return _sdk_client
 
 
 def verify_signature(body: bytes, signature: str) -> bool:
     try:
-        CLIENT.utility.verify_webhook_signature(
-            body, signature, os.getenv("RAZORPAY_WEBHOOK_SECRET")
+        # The SDK encodes the body itself and rejects raw bytes
+        _client().utility.verify_webhook_signature(
+            body.decode("utf-8"), signature, os.getenv("RAZORPAY_WEBHOOK_SECRET")
         )
         logger.debug("Payment webhook signature valid")
         return True
-    except razorpay.errors.SignatureVerificationError:
+    except (razorpay.errors.SignatureVerificationError, UnicodeDecodeError):
         logger.warning("Invalid payment webhook signature")
         return False
 
+
+
+def payment_event_key(event: str, entity: Dict[str, Any]) -> str:
+    """Dedup key for a webhook: one per payment and status.
+
+    ``payment.captured`` and ``payment_link.paid`` for the same payment share
+    a key, so either one confirms the payment exactly once.
+    """
+    return f"{entity.get('id')}:{entity.get('status') or event}"
+
+
+async def claim_payment_event(event: Dict[str, Any]) -> bool:
+    """Record a webhook event; False if it was already processed.
+
+    A Redis ``SET NX`` answers most redeliveries without touching Mongo; the
+    unique ``event_key`` index on ``payment_events`` is the durable check.
+    """
+    key = event["event_key"]
+    redis = get_redis()
+    if redis and not await redis.set(f"payment_event:{key}", 1, nx=True, ex=PAYMENT_EVENT_TTL):
+        WEBHOOK_EVENTS.inc(outcome="duplicate")
+        return False
+    try:
+        inserted = await insert_payment_event(event)
+    except Exception:
+        # Leave the Redis key in place and every retry would be a "duplicate"
+        if redis:
+            await redis.delete(f"payment_event:{key}")
+        raise
+    if not inserted:
+        WEBHOOK_EVENTS.inc(outcome="duplicate")
+        return False
+    WEBHOOK_EVENTS.inc(outcome="new")
+    return True
+
+
+async def release_payment_event(key: str) -> None:
+    """Undo a claim after a failure so Razorpay's retry is processed."""
+    redis = get_redis()
+    if redis:
+        await redis.delete(f"payment_event:{key}")
+    await delete_payment_event(key)
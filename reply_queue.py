@@ -0,0 +1,134 @@
+"""Background queue for answering WhatsApp messages out-of-band.
+
+When ``WHATSAPP_ASYNC_REPLIES`` is enabled the webhook only enqueues the
+inbound message and acknowledges Twilio; a pool of workers runs the turn and
+sends the reply through the Twilio REST API. Jobs go through a Redis list so
+any worker process can pick them up, falling back to an in-process queue.
+"""
+
+import asyncio
+import json
+import logging
+import os
+import time
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, Dict, List, Optional
+
+from metrics import gauge, stats_gauge
+from session_store import get_redis
+
+logger = logging.getLogger(__name__)
+
+WHATSAPP_ASYNC_REPLIES = os.getenv("WHATSAPP_ASYNC_REPLIES", "false").lower() == "true"
+REPLY_WORKERS = int(os.getenv("REPLY_WORKERS", "8"))
+REPLY_QUEUE_KEY = os.getenv("REPLY_QUEUE_KEY", "whatsapp:reply-queue")
+
+Job = Dict[str, Any]
+
+_local_queue: "Optional[asyncio.Queue[Job]]" = None
+_workers: List["asyncio.Task[None]"] = []
+_latencies: Deque[float] = deque(maxlen=1000)
+_processed = 0
+_failed = 0
+
+
+def _queue() -> "asyncio.Queue[Job]":
+    global _local_queue
+    if _local_queue is None:
+        _local_queue = asyncio.Queue()
+    return _local_queue
+
+
+async def enqueue_reply(job: Job) -> None:
+    """Queue an inbound message for a reply worker."""
+    job = {**job, "enqueued_at": time.time()}
+    redis = get_redis()
+    if redis:
+        await redis.lpush(REPLY_QUEUE_KEY, json.dumps(job))
+    else:
+        _queue().put_nowait(job)
+
+
+async def _next_job() -> Optional[Job]:
+    redis = get_redis()
+    if redis:
+        item = await redis.brpop(REPLY_QUEUE_KEY, timeout=1)
+        if not item:
+            return None
+        try:
+            return json.loads(item[1])
+        except json.JSONDecodeError:
+            logger.warning("Dropping malformed reply job: %s", item[1])
+            return None
+    return await _queue().get()
+
+
+async def _worker(handler: Callable[[Job], Awaitable[None]]) -> None:
+    global _processed, _failed
+    while True:
+        try:
+            job = await _next_job()
+        except asyncio.CancelledError:
+            raise
+        except Exception as exc:
+            logger.warning("Reply queue read failed: %s", exc)
+            await asyncio.sleep(1)
+            continue
+        if job is None:
+            continue
+        try:
+            await handler(job)
+            _processed += 1
+        except Exception as exc:
+            _failed += 1
+            logger.exception("Reply job failed: %s", exc)
+        _latencies.append(time.time() - job.get("enqueued_at", time.time()))
+
+
+def start_reply_workers(handler: Callable[[Job], Awaitable[None]], count: int = REPLY_WORKERS) -> None:
+    """Spawn ``count`` worker tasks that feed queued jobs to ``handler``."""
+    for _ in range(count):
+        _workers.append(asyncio.create_task(_worker(handler)))
+    logger.info("Started %s WhatsApp reply workers", count)
+
+
+async def stop_reply_workers() -> None:
+    """Cancel running worker tasks."""
+    for task in _workers:
+        task.cancel()
+    await asyncio.gather(*_workers, return_exceptions=True)
+    _workers.clear()
+
+
+def _percentile(values: List[float], pct: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(pct * len(ordered)))]
+
+
+async def reply_queue_stats() -> Dict[str, Any]:
+    """Return queue depth and end-to-end latency over recent jobs."""
+    redis = get_redis()
+    if redis:
+        depth = await redis.llen(REPLY_QUEUE_KEY)
+    else:
+        depth = _queue().qsize()
+    recent = list(_latencies)
+    return {
+        "enabled": WHATSAPP_ASYNC_REPLIES,
+        "workers": len(_workers),
+        "depth": depth,
+        "processed": _processed,
+        "failed": _failed,
+        "latency_p50": _percentile(recent, 0.50),
+        "latency_p95": _percentile(recent, 0.95),
+        "latency_max": max(recent, default=0.0),
+    }
+
+
+async def _queue_gauge() -> Dict[Any, float]:
+    return stats_gauge(await reply_queue_stats())
+
+
+gauge("metabolix_reply_queue", "Async reply queue depth, counts and latency.", _queue_gauge)
@@ -1,23 +1,37 @@
 """FastAPI route handlers for the Metabolix chatbot."""
 
+import hmac
+import json
 import logging
+import os
 import asyncio
-from typing import Optional
-from fastapi import APIRouter, HTTPException, Request, status
-from fastapi.responses import Response
-
-from chat_engine import generate_response, PAYMENT_PLACEHOLDER
+from contextlib import aclosing
+from datetime import datetime, timedelta
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional, Tuple, Type
+from fastapi import APIRouter, BackgroundTasks, HTTPException, Request, status
+from fastapi.responses import Response, StreamingResponse
+from pydantic import BaseModel, ValidationError
+
+from chat_engine import (
+    FALLBACK_REPLY,
+    OPENAI_DEADLINE,
+    PAYMENT_PLACEHOLDER,
+    generate_response,
+    payment_link_likely,
+    stream_response,
+)
 from db import (
+    UnitOfWork,
     save_user,
     save_chat,
     save_summary,
-    get_user_by_phone,
-    update_user_language,
-    append_chat,
-    record_payment,
-    mark_payment_paid,
+    get_turn_context,
+    get_conversation_summary,
+    get_pending_payments,
     save_order,
+    save_orders,
     save_appointment,
+    save_appointments,
 )
 from schemas import (
     Consent,
@@ -29,45 +43,98 @@ from schemas import (
     OrderRequest,
     AppointmentRequest,
 )
-from utils import timestamp, detect_language, send_whatsapp_message, notify_admin
+from utils import (
+    timestamp,
+    detect_language,
+    language_changed,
+    send_whatsapp_message,
+)
 from razorpay_utils import (
-    create_payment_link,
+    PAYMENT_LINK_EXPIRY_HOURS,
+    forget_payment_links,
+    get_payment_link,
     verify_signature,
     is_payment_complete,
+    cache_payment_status,
+    claim_payment_event,
+    payment_event_key,
+    release_payment_event,
 )
-from session_store import get_session, save_session
+from admin_digest import queue_admin_alert
+from catalog import answer_catalog_question
+from context import build_context, conversation_offset, schedule_summary
+from export import FIELDS as EXPORT_FIELDS, export_rows, render as render_export
+from session_store import get_session, append_session
+from sender_turns import run_coalesced
+from reply_queue import WHATSAPP_ASYNC_REPLIES, enqueue_reply, reply_queue_stats
 from twilio.twiml.messaging_response import MessagingResponse
+from metrics import instrument
 
 logger = logging.getLogger(__name__)
 
 router = APIRouter()
 
-
-async def confirm_pending_payment(phone: str) -> Optional[str]:
-    """Check if user has a pending payment that is now paid."""
-    user = await get_user_by_phone(phone)
-    if not user:
+# Payment link offered when the WhatsApp bot's reply asks for payment
+CHAT_CONSULT_AMOUNT = 99
+CHAT_CONSULT_DESCRIPTION = "Metabolix consult"
+# Leaves the OpenAI retry loop room to finish before the turn gives up
+REPLY_TIMEOUT = OPENAI_DEADLINE + 5
+
+
+@instrument("payments.confirm_pending")
+async def confirm_pending_payment(
+    phone: str,
+    pending: Optional[List[Dict[str, Any]]] = None,
+    uow: Optional[UnitOfWork] = None,
+) -> Optional[str]:
+    """Check if user has a pending payment that is now paid.
+
+    The payment webhook marks links paid as they are settled, so in the
+    common case there is nothing pending and no Razorpay call is made. Links
+    older than ``PAYMENT_LINK_EXPIRY_HOURS`` are expired instead of polled and
+    the remaining ones are checked concurrently. When a ``uow`` is passed the
+    resulting writes are left for the caller to flush.
+    """
+    if pending is None:
+        pending = await get_pending_payments(phone)
+    if not pending:
         return None
-    payments = user.get("payments", [])
-    for p in reversed(payments):
-        if p.get("status") == "pending" and p.get("link_id"):
-            info = await is_payment_complete(p["link_id"])
-            if info:
-                await mark_payment_paid(phone, p["link_id"], info["payment_id"])
-                await record_payment(
-                    phone,
-                    {
-                        "payment_id": info["payment_id"],
-                        "amount": info["amount"],
-                        "status": "paid",
-                        "time": timestamp(),
-                    },
-                )
-                msg = (
-                    f"Payment confirmed. Transaction ID: {info['payment_id']}. "
-                    "A doctor will reach you within 24 hours."
-                )
-                return msg
+    own_uow = uow is None
+    if own_uow:
+        uow = UnitOfWork(phone)
+    cutoff = (datetime.utcnow() - timedelta(hours=PAYMENT_LINK_EXPIRY_HOURS)).isoformat()
+    live = [p for p in pending if p.get("link_id") and p.get("time", "") >= cutoff]
+    if len(live) < len(pending):
+        uow.expire_pending_payments(cutoff)
+
+    results = await asyncio.gather(
+        *(is_payment_complete(p["link_id"]) for p in live), return_exceptions=True
+    )
+    confirmed = None
+    for p, info in zip(live, results):
+        if isinstance(info, Exception):
+            logger.warning("Payment status check failed for %s: %s", p["link_id"], info)
+            continue
+        if not info:
+            continue
+        uow.mark_payment_paid(p["link_id"], info["payment_id"])
+        uow.record_payment(
+            {
+                "payment_id": info["payment_id"],
+                "amount": info["amount"],
+                "status": "paid",
+                "time": timestamp(),
+            }
+        )
+        confirmed = info
+    if own_uow:
+        await uow.flush()
+    if confirmed:
+        await forget_payment_links(phone)
+        return (
+            f"Payment confirmed. Transaction ID: {confirmed['payment_id']}. "
+            "A doctor will reach you within 24 hours."
+        )
     return None
 
 
@@ -91,28 +158,75 @@ async def triage(symptom: SymptomData):
     return {"reply": reply}
 
 
+def _sse(data: Dict[str, Any], event: Optional[str] = None) -> str:
+    prefix = f"event: {event}\n" if event else ""
+    return f"{prefix}data: {json.dumps(data)}\n\n"
+
+
+@router.post("/triage/stream")
+async def triage_stream(symptom: SymptomData):
+    """Stream the triage reply as server-sent events.
+
+    Sends ``{"delta": ...}`` events as tokens arrive, then a ``done`` event
+    with the full reply. The turn is saved only once the reply is complete;
+    if the client disconnects first, the generator is cancelled and closing
+    ``stream_response`` closes the upstream OpenAI request.
+    """
+    logger.debug("Streaming triage request: %s", symptom.description)
+    messages = [{"role": "user", "content": symptom.description}]
+
+    async def events() -> AsyncIterator[str]:
+        parts: List[str] = []
+        try:
+            async with aclosing(stream_response(messages)) as deltas:
+                async for delta in deltas:
+                    parts.append(delta)
+                    yield _sse({"delta": delta})
+        except Exception as exc:
+            logger.exception("Streaming triage failed: %s", exc)
+            yield _sse({"error": FALLBACK_REPLY}, "error")
+            return
+        reply = "".join(parts).strip()
+        await save_chat({"input": symptom.description, "output": reply, "time": timestamp()})
+        yield _sse({"reply": reply}, "done")
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
 @router.post("/consult")
 async def consult(payload: ConsultRequest, consult_type: str = "audio"):
     logger.info("Consult requested type=%s", consult_type)
+    # The payment is recorded against the phone; without one it would be dropped
+    if not payload.user.phone:
+        raise HTTPException(status_code=422, detail="Phone number required")
     amount = 99 if consult_type == "audio" else 249
-    link = await create_payment_link(amount, f"Metabolix {consult_type} consult", payload.user.phone)
-    await save_chat({
+    description = f"Metabolix {consult_type} consult"
+    user = await get_turn_context(payload.user.phone)
+    link = await get_payment_link(amount, description, payload.user.phone, user.get("payments"))
+    uow = UnitOfWork(payload.user.phone)
+    uow.save_chat({
         "user": payload.user.dict(),
         "symptoms": payload.symptoms.dict(),
         "consult_type": consult_type,
         "requested_at": timestamp(),
         "payment_link": link["url"],
     })
-    await record_payment(
-        payload.user.phone,
-        {
-            "amount": amount,
-            "link": link["url"],
-            "link_id": link["id"],
-            "status": "pending",
-            "time": timestamp(),
-        },
-    )
+    if link["id"] not in (user.get("payment_link_ids") or []):
+        uow.record_payment(
+            {
+                "amount": amount,
+                "description": description,
+                "link": link["url"],
+                "link_id": link["id"],
+                "status": "pending",
+                "time": timestamp(),
+            },
+        )
+    await uow.flush()
     return {"payment_link": link["url"]}
 
 
@@ -120,7 +234,7 @@ async def consult(payload: ConsultRequest, consult_type: str = "audio"):
 async def create_order(order: OrderRequest):
     """Record a product order and notify the admin."""
     await save_order(order.dict())
-    await notify_admin(
+    await queue_admin_alert(
         f"New order for {order.product} x{order.quantity} from {order.user.name} ({order.user.phone})"
     )
     return {"status": "received"}
@@ -130,82 +244,257 @@ async def create_order(order: OrderRequest):
 async def create_appointment(appt: AppointmentRequest):
     """Record an appointment request and notify the admin."""
     await save_appointment(appt.dict())
-    await notify_admin(
+    await queue_admin_alert(
         f"New appointment on {appt.datetime} from {appt.user.name} ({appt.user.phone})"
     )
     return {"status": "booked"}
 
 
-@router.post("/whatsapp")
-async def whatsapp_webhook(request: Request):
-    logger.debug("Webhook triggered")
+BATCH_INSERT_CHUNK = int(os.getenv("BATCH_INSERT_CHUNK", "500"))
+
+
+async def _ndjson_lines(request: Request) -> AsyncIterator[Tuple[int, bytes]]:
+    """Yield ``(line_number, line)`` for each non-blank line of the body as it streams in."""
+    buffer = b""
+    number = 0
+    async for chunk in request.stream():
+        buffer += chunk
+        *lines, buffer = buffer.split(b"\n")
+        for line in lines:
+            number += 1
+            if line.strip():
+                yield number, line
+    if buffer.strip():
+        yield number + 1, buffer
+
+
+async def _ingest_ndjson(
+    request: Request,
+    model: Type[BaseModel],
+    save: Callable[[List[Dict[str, Any]]], Awaitable[Dict[int, str]]],
+) -> Dict[str, Any]:
+    """Validate NDJSON rows against ``model`` and insert them in chunks."""
+    received = inserted = 0
+    errors: List[Dict[str, Any]] = []
+    chunk: List[Tuple[int, Dict[str, Any]]] = []
+
+    async def flush() -> None:
+        nonlocal inserted
+        failed = await save([doc for _, doc in chunk])
+        inserted += len(chunk) - len(failed)
+        errors.extend({"line": chunk[i][0], "error": msg} for i, msg in failed.items())
+        chunk.clear()
+
+    async for number, line in _ndjson_lines(request):
+        received += 1
+        try:
+            chunk.append((number, model(**json.loads(line)).dict()))
+        except (ValueError, TypeError, ValidationError) as exc:
+            errors.append({"line": number, "error": str(exc)})
+            continue
+        if len(chunk) >= BATCH_INSERT_CHUNK:
+            await flush()
+    if chunk:
+        await flush()
+    errors.sort(key=lambda e: e["line"])
+    return {"received": received, "inserted": inserted, "failed": len(errors), "errors": errors}
+
+
+@router.post("/orders/batch")
+async def create_orders_batch(request: Request):
+    """Import orders from an NDJSON body, one ``OrderRequest`` per line."""
+    result = await _ingest_ndjson(request, OrderRequest, save_orders)
+    if result["received"]:
+        await queue_admin_alert(
+            f"Batch import: {result['inserted']} orders saved, {result['failed']} rejected"
+        )
+    return result
+
+
+@router.post("/appointments/batch")
+async def create_appointments_batch(request: Request):
+    """Import appointment requests from an NDJSON body, one ``AppointmentRequest`` per line."""
+    result = await _ingest_ndjson(request, AppointmentRequest, save_appointments)
+    if result["received"]:
+        await queue_admin_alert(
+            f"Batch import: {result['inserted']} appointments saved, {result['failed']} rejected"
+        )
+    return result
+
+
+EXPORT_TOKEN = os.getenv("EXPORT_TOKEN")
+
+
+@router.get("/export/{kind}")
+async def export_records(
+    kind: str,
+    request: Request,
+    format: str = "ndjson",
+    phone: Optional[str] = None,
+    since: Optional[str] = None,
+    until: Optional[str] = None,
+    after: Optional[str] = None,
+):
+    """Stream chats, orders, appointments or payments as NDJSON or CSV.
+
+    Disabled unless ``EXPORT_TOKEN`` is set; callers send it as a bearer token.
+    """
+    supplied = request.headers.get("Authorization", "").encode()
+    if not EXPORT_TOKEN or not hmac.compare_digest(supplied, f"Bearer {EXPORT_TOKEN}".encode()):
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Export not permitted")
+    if kind not in EXPORT_FIELDS:
+        raise HTTPException(status_code=404, detail=f"Unknown export {kind!r}")
+    if format not in ("ndjson", "csv"):
+        raise HTTPException(status_code=400, detail="format must be ndjson or csv")
     try:
-        form = await request.form()
-        sender = form["From"].split(":")[-1]  # Extract phone
-        message = form["Body"].strip()
-        num_media = int(form.get("NumMedia", 0))
+        rows = export_rows(kind, phone, since, until, after)
+    except ValueError as exc:
+        raise HTTPException(status_code=400, detail=str(exc))
+    media_type = "text/csv" if format == "csv" else "application/x-ndjson"
+    return StreamingResponse(render_export(kind, rows, format), media_type=media_type)
 
-        language = detect_language(message)
-        try:
-            await update_user_language(sender, language)
-        except RuntimeError:
-            pass
-
-        session = await get_session(sender)
-        if not session:
-            user = await get_user_by_phone(sender)
-            if user:
-                meta = (
-                    f"Returning user details: name={user.get('name')}, "
-                    f"age={user.get('age')}, gender={user.get('gender')}, "
-                    f"pin={user.get('pin')}"
-                )
-                session.append({"role": "system", "content": meta})
 
-        session.append({"role": "user", "content": message or "<media>"})
+def _log_link_failure(task: "asyncio.Future[Dict[str, str]]") -> None:
+    # Speculative links may never be awaited; don't leave their errors unretrieved
+    if not task.cancelled() and task.exception() is not None:
+        logger.warning("Payment link creation failed: %s", task.exception())
 
-        confirmation = await confirm_pending_payment(sender)
 
-        if num_media > 0 and confirmation:
-            session.append({"role": "assistant", "content": confirmation})
-            await save_session(sender, session)
-            await append_chat(sender, "<media>", confirmation, timestamp())
-            await save_chat({"phone": sender, "input": "<media>", "output": confirmation})
-            resp = MessagingResponse()
-            resp.message(confirmation)
-            return Response(content=str(resp), media_type="application/xml")
+@instrument("whatsapp.turn")
+async def handle_whatsapp_message(sender: str, message: str, num_media: int = 0) -> str:
+    """Run one WhatsApp turn and return the reply text.
 
-        # Ensure OpenAI call is time-limited
-        try:
-            reply = await asyncio.wait_for(generate_response(session, language), timeout=60)
+    All Mongo writes for the turn are collected in a ``UnitOfWork`` and
+    flushed together with the session append at the end.
+    """
+    uow = UnitOfWork(sender)
+    language = detect_language(message, sender)
+    if language_changed(sender, language):
+        uow.set_language(language)
+
+    session, user, summary = await asyncio.gather(
+        get_session(sender), get_turn_context(sender), get_conversation_summary(sender)
+    )
+    offset = conversation_offset(session, user.get("chat_count") or 0)
+    pinned = []
+    if not session and user:
+        meta = (
+            f"Returning user details: name={user.get('name')}, "
+            f"age={user.get('age')}, gender={user.get('gender')}, "
+            f"pin={user.get('pin')}"
+        )
+        pinned.append({"role": "system", "content": meta})
 
-            if PAYMENT_PLACEHOLDER in reply:
-                link = await create_payment_link(99, "Metabolix consult", sender)
-                reply = reply.replace(PAYMENT_PLACEHOLDER, link["url"])
-                await record_payment(
-                    sender,
+    user_msg = {"role": "user", "content": message or "<media>"}
+    session = pinned + session + [user_msg]
+
+    pending = user.get("payments") or []
+    confirmation = await confirm_pending_payment(sender, pending, uow)
+
+    if num_media > 0 and confirmation:
+        uow.append_chat("<media>", confirmation, timestamp())
+        uow.save_chat(
+            {"phone": sender, "input": "<media>", "output": confirmation, "time": timestamp()}
+        )
+        await asyncio.gather(
+            append_session(
+                sender,
+                [user_msg, {"role": "assistant", "content": confirmation}],
+                pinned=pinned,
+            ),
+            uow.flush(),
+        )
+        return confirmation
+
+    link_task: Optional["asyncio.Future[Dict[str, str]]"] = None
+    # Ensure OpenAI call is time-limited
+    try:
+        # Plain price/frequency questions are answered from the catalog directly
+        reply = answer_catalog_question(message) if language == "English" else None
+        if reply is None:
+            context, overflow, covered = build_context(session, summary, offset=offset)
+            schedule_summary(sender, summary, overflow, covered)
+            # Create the link while the model writes a reply that will likely need it
+            if payment_link_likely(session):
+                link_task = asyncio.ensure_future(
+                    get_payment_link(CHAT_CONSULT_AMOUNT, CHAT_CONSULT_DESCRIPTION, sender, pending)
+                )
+                link_task.add_done_callback(_log_link_failure)
+            reply = await asyncio.wait_for(
+                generate_response(context, language), timeout=REPLY_TIMEOUT
+            )
+
+        if PAYMENT_PLACEHOLDER in reply:
+            link = await (
+                link_task
+                or get_payment_link(CHAT_CONSULT_AMOUNT, CHAT_CONSULT_DESCRIPTION, sender, pending)
+            )
+            reply = reply.replace(PAYMENT_PLACEHOLDER, link["url"])
+            # A cached link may already be recorded, paid or not; never re-add it
+            if link["id"] not in (user.get("payment_link_ids") or []):
+                uow.record_payment(
                     {
-                        "amount": 99,
+                        "amount": CHAT_CONSULT_AMOUNT,
+                        "description": CHAT_CONSULT_DESCRIPTION,
                         "link": link["url"],
                         "link_id": link["id"],
                         "status": "pending",
                         "time": timestamp(),
-                    },
+                    }
                 )
-            if confirmation:
-                reply = f"{confirmation}\n\n{reply}"
+        if confirmation:
+            reply = f"{confirmation}\n\n{reply}"
+
+    except asyncio.TimeoutError:
+        reply = "Sorry, the system is currently slow. Please try again in a few minutes."
+    except Exception as e:
+        logger.exception("Error generating reply: %s", e)
+        reply = "Sorry, something went wrong. Please try again."
+
+    uow.append_chat(message, reply, timestamp())
+    uow.save_chat({"phone": sender, "input": message, "output": reply, "time": timestamp()})
+    await asyncio.gather(
+        append_session(
+            sender, [user_msg, {"role": "assistant", "content": reply}], pinned=pinned
+        ),
+        uow.flush(),
+    )
+    return reply
+
 
-        except asyncio.TimeoutError:
-            reply = "Sorry, the system is currently slow. Please try again in a few minutes."
-        except Exception as e:
-            logger.exception("Error generating reply: %s", e)
-            reply = "Sorry, something went wrong. Please try again."
+async def process_whatsapp_job(job: Dict[str, Any]) -> None:
+    """Queue worker entry point: answer a queued message out-of-band."""
+    try:
+        reply = await run_coalesced(
+            job["sender"], job["message"], job.get("num_media", 0), handle_whatsapp_message
+        )
+    except Exception as e:
+        logger.exception("Queued WhatsApp turn failed: %s", e)
+        reply = "Sorry, something went wrong on our side. We'll fix it soon."
+    if reply is not None:
+        await send_whatsapp_message(job["sender"], reply)
 
-        session.append({"role": "assistant", "content": reply})
-        await save_session(sender, session)
-        await append_chat(sender, message, reply, timestamp())
-        await save_chat({"phone": sender, "input": message, "output": reply})
 
+@router.post("/whatsapp")
+async def whatsapp_webhook(request: Request):
+    logger.debug("Webhook triggered")
+    try:
+        form = await request.form()
+        sender = form["From"].split(":")[-1]  # Extract phone
+        message = form["Body"].strip()
+        num_media = int(form.get("NumMedia", 0))
+
+        if WHATSAPP_ASYNC_REPLIES:
+            # Ack Twilio immediately; a reply worker answers via the REST API.
+            await enqueue_reply(
+                {"sender": sender, "message": message, "num_media": num_media}
+            )
+            return Response(content=str(MessagingResponse()), media_type="application/xml")
+
+        # Turns are serialized and coalesced only by the reply workers: waiting
+        # here for the sender lock would outlast Twilio's ~15s webhook timeout,
+        # and Twilio's retry would be answered a second time.
+        reply = await handle_whatsapp_message(sender, message, num_media)
         resp = MessagingResponse()
         resp.message(reply)
         return Response(content=str(resp), media_type="application/xml")
@@ -216,6 +505,13 @@ async def whatsapp_webhook(request: Request):
         fallback.message("Sorry, something went wrong on our side. We'll fix it soon.")
         return Response(content=str(fallback), media_type="application/xml")
 
+
+@router.get("/whatsapp/queue")
+async def whatsapp_queue_stats():
+    """Report async reply queue depth and end-to-end latency."""
+    return await reply_queue_stats()
+
+
 @router.post("/summary")
 async def store_summary(summary: Summary):
     logger.info("Storing summary for %s", summary.user_phone)
@@ -223,8 +519,19 @@ async def store_summary(summary: Summary):
     return {"status": "saved"}
 
 
+async def notify_payment_confirmed(phone: str, payment_id: Optional[str]) -> None:
+    """Tell the user their payment went through; runs after the webhook returns."""
+    try:
+        await send_whatsapp_message(
+            phone,
+            f"Payment confirmed. Transaction ID: {payment_id}. A doctor will reach you within 24 hours.",
+        )
+    except Exception as exc:
+        logger.warning("Payment confirmation to %s failed: %s", phone, exc)
+
+
 @router.post("/payment-webhook")
-async def payment_webhook(request: Request):
+async def payment_webhook(request: Request, background_tasks: BackgroundTasks):
     signature = request.headers.get("X-Razorpay-Signature")
     if not signature:
         raise HTTPException(status_code=400, detail="Missing Razorpay signature")
@@ -234,36 +541,65 @@ async def payment_webhook(request: Request):
     if not verify_signature(body, signature):
         raise HTTPException(status_code=400, detail="Invalid signature")
 
-    payload = await request.json()
+    try:
+        payload = json.loads(body)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid Razorpay payload")
     event = payload.get("event")
     entity = payload.get("payload", {}).get("payment", {}).get("entity")
 
     if not event or not entity:
         raise HTTPException(status_code=400, detail="Invalid Razorpay payload")
 
-    await save_chat({
+    contact = entity.get("contact")
+    link = payload.get("payload", {}).get("payment_link", {}).get("entity") or {}
+    captured = entity.get("status") == "captured"
+    amount = entity.get("amount", 0) / 100
+    record = {
+        "event_key": payment_event_key(event, entity),
+        "event_id": request.headers.get("X-Razorpay-Event-Id"),
         "event": event,
-        "entity": entity,
-        "raw_payload": payload,
-        "time": timestamp()
-    })
+        "payment_id": entity.get("id"),
+        "link_id": link.get("id"),
+        "phone": contact,
+        "amount": amount,
+        "status": entity.get("status"),
+        "time": timestamp(),
+    }
+    if not await claim_payment_event(record):
+        logger.info("Ignoring duplicate payment webhook %s", record["event_key"])
+        # payment.captured usually arrives first without the link; the later
+        # payment_link.paid shares its key but is the one naming the link
+        if link.get("id") and captured:
+            cache_payment_status(link["id"], {"payment_id": entity.get("id"), "amount": amount})
+            if contact:
+                uow = UnitOfWork(contact)
+                uow.mark_payment_paid(link["id"], entity.get("id"))
+                await uow.flush()
+        return {"status": "duplicate"}
 
-    contact = entity.get("contact")
-    if contact:
-        await record_payment(
-            contact,
-            {
+    try:
+        if link.get("id") and captured:
+            cache_payment_status(link["id"], {"payment_id": entity.get("id"), "amount": amount})
+        if contact:
+            if captured:
+                await forget_payment_links(contact)
+            uow = UnitOfWork(contact)
+            if link.get("id") and captured:
+                uow.mark_payment_paid(link["id"], entity.get("id"))
+            uow.record_payment({
                 "payment_id": entity.get("id"),
-                "amount": entity.get("amount", 0) / 100,
+                "amount": amount,
                 "status": entity.get("status"),
-                "time": timestamp(),
-            },
-        )
-        await send_whatsapp_message(
-            contact,
-            f"Payment confirmed. Transaction ID: {entity.get('id')}. A doctor will reach you within 24 hours.",
-        )
-
+                "time": record["time"],
+            })
+            await uow.flush()
+    except Exception:
+        await release_payment_event(record["event_key"])
+        raise
+
+    if contact and captured:
+        background_tasks.add_task(notify_payment_confirmed, contact, entity.get("id"))
 
     return {"status": "ok"}
 
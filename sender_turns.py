@@ -0,0 +1,158 @@
+"""Per-sender ordering and burst coalescing for WhatsApp turns.
+
+Every inbound message is appended to a per-sender buffer, then the request
+waits for the sender's lock. Whoever holds the lock drains the whole buffer
+and answers it as a single turn, so messages that arrive while a reply is
+being generated are merged into the next LLM call instead of racing it.
+Requests whose message was already drained by another turn get ``None``.
+
+``BURST_WINDOW_MS`` adds a short debounce before taking the lock so a quick
+burst ("hi", "price?", "for 3 months") is merged even when nothing is in
+flight. With Redis configured both the buffer and the lock are shared by
+all workers; otherwise they are per process.
+
+Only the queued reply path (``WHATSAPP_ASYNC_REPLIES``) uses this: a worker
+can wait ``SENDER_LOCK_WAIT`` for the lock, but a synchronous webhook cannot
+without Twilio timing out and redelivering the message.
+"""
+
+import asyncio
+import json
+import logging
+import os
+import uuid
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional
+
+from session_store import get_redis
+
+logger = logging.getLogger(__name__)
+
+BURST_WINDOW_MS = int(os.getenv("BURST_WINDOW_MS", "0"))
+SENDER_LOCK_TTL = int(os.getenv("SENDER_LOCK_TTL", "90"))
+SENDER_LOCK_WAIT = float(os.getenv("SENDER_LOCK_WAIT", "120"))
+_BUFFER_TTL = 300
+
+_local_locks: Dict[str, List[Any]] = {}
+_local_buffers: Dict[str, List[Dict[str, Any]]] = {}
+
+
+def _buffer_key(sender: str) -> str:
+    return f"burst:{sender}"
+
+
+def _lock_key(sender: str) -> str:
+    return f"lock:sender:{sender}"
+
+
+async def buffer_message(sender: str, message: str, num_media: int = 0) -> None:
+    """Queue an inbound message for the sender's next turn."""
+    item = {"message": message, "num_media": num_media}
+    redis = get_redis()
+    if redis:
+        async with redis.pipeline(transaction=True) as pipe:
+            pipe.rpush(_buffer_key(sender), json.dumps(item))
+            pipe.expire(_buffer_key(sender), _BUFFER_TTL)
+            await pipe.execute()
+    else:
+        _local_buffers.setdefault(sender, []).append(item)
+
+
+async def drain_messages(sender: str) -> List[Dict[str, Any]]:
+    """Atomically take every buffered message for ``sender``, oldest first."""
+    redis = get_redis()
+    if redis:
+        async with redis.pipeline(transaction=True) as pipe:
+            pipe.lrange(_buffer_key(sender), 0, -1)
+            pipe.delete(_buffer_key(sender))
+            items, _ = await pipe.execute()
+        return [json.loads(i) for i in items]
+    return _local_buffers.pop(sender, [])
+
+
+@asynccontextmanager
+async def _local_lock(sender: str) -> AsyncIterator[None]:
+    entry = _local_locks.get(sender)
+    if entry is None:
+        entry = _local_locks[sender] = [asyncio.Lock(), 0]
+    entry[1] += 1
+    try:
+        async with entry[0]:
+            yield
+    finally:
+        entry[1] -= 1
+        if entry[1] == 0:
+            _local_locks.pop(sender, None)
+
+
+async def _acquire_redis_lock(redis: Any, key: str, token: str) -> bool:
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + SENDER_LOCK_WAIT
+    delay = 0.01
+    while True:
+        if await redis.set(key, token, nx=True, ex=SENDER_LOCK_TTL):
+            return True
+        if loop.time() >= deadline:
+            return False
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, 0.25)
+
+
+async def _release_redis_lock(redis: Any, key: str, token: str) -> None:
+    # Compare-and-delete so an expired lock re-acquired by another worker is kept
+    async with redis.pipeline(transaction=True) as pipe:
+        await pipe.watch(key)
+        if await pipe.get(key) == token:
+            pipe.multi()
+            pipe.delete(key)
+            await pipe.execute()
+        else:
+            await pipe.unwatch()
+
+
+@asynccontextmanager
+async def sender_lock(sender: str) -> AsyncIterator[None]:
+    """Hold the sender's lock; shared across workers when Redis is configured.
+
+    If the Redis lock cannot be taken within ``SENDER_LOCK_WAIT`` the turn
+    proceeds anyway rather than dropping the message.
+    """
+    async with _local_lock(sender):
+        redis = get_redis()
+        if not redis:
+            yield
+            return
+        key, token = _lock_key(sender), uuid.uuid4().hex
+        acquired = await _acquire_redis_lock(redis, key, token)
+        if not acquired:
+            logger.warning("Timed out waiting for sender lock %s; proceeding", sender)
+        try:
+            yield
+        finally:
+            if acquired:
+                await _release_redis_lock(redis, key, token)
+
+
+async def run_coalesced(
+    sender: str,
+    message: str,
+    num_media: int,
+    handler: Callable[[str, str, int], Awaitable[str]],
+) -> Optional[str]:
+    """Run ``handler`` once for this message and any others buffered with it.
+
+    Returns the reply, or ``None`` when the message was merged into a turn
+    handled by another request.
+    """
+    await buffer_message(sender, message, num_media)
+    if BURST_WINDOW_MS > 0:
+        await asyncio.sleep(BURST_WINDOW_MS / 1000)
+    async with sender_lock(sender):
+        pending = await drain_messages(sender)
+        if not pending:
+            return None
+        if len(pending) > 1:
+            logger.info("Coalesced %s messages from %s into one turn", len(pending), sender)
+        merged = "\n".join(p["message"] for p in pending if p["message"])
+        media = max(p.get("num_media", 0) for p in pending)
+        return await handler(sender, merged, media)
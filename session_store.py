@@ -1,42 +1,193 @@
 import os
 import json
 import logging
-from typing import List, Dict
+from typing import Any, Dict, List, Optional, Tuple
 
 import redis.asyncio as aioredis
 from dotenv import load_dotenv
 
+from metrics import gauge, instrument, stats_gauge
+from utils import LRUCache
+
 load_dotenv()
 logger = logging.getLogger(__name__)
 
 REDIS_URL = os.getenv("REDIS_URL")
+SESSION_TTL_SECONDS = int(os.getenv("SESSION_TTL_SECONDS", "86400"))
+SESSION_MAX_TURNS = int(os.getenv("SESSION_MAX_TURNS", "20"))
+SESSION_MEMORY_MAX = int(os.getenv("SESSION_MEMORY_MAX", "1000"))
 
 _redis = None
-_memory_store: Dict[str, List[Dict[str, str]]] = {}
+_memory_store: LRUCache[List[Dict[str, str]]] = LRUCache(
+    SESSION_MEMORY_MAX, ttl=SESSION_TTL_SECONDS
+)
+
+
 
-if REDIS_URL:
+def init_redis() -> None:
+    """Create the Redis client if configured and not already set up."""
+    global _redis
+    if _redis is not None or not REDIS_URL:
+        return
     try:
         _redis = aioredis.from_url(REDIS_URL, decode_responses=True)
-        logger.info("Connected to Redis at %s", REDIS_URL)
+        logger.info("Redis client created for %s", REDIS_URL)
     except Exception as exc:
         logger.warning("Redis connection failed: %s", exc)
         _redis = None
 
 
+async def ping_redis() -> None:
+    """Round-trip to Redis; raises if it is unreachable."""
+    if _redis is None:
+        raise RuntimeError("Redis not configured")
+    await _redis.ping()
+
+
+async def close_redis() -> None:
+    """Close the Redis connection pool."""
+    global _redis
+    if _redis is not None:
+        await _redis.aclose()
+        _redis = None
+
+
+def _split_pinned(
+    session: List[Dict[str, str]]
+) -> Tuple[List[Dict[str, str]], List[Dict[str, str]]]:
+    """Split leading system messages from the rest of the conversation."""
+    head = 0
+    while head < len(session) and session[head].get("role") == "system":
+        head += 1
+    return session[:head], session[head:]
+
+
+def trim_session(
+    session: List[Dict[str, str]], max_turns: Optional[int] = None
+) -> List[Dict[str, str]]:
+    """Keep leading system messages plus the last ``max_turns`` exchanges."""
+    if max_turns is None:
+        max_turns = SESSION_MAX_TURNS
+    pinned, body = _split_pinned(session)
+    limit = max_turns * 2
+    if len(body) <= limit:
+        return session
+    return pinned + body[-limit:]
+
+
+def get_redis():
+    """Return the shared Redis client, or ``None`` when Redis is not configured."""
+    return _redis
+
+
+def _list_key(key: str) -> str:
+    return f"session:{key}"
+
+
+def _pinned_key(key: str) -> str:
+    return f"session:{key}:pinned"
+
+
+async def _migrate_legacy(key: str) -> List[Dict[str, str]]:
+    """Move a pre-list JSON session blob stored under ``key`` into list form."""
+    data = await _redis.get(key)
+    if not data:
+        return []
+    try:
+        session = trim_session(json.loads(data))
+    except (json.JSONDecodeError, TypeError):
+        logger.warning("Invalid session data for %s", key)
+        await _redis.delete(key)
+        return []
+    await _write_redis(key, session, replace=True)
+    await _redis.delete(key)
+    return session
+
+
+async def _write_redis(key: str, session: List[Dict[str, str]], replace: bool = False) -> None:
+    pinned, body = _split_pinned(session)
+    async with _redis.pipeline(transaction=True) as pipe:
+        if replace:
+            pipe.delete(_list_key(key), _pinned_key(key))
+        if pinned:
+            pipe.rpush(_pinned_key(key), *(json.dumps(m) for m in pinned))
+        if body:
+            pipe.rpush(_list_key(key), *(json.dumps(m) for m in body))
+        pipe.ltrim(_list_key(key), -SESSION_MAX_TURNS * 2, -1)
+        pipe.expire(_pinned_key(key), SESSION_TTL_SECONDS)
+        pipe.expire(_list_key(key), SESSION_TTL_SECONDS)
+        await pipe.execute()
+
+
+def _decode(items: List[str]) -> List[Dict[str, str]]:
+    messages = []
+    for item in items:
+        try:
+            messages.append(json.loads(item))
+        except json.JSONDecodeError:
+            continue
+    return messages
+
+
+@instrument("session.get")
 async def get_session(key: str) -> List[Dict[str, str]]:
-    """Retrieve a chat session list from Redis or in-memory store."""
+    """Retrieve a chat session list from Redis or in-memory store.
+
+    Reading a Redis session refreshes its TTL; the read is a single pipelined
+    round trip.
+    """
     if _redis:
-        data = await _redis.get(key)
-        if data:
-            try:
-                return json.loads(data)
-            except json.JSONDecodeError:
-                logger.warning("Invalid session data for %s", key)
-    return _memory_store.get(key, [])
+        async with _redis.pipeline(transaction=False) as pipe:
+            pipe.lrange(_pinned_key(key), 0, -1)
+            pipe.lrange(_list_key(key), 0, -1)
+            pipe.expire(_pinned_key(key), SESSION_TTL_SECONDS)
+            pipe.expire(_list_key(key), SESSION_TTL_SECONDS)
+            pinned, body, _, _ = await pipe.execute()
+        if pinned or body:
+            return _decode(pinned) + _decode(body)
+        session = await _migrate_legacy(key)
+        if session:
+            return session
+    session = _memory_store.get(key)
+    return list(session) if session else []
+
+
+@instrument("session.append")
+async def append_session(
+    key: str,
+    messages: List[Dict[str, str]],
+    pinned: Optional[List[Dict[str, str]]] = None,
+) -> None:
+    """Append messages to a session without rewriting it.
+
+    ``pinned`` messages (e.g. returning-user details) are kept ahead of the
+    conversation and never trimmed. In Redis this is one RPUSH/LTRIM/EXPIRE
+    pipeline, so concurrent turns for the same key cannot overwrite each
+    other.
+    """
+    pinned = pinned or []
+    if _redis:
+        await _write_redis(key, pinned + messages)
+    existing_pinned, existing = _split_pinned(_memory_store.get(key) or [])
+    session = existing_pinned + pinned + existing + messages
+    _memory_store.set(key, trim_session(session))
 
 
 async def save_session(key: str, session: List[Dict[str, str]]) -> None:
-    """Persist chat session to Redis and memory."""
+    """Replace a stored session with a trimmed copy of ``session``."""
+    session = trim_session(session)
     if _redis:
-        await _redis.set(key, json.dumps(session))
-    _memory_store[key] = session
+        await _write_redis(key, session, replace=True)
+    _memory_store.set(key, session)
+
+
+def session_stats() -> Dict[str, Any]:
+    """Return in-memory session tier counters."""
+    return _memory_store.stats()
+
+
+gauge(
+    "metabolix_session_memory",
+    "In-memory session tier size and hit/miss/eviction counts.",
+    lambda: stats_gauge(_memory_store.stats()),
+)
@@ -0,0 +1,93 @@
+import asyncio
+
+import admin_digest
+
+
+def _local(monkeypatch):
+    monkeypatch.setattr(admin_digest, "get_redis", lambda: None)
+    monkeypatch.setattr(admin_digest, "_local_alerts", [])
+
+
+def test_alerts_are_sent_as_one_digest(monkeypatch):
+    _local(monkeypatch)
+    sent = []
+
+    async def fake_notify(text):
+        sent.append(text)
+
+    monkeypatch.setattr(admin_digest, "notify_admin", fake_notify)
+
+    async def run():
+        for i in range(3):
+            await admin_digest.queue_admin_alert(f"order {i}")
+        return await admin_digest.flush_admin_digest()
+
+    assert asyncio.run(run()) == 3
+    assert sent == ["3 new alerts:\n- order 0\n- order 1\n- order 2"]
+    assert admin_digest._local_alerts == []
+
+
+def test_failed_digest_keeps_alerts(monkeypatch):
+    _local(monkeypatch)
+
+    async def failing_notify(text):
+        raise RuntimeError("twilio down")
+
+    monkeypatch.setattr(admin_digest, "notify_admin", failing_notify)
+
+    async def run():
+        await admin_digest.queue_admin_alert("order 1")
+        return await admin_digest.flush_admin_digest()
+
+    assert asyncio.run(run()) == 0
+    assert admin_digest._local_alerts == ["order 1"]
+
+
+def test_long_digest_is_truncated():
+    text = admin_digest.format_digest([f"order {i} " + "x" * 100 for i in range(50)])
+    assert len(text) < 1600
+    assert text.endswith("more")
+
+
+def test_alerts_that_do_not_fit_stay_queued(monkeypatch):
+    _local(monkeypatch)
+    sent = []
+
+    async def fake_notify(text):
+        sent.append(text)
+
+    monkeypatch.setattr(admin_digest, "notify_admin", fake_notify)
+    alerts = [f"order {i} " + "x" * 100 for i in range(30)]
+
+    async def run():
+        for alert in alerts:
+            await admin_digest.queue_admin_alert(alert)
+        counts = []
+        while admin_digest._local_alerts:
+            counts.append(await admin_digest.flush_admin_digest())
+        return counts
+
+    counts = asyncio.run(run())
+    assert len(counts) > 1 and sum(counts) == 30
+    assert sent[0].endswith(f"...and {30 - counts[0]} more")
+    assert all(alert in "".join(sent) for alert in alerts)
+
+
+def test_oversized_alert_does_not_wedge_the_queue(monkeypatch):
+    _local(monkeypatch)
+    sent = []
+
+    async def fake_notify(text):
+        sent.append(text)
+
+    monkeypatch.setattr(admin_digest, "notify_admin", fake_notify)
+    # queued before alerts were clipped on the way in
+    admin_digest._local_alerts.append("x" * 5000)
+
+    async def run():
+        await admin_digest.queue_admin_alert("y" * 5000)
+        return [await admin_digest.flush_admin_digest() for _ in range(2)]
+
+    assert asyncio.run(run()) == [1, 1]
+    assert admin_digest._local_alerts == []
+    assert all(len(text) <= admin_digest._MAX_BODY for text in sent)
@@ -6,3 +6,10 @@ def test_app_import():
     client = TestClient(app)
     response = client.get("/docs")
     assert response.status_code == 200
+
+
+def test_readiness_without_backing_services():
+    with TestClient(app) as client:
+        response = client.get("/ready")
+    assert response.status_code == 200
+    assert response.json() == {"status": "ready", "checks": {}}
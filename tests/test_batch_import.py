@@ -0,0 +1,47 @@
+import json
+
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+import db
+import routes
+from benchmarks.fakes import FakeDatabase
+
+
+def _client(monkeypatch):
+    fake_db = FakeDatabase()
+    alerts = []
+
+    async def fake_alert(text):
+        alerts.append(text)
+
+    monkeypatch.setattr(db, "db", fake_db)
+    monkeypatch.setattr(routes, "queue_admin_alert", fake_alert)
+    monkeypatch.setattr(routes, "BATCH_INSERT_CHUNK", 2)
+    app = FastAPI()
+    app.include_router(routes.router)
+    return TestClient(app), fake_db, alerts
+
+
+def test_orders_batch_reports_bad_rows(monkeypatch):
+    client, fake_db, alerts = _client(monkeypatch)
+    user = {"name": "A", "age": 30, "gender": "F", "location": "Delhi", "phone": "+911"}
+    rows = [
+        json.dumps({"user": user, "product": "GLP-1", "quantity": 2}),
+        json.dumps({"user": user}),
+        "not json",
+        "",
+        json.dumps({"user": user, "product": "Consult"}),
+        json.dumps({"user": user, "product": "Kit"}),
+    ]
+
+    resp = client.post("/orders/batch", content="\n".join(rows),
+                       headers={"Content-Type": "application/x-ndjson"})
+
+    body = resp.json()
+    assert body["received"] == 5
+    assert body["inserted"] == 3
+    assert [e["line"] for e in body["errors"]] == [2, 3]
+    assert [d["product"] for d in fake_db.orders.docs] == ["GLP-1", "Consult", "Kit"]
+    assert fake_db.counter["mongo.orders.insert_many"] == 2
+    assert alerts == ["Batch import: 3 orders saved, 2 rejected"]
@@ -0,0 +1,49 @@
+from dataclasses import replace
+
+import catalog
+
+
+def test_quote_starts_at_sale_price_and_respects_floor():
+    mounjaro = catalog.PRODUCTS_BY_KEY["mounjaro-5"]
+    assert catalog.quote(mounjaro).unit_price == 3500
+    assert catalog.quote(mounjaro, offered=3000).unit_price == 3500
+
+    no_sale = replace(mounjaro, sale=None, floor=4000)
+    assert catalog.quote(no_sale).unit_price == round(4375 * 0.95)
+    assert catalog.quote(no_sale, offered=3900).unit_price == 4000
+    assert catalog.quote(no_sale, quantity=2).total == 2 * round(4375 * 0.95) + 2500
+
+
+def test_quote_without_floor_keeps_opening_discount():
+    cgm = catalog.PRODUCTS_BY_KEY["cgm"]
+    assert catalog.quote(cgm).unit_price == 4987
+    assert catalog.quote(cgm, offered=4500).unit_price == 4987
+
+
+def test_price_question_is_answered_from_catalog():
+    reply = catalog.answer_catalog_question("Rybelsus 14mg price?")
+    assert "₹3,096" in reply and "₹3,870" in reply
+    assert "Delivery: *₹399*" in reply
+    assert "3mg" not in reply
+    assert reply.endswith(catalog.DISCLAIMER)
+
+
+def test_frequency_question():
+    assert "once weekly" in catalog.answer_catalog_question("how often is mounjaro taken?")
+
+
+def test_open_questions_go_to_the_model():
+    assert catalog.answer_catalog_question("what is the price") is None
+    assert catalog.answer_catalog_question("mounjaro or rybelsus, which costs less?") is None
+    assert catalog.answer_catalog_question("my heart rate is high on mounjaro") is None
+    assert catalog.answer_catalog_question("how much weight can I lose on rybelsus?") is None
+    assert catalog.answer_catalog_question("is a daily walk ok with mounjaro?") is None
+    long_question = "I have diabetes and thyroid, is mounjaro safe and what is the price for me"
+    assert catalog.answer_catalog_question(long_question) is None
+
+
+def test_prompt_only_carries_relevant_entries():
+    text = catalog.catalog_prompt("tell me about mounjaro")
+    assert "Mounjaro Tirzepatide 2.5mg" in text
+    assert "Doctor Consult" in text
+    assert "Rybelsus" not in text
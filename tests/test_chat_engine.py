@@ -0,0 +1,246 @@
+import asyncio
+from types import SimpleNamespace
+
+import openai
+
+import chat_engine
+from utils import LRUCache
+
+
+def _rate_limited():
+    # Only the attributes the SDK error and the retry logic read
+    response = SimpleNamespace(status_code=429, headers={"retry-after-ms": "10"}, request=None)
+    return openai.RateLimitError("slow down", response=response, body=None)
+
+
+class FakeCompletions:
+    def __init__(self, failures):
+        self.failures = failures
+        self.calls = 0
+        self.in_flight = 0
+        self.peak = 0
+
+    async def create(self, **kwargs):
+        self.calls += 1
+        self.in_flight += 1
+        self.peak = max(self.peak, self.in_flight)
+        try:
+            await asyncio.sleep(0.01)
+            if self.failures:
+                self.failures -= 1
+                raise _rate_limited()
+            usage = SimpleNamespace(prompt_tokens=10, completion_tokens=5, total_tokens=15)
+            message = SimpleNamespace(content=" hello ")
+            return SimpleNamespace(choices=[SimpleNamespace(message=message)], usage=usage)
+        finally:
+            self.in_flight -= 1
+
+
+def _install(monkeypatch, completions, cache=False):
+    fake = SimpleNamespace(chat=SimpleNamespace(completions=completions))
+    monkeypatch.setattr(chat_engine, "client", fake)
+    monkeypatch.setattr(chat_engine, "_limiter", None)
+    monkeypatch.setattr(chat_engine, "get_redis", lambda: None)
+    monkeypatch.setattr(chat_engine, "_reply_cache", LRUCache(10))
+    monkeypatch.setattr(chat_engine, "RESPONSE_CACHE_STAGES", {"first"} if cache else set())
+
+
+def test_rate_limit_is_retried_after_retry_after(monkeypatch):
+    completions = FakeCompletions(failures=2)
+    _install(monkeypatch, completions)
+    before = chat_engine.OPENAI_RETRIES.value(reason="rate_limit")
+
+    reply = asyncio.run(chat_engine.generate_response([{"role": "user", "content": "hi"}]))
+
+    assert reply == "hello"
+    assert completions.calls == 3
+    assert chat_engine.OPENAI_RETRIES.value(reason="rate_limit") == before + 2
+
+
+def test_gives_up_after_max_retries(monkeypatch):
+    completions = FakeCompletions(failures=10)
+    _install(monkeypatch, completions)
+    monkeypatch.setattr(chat_engine, "OPENAI_MAX_RETRIES", 1)
+
+    reply = asyncio.run(chat_engine.generate_response([{"role": "user", "content": "hi"}]))
+
+    assert reply.startswith("Sorry")
+    assert completions.calls == 2
+
+
+def test_no_retry_is_started_past_the_deadline(monkeypatch):
+    completions = FakeCompletions(failures=5)
+    _install(monkeypatch, completions)
+    monkeypatch.setattr(chat_engine, "OPENAI_DEADLINE", 0.015)
+
+    reply = asyncio.run(chat_engine.generate_response([{"role": "user", "content": "hi"}]))
+
+    assert reply == chat_engine.FALLBACK_REPLY
+    assert completions.calls == 1
+
+
+def test_in_flight_calls_are_capped(monkeypatch):
+    completions = FakeCompletions(failures=0)
+    _install(monkeypatch, completions)
+    monkeypatch.setattr(chat_engine, "OPENAI_MAX_IN_FLIGHT", 2)
+
+    async def run():
+        messages = [{"role": "user", "content": "hi"}]
+        await asyncio.gather(*(chat_engine.generate_response(messages) for _ in range(6)))
+
+    asyncio.run(run())
+    assert completions.peak == 2
+
+
+def test_first_turn_replies_are_cached(monkeypatch):
+    completions = FakeCompletions(failures=0)
+    _install(monkeypatch, completions, cache=True)
+
+    async def run():
+        first = await asyncio.gather(*(
+            chat_engine.generate_response([{"role": "user", "content": text}])
+            for text in ("Price?", "price", "  PRICE!! ")
+        ))
+        history = [
+            {"role": "user", "content": "hi"},
+            {"role": "assistant", "content": "hello"},
+            {"role": "user", "content": "price?"},
+        ]
+        await chat_engine.generate_response(history)
+        await chat_engine.generate_response([{"role": "user", "content": "price"}], "Hindi")
+        return first
+
+    assert asyncio.run(run()) == ["hello"] * 3
+    # one call for the three openers, one mid-conversation, one for Hindi
+    assert completions.calls == 3
+
+
+def test_fallback_replies_are_not_cached(monkeypatch):
+    completions = FakeCompletions(failures=10)
+    _install(monkeypatch, completions, cache=True)
+    monkeypatch.setattr(chat_engine, "OPENAI_MAX_RETRIES", 0)
+
+    async def run():
+        for _ in range(2):
+            await chat_engine.generate_response([{"role": "user", "content": "hi"}])
+
+    asyncio.run(run())
+    assert completions.calls == 2
+
+
+class FakeStream:
+    def __init__(self, parts):
+        self.parts = parts
+        self.closed = False
+
+    def __aiter__(self):
+        return self._chunks()
+
+    async def _chunks(self):
+        for part in self.parts:
+            await asyncio.sleep(0)
+            delta = SimpleNamespace(content=part)
+            yield SimpleNamespace(choices=[SimpleNamespace(delta=delta)], usage=None)
+        usage = SimpleNamespace(prompt_tokens=10, completion_tokens=3, total_tokens=13)
+        yield SimpleNamespace(choices=[], usage=usage)
+
+    async def close(self):
+        self.closed = True
+
+
+class FakeStreamingCompletions:
+    def __init__(self, parts):
+        self.stream = FakeStream(parts)
+        self.kwargs = None
+
+    async def create(self, **kwargs):
+        self.kwargs = kwargs
+        return self.stream
+
+
+def test_stream_response_yields_deltas(monkeypatch):
+    completions = FakeStreamingCompletions(["Hel", "lo", None, "!"])
+    _install(monkeypatch, completions)
+
+    async def run():
+        return [d async for d in chat_engine.stream_response([{"role": "user", "content": "hi"}])]
+
+    assert asyncio.run(run()) == ["Hel", "lo", "!"]
+    assert completions.kwargs["stream"] is True
+    assert completions.stream.closed
+
+
+def test_stream_response_closes_upstream_when_abandoned(monkeypatch):
+    completions = FakeStreamingCompletions(["a", "b", "c"])
+    _install(monkeypatch, completions)
+
+    async def run():
+        deltas = chat_engine.stream_response([{"role": "user", "content": "hi"}])
+        first = await deltas.__anext__()
+        await deltas.aclose()
+        return first
+
+    assert asyncio.run(run()) == "a"
+    assert completions.stream.closed
+
+
+def test_triage_stream_saves_turn_after_completion(monkeypatch):
+    import json
+
+    from fastapi import FastAPI
+    from fastapi.testclient import TestClient
+
+    import db
+    import routes
+    from benchmarks.fakes import FakeDatabase
+
+    async def fake_stream(messages, language="English"):
+        for part in ("Drink ", "water."):
+            yield part
+
+    fake_db = FakeDatabase()
+    monkeypatch.setattr(db, "db", fake_db)
+    monkeypatch.setattr(routes, "stream_response", fake_stream)
+    app = FastAPI()
+    app.include_router(routes.router)
+
+    with TestClient(app).stream("POST", "/triage/stream", json={"description": "headache"}) as resp:
+        assert resp.headers["content-type"].startswith("text/event-stream")
+        events = [e for e in resp.read().decode().split("\n\n") if e]
+
+    assert [json.loads(e.split("data: ")[1]) for e in events[:2]] == [
+        {"delta": "Drink "}, {"delta": "water."}
+    ]
+    assert events[2] == 'event: done\ndata: {"reply": "Drink water."}'
+    assert fake_db.chats.docs[0]["output"] == "Drink water."
+
+
+def test_payment_link_likely():
+    offer = {"role": "assistant", "content": "Shall I book your doctor consult for ₹499?"}
+    chat = {"role": "assistant", "content": "Hi! How are you feeling today?"}
+
+    assert chat_engine.payment_link_likely([offer, {"role": "user", "content": "Yes please"}])
+    assert chat_engine.payment_link_likely([{"role": "user", "content": "send me the payment link"}])
+    assert not chat_engine.payment_link_likely([chat, {"role": "user", "content": "ok"}])
+    assert not chat_engine.payment_link_likely([{"role": "user", "content": "what is GLP-1?"}])
+
+
+def test_stream_holds_its_slot_and_settles_real_usage(monkeypatch):
+    completions = FakeStreamingCompletions(["a", "b"])
+    _install(monkeypatch, completions)
+    monkeypatch.setattr(chat_engine, "OPENAI_MAX_IN_FLIGHT", 1)
+    monkeypatch.setattr(chat_engine, "OPENAI_TOKENS_PER_MINUTE", 100000)
+
+    async def run():
+        deltas = chat_engine.stream_response([{"role": "user", "content": "hi"}])
+        await deltas.__anext__()
+        limiter = chat_engine._get_limiter()
+        held = limiter.semaphore.locked()
+        async for _ in deltas:
+            pass
+        return held, limiter.semaphore.locked(), limiter.available
+
+    held, after, available = asyncio.run(run())
+    assert held and not after
+    # the fake stream reports 13 tokens in its last chunk
+    assert 100000 - 13 - 1 <= available <= 100000
@@ -0,0 +1,109 @@
+import asyncio
+
+import context
+from utils import count_message_tokens
+
+
+def _session(turns):
+    session = [{"role": "system", "content": "Returning user details: name=A"}]
+    for i in range(turns):
+        session.append({"role": "user", "content": f"question {i} " + "word " * 40})
+        session.append({"role": "assistant", "content": f"answer {i} " + "word " * 40})
+    session.append({"role": "user", "content": "latest question"})
+    return session
+
+
+def test_window_stays_within_budget():
+    messages, overflow, covered = context.build_context(_session(30), budget=300)
+    assert messages[0]["content"].startswith("Returning user")
+    assert messages[-1]["content"] == "latest question"
+    assert messages[1]["role"] == "user"
+    assert count_message_tokens(messages[1:]) <= 300
+    assert overflow[0]["content"].startswith("question 0")
+    assert covered
+
+
+def test_summarized_messages_are_replaced_by_summary(monkeypatch):
+    saved = []
+
+    async def fake_summarize(previous, messages):
+        return f"{len(messages)} messages about weight loss"
+
+    async def fake_save(phone, summary, covered):
+        saved.append({"user_phone": phone, "summary": summary, "covered": covered})
+        return True
+
+    monkeypatch.setattr(context, "summarize_conversation", fake_summarize)
+    monkeypatch.setattr(context, "save_conversation_summary", fake_save)
+    session = _session(30)
+
+    async def run():
+        _, overflow, covered = context.build_context(session, budget=300)
+        context.schedule_summary("+911", None, overflow, covered)
+        await asyncio.gather(*context._tasks)
+        return overflow
+
+    overflow = asyncio.run(run())
+    summary = saved[0]
+    assert summary["covered"] == len(overflow) and summary["user_phone"] == "+911"
+
+    session += [
+        {"role": "assistant", "content": "latest answer " + "word " * 40},
+        {"role": "user", "content": "one more " + "word " * 40},
+    ]
+    messages, new_overflow, _ = context.build_context(session, summary, budget=300)
+    assert messages[1]["content"].endswith(f"{len(overflow)} messages about weight loss")
+    assert messages[-1]["content"].startswith("one more")
+    # Only the messages that slid out since the last fold need summarizing
+    assert 0 < len(new_overflow) <= 4
+    assert new_overflow[0] == session[1 + len(overflow)]
+
+
+def test_trimmed_session_is_not_refolded():
+    session = _session(30)
+    _, overflow, covered = context.build_context(session, budget=300)
+    summary = {"summary": "earlier", "covered": covered}
+
+    # The session store has since dropped the first 20 messages
+    trimmed = session[:1] + session[21:]
+    _, new_overflow, new_covered = context.build_context(trimmed, summary, budget=300, offset=20)
+
+    assert new_overflow == []
+    assert new_covered is None
+
+
+def test_offset_comes_from_the_durable_turn_count():
+    session = _session(30)
+    _, overflow, covered = context.build_context(session, budget=300)
+    summary = {"summary": "earlier", "covered": covered}
+
+    # After a restart the session store only has the last two turns
+    stored = session[:1] + session[-5:-1]
+    offset = context.conversation_offset(stored, 30)
+    assert offset == 56
+    messages, new_overflow, _ = context.build_context(
+        stored + [session[-1]], summary, budget=300, offset=offset
+    )
+    assert new_overflow == []
+    # the surviving turns are kept instead of clamping to the newest message
+    assert messages[-5:] == session[-5:]
+
+
+def test_rolling_summary_is_one_document_per_phone(monkeypatch):
+    import db
+    from benchmarks.fakes import FakeDatabase
+
+    fake_db = FakeDatabase()
+    monkeypatch.setattr(db, "db", fake_db)
+
+    async def run():
+        await db.ensure_indexes()
+        await db.save_conversation_summary("+911", "first", 10)
+        await db.save_conversation_summary("+911", "second", 20)
+        stale = await db.save_conversation_summary("+911", "late", 15)
+        return stale, await db.get_conversation_summary("+911")
+
+    stale, summary = asyncio.run(run())
+    assert stale is False
+    assert summary == {"summary": "second", "covered": 20}
+    assert len(fake_db.summaries.docs) == 1
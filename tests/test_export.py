@@ -0,0 +1,52 @@
+import asyncio
+import json
+
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+import db
+import export
+import routes
+from benchmarks.fakes import FakeDatabase
+
+
+def _orders(monkeypatch):
+    fake_db = FakeDatabase()
+    monkeypatch.setattr(db, "db", fake_db)
+    user = {"name": "A", "age": 30, "gender": "F", "location": "Delhi", "phone": "+911"}
+    times = ["2024-01-02T00:00:00", "2024-01-01T00:00:00", "2024-01-02T00:00:00", "2024-01-03T00:00:00"]
+    for i, t in enumerate(times):
+        asyncio.run(db.save_order({"user": user, "product": f"p{i}", "quantity": 1, "time": t}))
+    return fake_db
+
+
+async def _collect(*args, **kwargs):
+    return [row async for row in export.export_rows(*args, **kwargs)]
+
+
+def test_export_resumes_after_cursor(monkeypatch):
+    _orders(monkeypatch)
+    rows = asyncio.run(_collect("orders", since="2024-01-02"))
+    assert [r["product"] for r in rows] == ["p0", "p2", "p3"]
+
+    rest = asyncio.run(_collect("orders", since="2024-01-02", after=rows[0]["cursor"]))
+    assert [r["product"] for r in rest] == ["p2", "p3"]
+
+
+def test_export_endpoint_streams_csv(monkeypatch):
+    _orders(monkeypatch)
+    monkeypatch.setattr(routes, "EXPORT_TOKEN", "secret")
+    app = FastAPI()
+    app.include_router(routes.router)
+    client = TestClient(app)
+
+    assert client.get("/export/orders").status_code == 403
+    headers = {"Authorization": "Bearer secret"}
+    resp = client.get("/export/orders", params={"format": "csv", "until": "2024-01-02"}, headers=headers)
+    lines = resp.text.strip().splitlines()
+    assert lines[0].startswith("cursor,time,user.name")
+    assert len(lines) == 2 and ",p1," in lines[1]
+
+    resp = client.get("/export/orders", params={"phone": "+911"}, headers=headers)
+    assert [json.loads(line)["product"] for line in resp.text.splitlines()] == ["p1", "p0", "p2", "p3"]
+    assert client.get("/export/orders", params={"after": "junk"}, headers=headers).status_code == 400
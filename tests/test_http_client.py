@@ -0,0 +1,45 @@
+import asyncio
+
+from aiohttp import web
+
+import http_client
+
+
+async def _start_fake_server(state):
+    async def handler(request):
+        state["peers"].add(request.transport.get_extra_info("peername"))
+        state["in_flight"] += 1
+        state["max_in_flight"] = max(state["max_in_flight"], state["in_flight"])
+        await asyncio.sleep(0.02)
+        state["in_flight"] -= 1
+        return web.json_response({"id": "plink_1", "status": "created"})
+
+    app = web.Application()
+    app.router.add_route("*", "/{tail:.*}", handler)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    return runner, f"http://127.0.0.1:{port}"
+
+
+def test_pool_reuses_connections_and_limits_per_host(monkeypatch):
+    monkeypatch.setattr(http_client, "HTTP_MAX_PER_HOST", 3)
+    state = {"peers": set(), "in_flight": 0, "max_in_flight": 0}
+
+    async def run():
+        runner, base = await _start_fake_server(state)
+        try:
+            results = await asyncio.gather(
+                *(http_client.request_json("GET", f"{base}/payment_links/{i}") for i in range(20))
+            )
+        finally:
+            await http_client.close_http()
+            await runner.cleanup()
+        return results
+
+    results = asyncio.run(run())
+    assert all(r["status"] == "created" for r in results)
+    assert state["max_in_flight"] <= 3
+    assert len(state["peers"]) <= 3
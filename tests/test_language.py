@@ -0,0 +1,21 @@
+import utils
+from utils import LRUCache, detect_language, language_changed
+
+
+def test_detects_indic_scripts_without_langdetect(monkeypatch):
+    def fail(text):
+        raise AssertionError("langdetect should not be called")
+
+    monkeypatch.setattr(utils, "detect", fail)
+    assert detect_language("मुझे वजन कम करना है") == "Hindi"
+    assert detect_language("मला वजन कमी करायचे आहे") == "Marathi"
+    assert detect_language("எனக்கு எடை குறைக்க வேண்டும்") == "Tamil"
+    assert detect_language("ನಾನು ತೂಕ ಇಳಿಸಬೇಕು") == "Kannada"
+
+
+def test_sender_language_cache(monkeypatch):
+    monkeypatch.setattr(utils, "_sender_languages", LRUCache(10))
+    assert language_changed("+911", "Tamil") is True
+    assert language_changed("+911", "Tamil") is False
+    assert detect_language("👍", "+911") == "Tamil"
+    assert detect_language("👍", "+912") == "English"
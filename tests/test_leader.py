@@ -0,0 +1,73 @@
+import asyncio
+
+import fakeredis.aioredis
+import pytest
+
+import leader
+
+
+@pytest.fixture
+def redis(monkeypatch):
+    client = fakeredis.aioredis.FakeRedis(decode_responses=True)
+    monkeypatch.setattr(leader, "get_redis", lambda: client)
+    return client
+
+
+def test_lease_is_exclusive_until_released(redis):
+    async def run():
+        a, b = leader.Lease("job", ttl=5), leader.Lease("job", ttl=5)
+        assert await a.acquire()
+        assert not await b.acquire()
+        assert await a.acquire()  # re-acquiring renews
+        await a.release()
+        return await b.acquire()
+
+    assert asyncio.run(run())
+
+
+def test_only_one_worker_runs_each_pass(redis):
+    runs = []
+    running = []
+
+    def make_job(worker):
+        async def job():
+            running.append(worker)
+            assert len(running) == 1
+            runs.append(worker)
+            await asyncio.sleep(0.02)
+            running.remove(worker)
+        return job
+
+    async def run():
+        tasks = [
+            asyncio.create_task(leader.run_periodic("nudge", make_job(w), interval=0.1, ttl=0.15))
+            for w in range(3)
+        ]
+        await asyncio.sleep(0.35)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    asyncio.run(run())
+    assert 3 <= len(runs) <= 5
+    assert len(set(runs)) == 1
+
+
+def test_job_is_cancelled_when_lease_is_lost(redis):
+    state = {}
+
+    async def job():
+        try:
+            await asyncio.sleep(1)
+        except asyncio.CancelledError:
+            state["cancelled"] = True
+            raise
+
+    async def run():
+        lease = leader.Lease("nudge", ttl=0.06)
+        assert await lease.acquire()
+        await redis.set(lease.key, "someone-else")
+        return await leader._run_while_leader(lease, job)
+
+    assert asyncio.run(run()) is False
+    assert state == {"cancelled": True}
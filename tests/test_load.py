@@ -0,0 +1,19 @@
+import asyncio
+
+from benchmarks.load_test import ENDPOINTS, run_load_test
+
+
+def test_load_test_smoke():
+    report = asyncio.run(run_load_test(
+        requests=16, concurrency=4, openai_latency=0, link_ratio=1.0, phones=16
+    ))
+
+    assert all(stats["errors"] == 0 for stats in report["endpoints"].values())
+    assert {name: stats["count"] for name, stats in report["endpoints"].items()} == {
+        name: 4 for name in ENDPOINTS
+    }
+    calls = report["calls"]
+    assert calls["openai.chat.completions"] == 4
+    # one link per WhatsApp reply plus one per /consult
+    assert calls["razorpay.payment_links.create"] == 8
+    assert report["dependencies"]["twilio"] >= 4
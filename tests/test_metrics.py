@@ -0,0 +1,41 @@
+import asyncio
+
+from fastapi.testclient import TestClient
+
+import metrics
+from main import app
+
+
+def test_histogram_renders_cumulative_buckets():
+    hist = metrics.Histogram("test_seconds", "Test.", buckets=(0.1, 1.0))
+    hist.observe(0.05, stage="a")
+    hist.observe(0.5, stage="a")
+    hist.observe(5.0, stage="a")
+    lines = hist.render()
+    assert 'test_seconds_bucket{stage="a",le="0.1"} 1' in lines
+    assert 'test_seconds_bucket{stage="a",le="1.0"} 2' in lines
+    assert 'test_seconds_bucket{stage="a",le="+Inf"} 3' in lines
+    assert 'test_seconds_count{stage="a"} 3' in lines
+
+
+def test_instrument_records_stage_and_errors():
+    @metrics.instrument("test.failing")
+    async def failing():
+        raise ValueError("boom")
+
+    try:
+        asyncio.run(failing())
+    except ValueError:
+        pass
+    assert metrics.STAGE_SECONDS.count(stage="test.failing") == 1
+    assert metrics.STAGE_ERRORS.value(stage="test.failing") == 1
+
+
+def test_metrics_endpoint():
+    client = TestClient(app)
+    client.get("/")
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain")
+    assert 'metabolix_http_request_seconds_count{method="GET",path="/",status="200"}' in response.text
+    assert "metabolix_session_memory" in response.text
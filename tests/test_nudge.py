@@ -0,0 +1,96 @@
+import asyncio
+from datetime import datetime, timedelta
+
+import db
+import nudge
+from benchmarks.fakes import FakeDatabase
+
+
+def test_user_who_replies_mid_pass_is_not_stamped(monkeypatch):
+    fake_db = FakeDatabase()
+    idle = datetime.utcnow() - timedelta(days=2)
+    fake_db.users.docs.extend([
+        {"_id": 1, "phone": "+911", "name": "A", "last_activity_at": idle, "last_nudge_at": None},
+        {"_id": 2, "phone": "+912", "name": "B", "last_activity_at": idle, "last_nudge_at": None},
+    ])
+    sent = []
+
+    async def fake_send(phone, text):
+        sent.append(phone)
+        if phone == "+912":
+            # the user replies while the pass is running
+            fake_db.users.docs[1].update(last_activity_at=datetime.utcnow(), last_nudge_at=None)
+
+    monkeypatch.setattr(db, "db", fake_db)
+    monkeypatch.setattr(nudge, "send_whatsapp_message", fake_send)
+
+    asyncio.run(nudge.check_and_nudge())
+    assert sent == ["+911", "+912"]
+    assert fake_db.users.docs[0]["last_nudge_at"] is not None
+    assert fake_db.users.docs[1]["last_nudge_at"] is None
+
+
+def test_migration_carries_legacy_nudge(monkeypatch):
+    fake_db = FakeDatabase()
+    fake_db.users.docs.extend([
+        {"_id": 1, "phone": "+911", "chats": [{"input": "hi", "time": "2024-01-01T10:00:00"}],
+         "last_nudge": "2024-01-02T10:00:00"},
+        {"_id": 2, "phone": "+912", "chats": [{"input": "hi", "time": "2024-01-03T10:00:00"}],
+         "last_nudge": "2024-01-02T10:00:00"},
+    ])
+    monkeypatch.setattr(db, "db", fake_db)
+
+    async def run():
+        await db.migrate_legacy_chats()
+        # the backfill finds nothing left to do once the migration has run
+        return await nudge.backfill_activity_fields()
+
+    assert asyncio.run(run()) == 0
+    assert fake_db.users.docs[0]["last_nudge_at"] == datetime(2024, 1, 2, 10)
+    # a reply after the legacy nudge makes the user due again
+    assert fake_db.users.docs[1]["last_nudge_at"] is None
+
+
+def test_users_are_claimed_before_sending(monkeypatch):
+    fake_db = FakeDatabase()
+    idle = datetime.utcnow() - timedelta(days=2)
+    fake_db.users.docs.extend([
+        {"_id": 1, "phone": "+911", "name": "A", "last_activity_at": idle, "last_nudge_at": None},
+        {"_id": 2, "phone": "+912", "name": "B", "last_activity_at": idle, "last_nudge_at": None},
+    ])
+    sent = []
+
+    async def fake_send(phone, text):
+        # stamped before the message goes out
+        assert fake_db.users.docs[0 if phone == "+911" else 1]["last_nudge_at"] is not None
+        if phone == "+912":
+            raise RuntimeError("twilio down")
+        sent.append(phone)
+
+    monkeypatch.setattr(db, "db", fake_db)
+    monkeypatch.setattr(nudge, "send_whatsapp_message", fake_send)
+
+    async def run():
+        first = await nudge.check_and_nudge()
+        # a rerun, e.g. by a new leader, only retries the failed send
+        second = await nudge.check_and_nudge()
+        return first, second
+
+    assert asyncio.run(run()) == (1, 0)
+    assert sent == ["+911"]
+    assert fake_db.users.docs[1]["last_nudge_at"] is None
+
+
+def test_claim_skips_users_who_replied_since_the_read(monkeypatch):
+    fake_db = FakeDatabase()
+    idle = datetime.utcnow() - timedelta(days=2)
+    fake_db.users.docs.extend([
+        {"_id": 1, "phone": "+911", "last_activity_at": idle, "last_nudge_at": None},
+        {"_id": 2, "phone": "+912", "last_activity_at": datetime.utcnow(), "last_nudge_at": None},
+    ])
+    monkeypatch.setattr(db, "db", fake_db)
+    batch = [dict(doc, last_activity_at=idle) for doc in fake_db.users.docs]
+
+    claimed = asyncio.run(nudge._claim(batch, datetime(2024, 1, 1)))
+    assert [user["_id"] for user in claimed] == [1]
+    assert fake_db.users.docs[1]["last_nudge_at"] is None
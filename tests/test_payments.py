@@ -0,0 +1,290 @@
+import asyncio
+import json
+from datetime import datetime, timedelta
+
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+import db
+import razorpay_utils
+import routes
+from benchmarks.fakes import FakeDatabase
+from db import UnitOfWork
+from utils import LRUCache
+
+
+def test_payment_status_is_cached(monkeypatch):
+    calls = []
+
+    async def fake_fetch(link_id):
+        calls.append(link_id)
+        return {"status": "created"}
+
+    monkeypatch.setattr(razorpay_utils, "fetch_payment_link", fake_fetch)
+    monkeypatch.setattr(razorpay_utils, "_status_cache", LRUCache(10, ttl=60))
+
+    async def run():
+        return [await razorpay_utils.is_payment_complete("plink_1") for _ in range(3)]
+
+    assert asyncio.run(run()) == [None, None, None]
+    assert calls == ["plink_1"]
+
+
+def test_confirm_pending_payment_expires_stale_links(monkeypatch):
+    old = (datetime.utcnow() - timedelta(days=30)).isoformat()
+    checked = []
+
+    async def fake_complete(link_id):
+        checked.append(link_id)
+
+    monkeypatch.setattr(routes, "is_payment_complete", fake_complete)
+    uow = UnitOfWork("+911")
+    pending = [{"link_id": "plink_old", "status": "pending", "time": old}]
+
+    assert asyncio.run(routes.confirm_pending_payment("+911", pending, uow)) is None
+    assert len(uow._payment_updates) == 1
+    assert checked == []
+
+
+def test_confirm_pending_payment_records_paid_link(monkeypatch):
+    async def fake_complete(link_id):
+        return {"payment_id": "pay_1", "amount": 99}
+
+    monkeypatch.setattr(routes, "is_payment_complete", fake_complete)
+    uow = UnitOfWork("+911")
+    pending = [{"link_id": "plink_1", "status": "pending", "time": datetime.utcnow().isoformat()}]
+
+    reply = asyncio.run(routes.confirm_pending_payment("+911", pending, uow))
+    assert "pay_1" in reply
+    assert uow._payments[0]["status"] == "paid"
+
+
+def test_payment_webhook_redelivery_is_ignored(monkeypatch):
+    fake_db = FakeDatabase()
+    sent = []
+
+    async def fake_send(phone, text):
+        sent.append(phone)
+
+    monkeypatch.setattr(db, "db", fake_db)
+    monkeypatch.setattr(razorpay_utils, "get_redis", lambda: None)
+    monkeypatch.setattr(routes, "verify_signature", lambda body, signature: True)
+    monkeypatch.setattr(routes, "send_whatsapp_message", fake_send)
+    asyncio.run(db.ensure_indexes())
+
+    app = FastAPI()
+    app.include_router(routes.router)
+    client = TestClient(app)
+    body = json.dumps({
+        "event": "payment.captured",
+        "payload": {"payment": {"entity": {
+            "id": "pay_1", "amount": 9900, "status": "captured", "contact": "+911",
+        }}},
+    })
+    headers = {"X-Razorpay-Signature": "sig", "Content-Type": "application/json"}
+
+    first = client.post("/payment-webhook", content=body, headers=headers)
+    second = client.post("/payment-webhook", content=body, headers=headers)
+
+    assert first.json() == {"status": "ok"}
+    assert second.json() == {"status": "duplicate"}
+    assert len(fake_db.payment_events.docs) == 1
+    assert len(fake_db.users.docs[0]["payments"]) == 1
+    assert sent == ["+911"]
+
+
+def _fake_links(monkeypatch):
+    created = []
+
+    async def fake_create(amount, description, phone):
+        await asyncio.sleep(0.01)
+        created.append((amount, description, phone))
+        link_id = f"plink_{len(created)}"
+        return {"id": link_id, "url": f"https://rzp.io/i/{link_id}"}
+
+    monkeypatch.setattr(razorpay_utils, "create_payment_link", fake_create)
+    monkeypatch.setattr(razorpay_utils, "get_redis", lambda: None)
+    monkeypatch.setattr(razorpay_utils, "_link_cache", LRUCache(10, ttl=60))
+    monkeypatch.setattr(razorpay_utils, "_status_cache", LRUCache(10, ttl=60))
+    return created
+
+
+def test_get_payment_link_reuses_matching_pending_link(monkeypatch):
+    created = _fake_links(monkeypatch)
+    now = datetime.utcnow().isoformat()
+    nearly_expired = (datetime.utcnow() - timedelta(hours=47, minutes=30)).isoformat()
+    pending = [
+        {"amount": 99, "description": "Metabolix consult", "link": "https://rzp.io/i/old",
+         "link_id": "plink_old", "status": "pending", "time": nearly_expired},
+        {"amount": 99, "description": "Metabolix consult", "link": "https://rzp.io/i/live",
+         "link_id": "plink_live", "status": "pending", "time": now},
+        {"amount": 249, "description": "Metabolix video consult", "link": "https://rzp.io/i/video",
+         "link_id": "plink_video", "status": "pending", "time": now},
+    ]
+
+    async def run():
+        same = await razorpay_utils.get_payment_link(99, "Metabolix consult", "+911", pending)
+        razorpay_utils.cache_payment_status("plink_live", {"payment_id": "pay_1", "amount": 99})
+        after_paid = await razorpay_utils.get_payment_link(99, "Metabolix consult", "+911", pending)
+        return same, after_paid
+
+    same, after_paid = asyncio.run(run())
+    assert same["id"] == "plink_live"
+    # a paid link is never handed out again, nor one about to expire
+    assert after_paid["id"] == "plink_1"
+    assert created == [(99, "Metabolix consult", "+911")]
+
+
+def test_get_payment_link_caches_and_coalesces_creation(monkeypatch):
+    created = _fake_links(monkeypatch)
+
+    async def run():
+        first = await asyncio.gather(*(
+            razorpay_utils.get_payment_link(99, "Metabolix consult", "+911") for _ in range(3)
+        ))
+        again = await razorpay_utils.get_payment_link(99, "Metabolix consult", "+911")
+        other = await razorpay_utils.get_payment_link(249, "Metabolix video consult", "+911")
+        await razorpay_utils.forget_payment_links("+911")
+        fresh = await razorpay_utils.get_payment_link(99, "Metabolix consult", "+911")
+        return first, again, other, fresh
+
+    first, again, other, fresh = asyncio.run(run())
+    assert {link["id"] for link in first} == {"plink_1"}
+    assert again["id"] == "plink_1"
+    assert other["id"] == "plink_2"
+    assert fresh["id"] == "plink_3"
+    assert len(created) == 3
+
+
+def test_consult_requires_phone(monkeypatch):
+    async def fail(*args, **kwargs):
+        raise AssertionError("no link should be created")
+
+    monkeypatch.setattr(routes, "get_payment_link", fail)
+    app = FastAPI()
+    app.include_router(routes.router)
+    user = {"name": "A", "age": 30, "gender": "F", "location": "Delhi"}
+
+    resp = TestClient(app).post("/consult", json={"user": user, "symptoms": {"description": "x"}})
+
+    assert resp.status_code == 422
+
+
+def test_verify_signature_rejects_non_utf8_body():
+    assert razorpay_utils.verify_signature(b"\xff\xfe{}", "sig") is False
+
+
+def test_link_paid_after_payment_captured_marks_the_link(monkeypatch):
+    fake_db = FakeDatabase()
+    sent = []
+
+    async def fake_send(phone, text):
+        sent.append(phone)
+
+    monkeypatch.setattr(db, "db", fake_db)
+    monkeypatch.setattr(razorpay_utils, "get_redis", lambda: None)
+    monkeypatch.setattr(razorpay_utils, "_status_cache", LRUCache(10, ttl=60))
+    monkeypatch.setattr(routes, "verify_signature", lambda body, signature: True)
+    monkeypatch.setattr(routes, "send_whatsapp_message", fake_send)
+    asyncio.run(db.ensure_indexes())
+    fake_db.users.docs.append({"phone": "+911", "payments": [
+        {"amount": 99, "link_id": "plink_1", "status": "pending", "time": "2024-01-01T00:00:00"},
+    ]})
+
+    app = FastAPI()
+    app.include_router(routes.router)
+    client = TestClient(app)
+    payment = {"id": "pay_1", "amount": 9900, "status": "captured", "contact": "+911"}
+    headers = {"X-Razorpay-Signature": "sig", "Content-Type": "application/json"}
+    captured = json.dumps({"event": "payment.captured", "payload": {"payment": {"entity": payment}}})
+    link_paid = json.dumps({"event": "payment_link.paid", "payload": {
+        "payment": {"entity": payment}, "payment_link": {"entity": {"id": "plink_1"}},
+    }})
+
+    assert client.post("/payment-webhook", content=captured, headers=headers).json() == {"status": "ok"}
+    assert client.post("/payment-webhook", content=link_paid, headers=headers).json() == {
+        "status": "duplicate"
+    }
+
+    payments = fake_db.users.docs[0]["payments"]
+    assert payments[0]["status"] == "paid"
+    assert [p["status"] for p in payments].count("captured") == 1
+    assert sent == ["+911"]
+    assert razorpay_utils._status_cache.get("plink_1")["payment_id"] == "pay_1"
+
+
+def test_failed_claim_does_not_block_retries(monkeypatch):
+    import fakeredis.aioredis
+
+    redis = fakeredis.aioredis.FakeRedis(decode_responses=True)
+    failures = [RuntimeError("mongo down")]
+
+    async def flaky_insert(event):
+        if failures:
+            raise failures.pop()
+        return True
+
+    monkeypatch.setattr(razorpay_utils, "get_redis", lambda: redis)
+    monkeypatch.setattr(razorpay_utils, "insert_payment_event", flaky_insert)
+
+    async def run():
+        try:
+            await razorpay_utils.claim_payment_event({"event_key": "pay_1:captured"})
+        except RuntimeError:
+            pass
+        return await razorpay_utils.claim_payment_event({"event_key": "pay_1:captured"})
+
+    assert asyncio.run(run()) is True
+
+
+def test_links_without_a_phone_are_never_shared(monkeypatch):
+    created = _fake_links(monkeypatch)
+
+    async def run():
+        return [await razorpay_utils.get_payment_link(99, "Metabolix consult", None, []) for _ in range(2)]
+
+    first, second = asyncio.run(run())
+    assert first["id"] != second["id"]
+    assert len(created) == 2
+    assert len(razorpay_utils._link_cache) == 0
+
+
+def test_links_forgotten_by_another_worker_are_not_reused(monkeypatch):
+    import fakeredis.aioredis
+
+    created = _fake_links(monkeypatch)
+    redis = fakeredis.aioredis.FakeRedis(decode_responses=True)
+    monkeypatch.setattr(razorpay_utils, "get_redis", lambda: redis)
+
+    async def run():
+        first = await razorpay_utils.get_payment_link(99, "Metabolix consult", "+911")
+        # the worker that handles the payment webhook forgets the paid link
+        await redis.delete("payment_links:+911")
+        return first, await razorpay_utils.get_payment_link(99, "Metabolix consult", "+911")
+
+    first, second = asyncio.run(run())
+    assert (first["id"], second["id"]) == ("plink_1", "plink_2")
+    assert len(created) == 2
+    assert len(razorpay_utils._link_cache) == 0
+
+
+def test_consult_does_not_re_record_a_known_link(monkeypatch):
+    fake_db = FakeDatabase()
+    fake_db.users.docs.append({"phone": "+911", "payments": [
+        {"amount": 99, "link_id": "plink_1", "status": "paid", "time": "2024-01-01T00:00:00"},
+    ]})
+
+    async def stale_link(amount, description, phone, pending):
+        assert pending == []
+        return {"id": "plink_1", "url": "https://rzp.io/i/plink_1"}
+
+    monkeypatch.setattr(db, "db", fake_db)
+    monkeypatch.setattr(routes, "get_payment_link", stale_link)
+    app = FastAPI()
+    app.include_router(routes.router)
+    user = {"name": "A", "age": 30, "gender": "F", "location": "Delhi", "phone": "+911"}
+
+    resp = TestClient(app).post("/consult", json={"user": user, "symptoms": {"description": "x"}})
+
+    assert resp.status_code == 200
+    assert [p["status"] for p in fake_db.users.docs[0]["payments"]] == ["paid"]
@@ -0,0 +1,27 @@
+import asyncio
+
+import reply_queue
+
+
+def test_in_process_queue_runs_jobs(monkeypatch):
+    monkeypatch.setattr(reply_queue, "get_redis", lambda: None)
+    monkeypatch.setattr(reply_queue, "_local_queue", None)
+    handled = []
+
+    async def handler(job):
+        handled.append(job["sender"])
+
+    async def run():
+        reply_queue.start_reply_workers(handler, count=2)
+        for phone in ("+911", "+912", "+913"):
+            await reply_queue.enqueue_reply({"sender": phone, "message": "hi"})
+        while len(handled) < 3:
+            await asyncio.sleep(0)
+        stats = await reply_queue.reply_queue_stats()
+        await reply_queue.stop_reply_workers()
+        return stats
+
+    stats = asyncio.run(run())
+    assert sorted(handled) == ["+911", "+912", "+913"]
+    assert stats["depth"] == 0
+    assert stats["workers"] == 2
@@ -0,0 +1,35 @@
+import asyncio
+
+import sender_turns
+
+
+def _run_burst(monkeypatch, window_ms):
+    monkeypatch.setattr(sender_turns, "get_redis", lambda: None)
+    monkeypatch.setattr(sender_turns, "BURST_WINDOW_MS", window_ms)
+    calls = []
+
+    async def handler(sender, message, num_media):
+        calls.append(message)
+        await asyncio.sleep(0.05)
+        return f"reply to {message!r}"
+
+    async def send(message, delay):
+        await asyncio.sleep(delay)
+        return await sender_turns.run_coalesced("+911", message, 0, handler)
+
+    async def run():
+        return await asyncio.gather(send("hi", 0), send("price?", 0.01), send("3 months", 0.02))
+
+    return calls, asyncio.run(run())
+
+
+def test_messages_during_a_turn_are_merged_into_the_next(monkeypatch):
+    calls, replies = _run_burst(monkeypatch, 0)
+    assert calls == ["hi", "price?\n3 months"]
+    assert replies == ["reply to 'hi'", "reply to 'price?\\n3 months'", None]
+
+
+def test_debounce_window_merges_whole_burst(monkeypatch):
+    calls, replies = _run_burst(monkeypatch, 40)
+    assert calls == ["hi\nprice?\n3 months"]
+    assert replies.count(None) == 2
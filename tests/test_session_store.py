@@ -0,0 +1,60 @@
+import asyncio
+
+import session_store
+from session_store import trim_session
+from utils import LRUCache
+
+
+def test_lru_cache_evicts_least_recently_used():
+    cache = LRUCache(2)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.get("a") == 1
+    cache.set("c", 3)
+    assert cache.get("b") is None
+    assert cache.get("a") == 1
+    assert cache.stats() == {"size": 2, "hits": 2, "misses": 1, "evictions": 1}
+
+
+def test_trim_session_keeps_system_prefix():
+    session = [{"role": "system", "content": "meta"}]
+    for i in range(10):
+        session.append({"role": "user", "content": f"q{i}"})
+        session.append({"role": "assistant", "content": f"a{i}"})
+    trimmed = trim_session(session, max_turns=2)
+    assert [m["content"] for m in trimmed] == ["meta", "q8", "a8", "q9", "a9"]
+
+
+def test_memory_session_roundtrip(monkeypatch):
+    monkeypatch.setattr(session_store, "_redis", None)
+    monkeypatch.setattr(session_store, "_memory_store", LRUCache(1))
+
+    async def run():
+        await session_store.save_session("p1", [{"role": "user", "content": "hi"}])
+        await session_store.save_session("p2", [{"role": "user", "content": "yo"}])
+        return await session_store.get_session("p1"), await session_store.get_session("p2")
+
+    first, second = asyncio.run(run())
+    assert first == []
+    assert second == [{"role": "user", "content": "yo"}]
+
+
+def test_memory_append_session_keeps_pinned(monkeypatch):
+    monkeypatch.setattr(session_store, "_redis", None)
+    monkeypatch.setattr(session_store, "_memory_store", LRUCache(10))
+    monkeypatch.setattr(session_store, "SESSION_MAX_TURNS", 1)
+    meta = {"role": "system", "content": "meta"}
+
+    async def run():
+        await session_store.append_session(
+            "p", [{"role": "user", "content": "q0"}, {"role": "assistant", "content": "a0"}],
+            pinned=[meta],
+        )
+        await session_store.append_session(
+            "p", [{"role": "user", "content": "q1"}, {"role": "assistant", "content": "a1"}]
+        )
+        return await session_store.get_session("p")
+
+    session = asyncio.run(run())
+    assert [m["content"] for m in session] == ["meta", "q1", "a1"]
+
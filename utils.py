@@ -1,16 +1,24 @@
 """Utility helpers for the Metabolix chatbot."""
 
 import re
+import time
+from collections import OrderedDict
 from datetime import datetime
-from typing import Optional
+from typing import Dict, Generic, Iterable, Optional, Tuple, TypeVar
 import os
-import asyncio
-import logging
-
-from twilio.rest import Client
 
 from langdetect import detect, DetectorFactory, LangDetectException
 
+try:
+    import tiktoken
+
+    _ENCODING = tiktoken.get_encoding("cl100k_base")
+except Exception:  # optional; token counts fall back to an estimate
+    _ENCODING = None
+
+from http_client import request_json
+from metrics import instrument
+
 AGE_PATTERN = re.compile(r"^\d{1,3}$")
 PIN_PATTERN = re.compile(r"^\d{6}$")
 
@@ -39,8 +47,43 @@ LANG_MAP = {
 }
 
 
-def detect_language(text: str) -> str:
-    """Detect language of user text and return readable name."""
+# Unicode blocks of the Indic scripts in LANG_MAP. Devanagari is shared by
+# Hindi and Marathi and is disambiguated with MARATHI_MARKERS.
+SCRIPT_RANGES = (
+    (0x0900, 0x097F, "Hindi"),
+    (0x0980, 0x09FF, "Bengali"),
+    (0x0A00, 0x0A7F, "Punjabi"),
+    (0x0A80, 0x0AFF, "Gujarati"),
+    (0x0B80, 0x0BFF, "Tamil"),
+    (0x0C00, 0x0C7F, "Telugu"),
+    (0x0C80, 0x0CFF, "Kannada"),
+    (0x0D00, 0x0D7F, "Malayalam"),
+)
+MARATHI_MARKERS = ("ळ", "आहे", "आणि", "मला", "तुम्ही", "काय")
+
+SENDER_LANGUAGE_CACHE_SIZE = int(os.getenv("SENDER_LANGUAGE_CACHE_SIZE", "10000"))
+
+
+def _script_language(text: str) -> Optional[str]:
+    """Return the language of the dominant Indic script, or ``None``."""
+    counts: Dict[str, int] = {}
+    for ch in text:
+        cp = ord(ch)
+        if cp < 0x0900 or cp > 0x0D7F:
+            continue
+        for start, end, name in SCRIPT_RANGES:
+            if start <= cp <= end:
+                counts[name] = counts.get(name, 0) + 1
+                break
+    if not counts:
+        return None
+    language = max(counts, key=counts.get)
+    if language == "Hindi" and any(m in text for m in MARATHI_MARKERS):
+        return "Marathi"
+    return language
+
+
+def _langdetect_language(text: str) -> str:
     try:
         code = detect(text)
         return LANG_MAP.get(code, "English")
@@ -48,33 +91,134 @@ def detect_language(text: str) -> str:
         return "English"
 
 
+def detect_language(text: str, sender: Optional[str] = None) -> str:
+    """Detect language of user text and return readable name.
+
+    Indic scripts are recognised from their Unicode blocks; langdetect is only
+    used for Latin-script text. Messages with no letters at all (emoji,
+    numbers) keep the sender's last known language.
+    """
+    language = _script_language(text)
+    if language is None:
+        if not any(ch.isalpha() for ch in text):
+            cached = _sender_languages.get(sender) if sender else None
+            return cached or "English"
+        language = _langdetect_language(text)
+    return language
+
+
+def language_changed(sender: str, language: str) -> bool:
+    """Remember ``sender``'s language; return True if it differs from the last seen."""
+    changed = _sender_languages.get(sender) != language
+    if changed:
+        _sender_languages.set(sender, language)
+    return changed
+
+
 def timestamp() -> str:
     return datetime.utcnow().isoformat()
 
 
+# --- Token counting ---
+
+def count_tokens(text: str) -> int:
+    """Count tokens offline: exact with ``tiktoken`` installed, else an estimate.
+
+    The estimate assumes ~4 ASCII characters per token and one token per
+    non-ASCII character, which is close for Devanagari and other Indic text.
+    """
+    if not text:
+        return 0
+    if _ENCODING is not None:
+        return len(_ENCODING.encode(text))
+    non_ascii = sum(1 for ch in text if ord(ch) > 127)
+    return max(1, (len(text) - non_ascii + 3) // 4 + non_ascii)
+
+
+def count_message_tokens(messages: Iterable[Dict[str, str]]) -> int:
+    """Tokens a chat prompt will use, including per-message overhead."""
+    return sum(count_tokens(m.get("content") or "") + 4 for m in messages) + 2
+
+
+# --- In-process caching ---
+V = TypeVar("V")
+
+
+class LRUCache(Generic[V]):
+    """Size-capped in-process LRU with optional per-entry TTL and counters."""
+
+    def __init__(self, max_size: int, ttl: Optional[float] = None) -> None:
+        self.max_size = max_size
+        self.ttl = ttl
+        self._data: "OrderedDict[str, Tuple[float, V]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: str) -> Optional[V]:
+        item = self._data.get(key)
+        if item is None:
+            self.misses += 1
+            return None
+        expires_at, value = item
+        if expires_at and expires_at < time.monotonic():
+            del self._data[key]
+            self.misses += 1
+            return None
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key: str, value: V) -> None:
+        expires_at = time.monotonic() + self.ttl if self.ttl else 0.0
+        self._data[key] = (expires_at, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def pop(self, key: str) -> None:
+        self._data.pop(key, None)
+
+    def clear(self) -> None:
+        self._data.clear()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "size": len(self._data),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+
+_sender_languages: LRUCache[str] = LRUCache(SENDER_LANGUAGE_CACHE_SIZE)
+
+
 # --- Twilio helper functions ---
 TWILIO_ACCOUNT_SID = os.getenv("TWILIO_ACCOUNT_SID")
 TWILIO_AUTH_TOKEN = os.getenv("TWILIO_AUTH_TOKEN")
 TWILIO_WHATSAPP_NUMBER = os.getenv("TWILIO_WHATSAPP_NUMBER")
-
-_twilio_client = None
-if TWILIO_ACCOUNT_SID and TWILIO_AUTH_TOKEN:
-    try:
-        _twilio_client = Client(TWILIO_ACCOUNT_SID, TWILIO_AUTH_TOKEN)
-    except Exception as exc:
-        logging.warning("Twilio client init failed: %s", exc)
-        _twilio_client = None
+TWILIO_API_BASE = os.getenv("TWILIO_API_BASE", "https://api.twilio.com")
 
 
+@instrument("twilio.send_message")
 async def send_whatsapp_message(phone: str, text: str) -> None:
     """Send a WhatsApp message via Twilio if configured."""
-    if not _twilio_client or not TWILIO_WHATSAPP_NUMBER:
+    if not (TWILIO_ACCOUNT_SID and TWILIO_AUTH_TOKEN and TWILIO_WHATSAPP_NUMBER):
         return
-    await asyncio.to_thread(
-        _twilio_client.messages.create,
-        body=text,
-        from_=f"whatsapp:{TWILIO_WHATSAPP_NUMBER}",
-        to=f"whatsapp:{phone}",
+    await request_json(
+        "POST",
+        f"{TWILIO_API_BASE}/2010-04-01/Accounts/{TWILIO_ACCOUNT_SID}/Messages.json",
+        auth=(TWILIO_ACCOUNT_SID, TWILIO_AUTH_TOKEN),
+        data={
+            "Body": text,
+            "From": f"whatsapp:{TWILIO_WHATSAPP_NUMBER}",
+            "To": f"whatsapp:{phone}",
+        },
     )
 
 # --- Admin notification helper ---